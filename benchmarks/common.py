@@ -0,0 +1,38 @@
+import os
+import tempfile
+
+from q2_surpi._simulate import simulate_surpi_run
+
+
+def _get_sizes(env_var, default):
+    # sizes can be overridden with a comma-separated list, e.g.
+    # Q2_SURPI_BENCH_TAXA=1000,1000000
+    env_value = os.environ.get(env_var)
+    if env_value is None:
+        return default
+    return [int(x) for x in env_value.split(",")]
+
+
+BARCODE_COUNTS = _get_sizes("Q2_SURPI_BENCH_BARCODES", [100, 1000])
+TAXA_COUNTS = _get_sizes("Q2_SURPI_BENCH_TAXA", [1000, 100000])
+# fraction of counttable cells that are nonzero
+DENSITY = 0.005
+FIXTURES_DIR = os.path.join(tempfile.gettempdir(), "q2-surpi-benchmarks")
+
+
+def get_fixture_fps(n_barcodes, n_taxa, seed=0):
+    """Return the counttable and sample sheet paths for a synthetic run.
+
+    The files are generated the first time they are requested and then
+    reused, so generation time is not part of any benchmark.
+    """
+    fixture_dir = os.path.join(
+        FIXTURES_DIR, f"{n_barcodes}x{n_taxa}_seed{seed}")
+    counttable_fp = os.path.join(fixture_dir, "surpi_output.counttable")
+    sample_sheet_fp = os.path.join(fixture_dir, "surpi_sample_info.csv")
+    if not os.path.exists(sample_sheet_fp):
+        counttable_fp, sample_sheet_fp = simulate_surpi_run(
+            fixture_dir, n_barcodes, n_taxa, density=DENSITY, seed=seed)
+    # endif the fixture doesn't exist yet
+
+    return counttable_fp, sample_sheet_fp
@@ -0,0 +1,155 @@
+import os
+import tempfile
+
+import qiime2
+
+import q2_surpi._formats_and_types
+from q2_surpi import (
+    SurpiCountTableFormat, SurpiSampleSheetFormat, SurpiCountTableReader,
+    extract)
+from q2_surpi.plugin_setup import _1, _2, _3
+from q2_surpi._counttable import write_arrow_cache
+from q2_surpi._cache import get_pyarrow
+
+from .common import BARCODE_COUNTS, TAXA_COUNTS, get_fixture_fps
+
+
+class _PipelineBenchmark:
+    params = (BARCODE_COUNTS, TAXA_COUNTS)
+    param_names = ['n_barcodes', 'n_taxa']
+    # generating the largest fixtures the first time takes a while
+    timeout = 3600
+
+    def setup(self, n_barcodes, n_taxa):
+        self.counttable_fp, self.sample_sheet_fp = get_fixture_fps(
+            n_barcodes, n_taxa)
+
+
+class CountTableValidation(_PipelineBenchmark):
+    def time_validate_min(self, n_barcodes, n_taxa):
+        SurpiCountTableFormat(self.counttable_fp, mode='r').validate('min')
+
+    def time_validate_max(self, n_barcodes, n_taxa):
+        SurpiCountTableFormat(self.counttable_fp, mode='r').validate('max')
+
+    def peakmem_validate_max(self, n_barcodes, n_taxa):
+        SurpiCountTableFormat(self.counttable_fp, mode='r').validate('max')
+
+
+class ShardedCountTableValidation(_PipelineBenchmark):
+    # validate every fixture in parallel, even those below the size at
+    # which 'max' validation switches to the sharded path
+    def setup(self, n_barcodes, n_taxa):
+        super().setup(n_barcodes, n_taxa)
+        self.min_bytes = \
+            q2_surpi._formats_and_types.PARALLEL_VALIDATION_MIN_BYTES
+        q2_surpi._formats_and_types.PARALLEL_VALIDATION_MIN_BYTES = 0
+
+    def teardown(self, n_barcodes, n_taxa):
+        q2_surpi._formats_and_types.PARALLEL_VALIDATION_MIN_BYTES = \
+            self.min_bytes
+
+    def time_validate_max_sharded(self, n_barcodes, n_taxa):
+        SurpiCountTableFormat(self.counttable_fp, mode='r').validate('max')
+
+
+class Transformers(_PipelineBenchmark):
+    def time_counttable_to_dataframe(self, n_barcodes, n_taxa):
+        _1(SurpiCountTableFormat(self.counttable_fp, mode='r'))
+
+    def peakmem_counttable_to_dataframe(self, n_barcodes, n_taxa):
+        _1(SurpiCountTableFormat(self.counttable_fp, mode='r'))
+
+    def time_counttable_to_reader_chunks(self, n_barcodes, n_taxa):
+        reader = _3(SurpiCountTableFormat(self.counttable_fp, mode='r'))
+        for _ in reader.iter_chunks():
+            pass
+
+    def peakmem_counttable_to_reader_chunks(self, n_barcodes, n_taxa):
+        reader = _3(SurpiCountTableFormat(self.counttable_fp, mode='r'))
+        for _ in reader.iter_chunks():
+            pass
+
+    def time_write_arrow_cache(self, n_barcodes, n_taxa):
+        if get_pyarrow() is None:
+            raise NotImplementedError("pyarrow is not installed")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            write_arrow_cache(self.counttable_fp,
+                              os.path.join(temp_dir, "surpi_output.arrow"))
+
+    def time_sample_sheet_to_dataframe(self, n_barcodes, n_taxa):
+        _2(SurpiSampleSheetFormat(self.sample_sheet_fp, mode='r'))
+
+    def peakmem_sample_sheet_to_dataframe(self, n_barcodes, n_taxa):
+        _2(SurpiSampleSheetFormat(self.sample_sheet_fp, mode='r'))
+
+
+class Extract(_PipelineBenchmark):
+    def setup(self, n_barcodes, n_taxa):
+        super().setup(n_barcodes, n_taxa)
+        self.sample_info_df = _2(
+            SurpiSampleSheetFormat(self.sample_sheet_fp, mode='r'))
+
+    def time_extract(self, n_barcodes, n_taxa):
+        extract(SurpiCountTableReader(self.counttable_fp),
+                self.sample_info_df)
+
+    def peakmem_extract(self, n_barcodes, n_taxa):
+        extract(SurpiCountTableReader(self.counttable_fp),
+                self.sample_info_df)
+
+
+class ExtractArrowCache(_PipelineBenchmark):
+    def setup(self, n_barcodes, n_taxa):
+        if get_pyarrow() is None:
+            raise NotImplementedError("pyarrow is not installed")
+        super().setup(n_barcodes, n_taxa)
+        self.sample_info_df = _2(
+            SurpiSampleSheetFormat(self.sample_sheet_fp, mode='r'))
+        self.arrow_fp = os.path.splitext(self.counttable_fp)[0] + ".arrow"
+        if not os.path.exists(self.arrow_fp):
+            write_arrow_cache(self.counttable_fp, self.arrow_fp)
+
+    def time_extract(self, n_barcodes, n_taxa):
+        extract(SurpiCountTableReader(self.counttable_fp,
+                                      arrow_fp=self.arrow_fp),
+                self.sample_info_df)
+
+    def peakmem_extract(self, n_barcodes, n_taxa):
+        extract(SurpiCountTableReader(self.counttable_fp,
+                                      arrow_fp=self.arrow_fp),
+                self.sample_info_df)
+
+
+class WriteArtifacts(_PipelineBenchmark):
+    def setup(self, n_barcodes, n_taxa):
+        super().setup(n_barcodes, n_taxa)
+        sample_info_df = _2(
+            SurpiSampleSheetFormat(self.sample_sheet_fp, mode='r'))
+        self.table, self.taxonomy_df = extract(
+            SurpiCountTableReader(self.counttable_fp), sample_info_df)
+        self.output_dir = tempfile.TemporaryDirectory(
+            prefix='q2-surpi-bench-')
+
+    def teardown(self, n_barcodes, n_taxa):
+        self.output_dir.cleanup()
+
+    def time_write_table(self, n_barcodes, n_taxa):
+        qiime2.Artifact.import_data(
+            'FeatureTable[Frequency]', self.table).save(
+            os.path.join(self.output_dir.name, 'table.qza'))
+
+    def peakmem_write_table(self, n_barcodes, n_taxa):
+        qiime2.Artifact.import_data(
+            'FeatureTable[Frequency]', self.table).save(
+            os.path.join(self.output_dir.name, 'table.qza'))
+
+    def time_write_taxonomy(self, n_barcodes, n_taxa):
+        qiime2.Artifact.import_data(
+            'FeatureData[Taxonomy]', self.taxonomy_df).save(
+            os.path.join(self.output_dir.name, 'taxonomy.qza'))
+
+    def peakmem_write_taxonomy(self, n_barcodes, n_taxa):
+        qiime2.Artifact.import_data(
+            'FeatureData[Taxonomy]', self.taxonomy_df).save(
+            os.path.join(self.output_dir.name, 'taxonomy.qza'))
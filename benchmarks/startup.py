@@ -0,0 +1,8 @@
+class ImportTime:
+    # timeraw benchmarks run their code in a fresh interpreter, so modules
+    # imported by other benchmarks don't hide the cost of importing the plugin
+    def timeraw_import_package(self):
+        return "import q2_surpi"
+
+    def timeraw_import_plugin_setup(self):
+        return "import q2_surpi.plugin_setup"
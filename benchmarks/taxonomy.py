@@ -0,0 +1,47 @@
+import numpy as np
+import pandas
+
+from q2_surpi._formats_and_types import SPECIES_KEY, GENUS_KEY, FAMILY_KEY
+from q2_surpi._plugin import _generate_taxonomy_str, _generate_taxonomy_strs
+
+
+def _make_taxa_df(n_rows, seed=0):
+    # Roughly mimic SURPI+ output: most rows have all three ranks, but some
+    # genera and families are missing, and a few species are "*" placeholders
+    rng = np.random.default_rng(seed)
+    families = np.array([f"Family{i}viridae" for i in range(500)],
+                        dtype=object)
+    genera = np.array([f"Genus{i}virus" for i in range(5000)], dtype=object)
+
+    species = np.array([f"Species virus {i}" for i in range(n_rows)],
+                       dtype=object)
+    species[rng.random(n_rows) < 0.01] = "*"
+    genus = genera[rng.integers(0, len(genera), n_rows)]
+    genus[rng.random(n_rows) < 0.3] = np.nan
+    family = families[rng.integers(0, len(families), n_rows)]
+    family[rng.random(n_rows) < 0.05] = np.nan
+
+    return pandas.DataFrame(
+        {SPECIES_KEY: species, GENUS_KEY: genus, FAMILY_KEY: family})
+
+
+class TaxonomyStrings:
+    params = [10_000, 100_000, 1_000_000]
+    param_names = ['n_rows']
+    # the row-wise baseline takes tens of seconds at the largest size
+    timeout = 600
+
+    def setup(self, n_rows):
+        self.taxa_df = _make_taxa_df(n_rows)
+
+    def time_rowwise(self, n_rows):
+        self.taxa_df.apply(lambda x: _generate_taxonomy_str(x), axis=1)
+
+    def time_vectorized(self, n_rows):
+        _generate_taxonomy_strs(self.taxa_df)
+
+    def peakmem_rowwise(self, n_rows):
+        self.taxa_df.apply(lambda x: _generate_taxonomy_str(x), axis=1)
+
+    def peakmem_vectorized(self, n_rows):
+        _generate_taxonomy_strs(self.taxa_df)
@@ -1,7 +1,3 @@
-from ._plugin import extract
-from ._formats_and_types import (
-    SurpiCountTable, SurpiCountTableFormat, SurpiCountTableDirectoryFormat,
-    SurpiSampleSheet, SurpiSampleSheetFormat, SurpiSampleSheetDirectoryFormat)
 from . import _version
 __version__ = _version.get_versions()['version']
 
@@ -17,6 +13,47 @@ __email__ = 'abirmingham@ucsd.edu'
 __url__ = 'https://github.com/biocore/q2-surpi'
 __citations_fname__ = 'citations.bib'
 
-__all__ = ['extract', 'SurpiCountTable', 'SurpiCountTableFormat',
-           'SurpiCountTableDirectoryFormat', 'SurpiSampleSheet',
-           'SurpiSampleSheetFormat', 'SurpiSampleSheetDirectoryFormat']
+# The public names are imported from their modules on first use, so that
+# importing q2_surpi (as the QIIME 2 CLI does whenever it builds its plugin
+# cache or prints help) does not also import pandas, biom and the like.
+_LAZY_IMPORTS = {
+    'extract': '_plugin',
+    'extract_batch': '_plugin',
+    'extract_append': '_plugin',
+    'SurpiCountTable': '_formats_and_types',
+    'SurpiCountTableFormat': '_formats_and_types',
+    'SurpiCountTableDirectoryFormat': '_formats_and_types',
+    'SurpiCountTableCompressedFormat': '_formats_and_types',
+    'SurpiSampleSheet': '_formats_and_types',
+    'SurpiSampleSheetFormat': '_formats_and_types',
+    'SurpiSampleSheetDirectoryFormat': '_formats_and_types',
+    'SurpiSampleSheetCompressedFormat': '_formats_and_types',
+    'SurpiCountTableReader': '_counttable',
+    'SurpiCountMatrix': '_counttable',
+}
+
+__all__ = ['extract', 'extract_batch', 'extract_append', 'SurpiCountTable',
+           'SurpiCountTableFormat', 'SurpiCountTableDirectoryFormat',
+           'SurpiCountTableCompressedFormat', 'SurpiSampleSheet',
+           'SurpiSampleSheetFormat', 'SurpiSampleSheetDirectoryFormat',
+           'SurpiSampleSheetCompressedFormat', 'SurpiCountTableReader',
+           'SurpiCountMatrix']
+
+
+def __getattr__(name):
+    module_name = _LAZY_IMPORTS.get(name)
+    if module_name is None:
+        raise AttributeError(
+            f"module '{__package_name__}' has no attribute '{name}'")
+
+    # __import__, unlike importlib.import_module, is reported by
+    # python -X importtime, so deferred imports still show up in its output
+    module = __import__(f"{__package_name__}.{module_name}", fromlist=[name])
+    value = getattr(module, name)
+    # later lookups find the name directly, without calling __getattr__
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_IMPORTS))
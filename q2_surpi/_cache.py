@@ -0,0 +1,288 @@
+import argparse
+import functools
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from q2_surpi._version import get_versions
+
+# if set, parsed counttables and extract results are cached in this directory
+CACHE_DIR_ENV_VAR = "Q2_SURPI_CACHE_DIR"
+# parsed counttables and stored results are two kinds of entry, each trimmed
+# to its own number of bytes, least recently used entries first, so that
+# writing one kind never evicts the other
+COUNTTABLE_ENTRIES = "counttables"
+RESULT_ENTRIES = "results"
+CACHE_MAX_BYTES_ENV_VAR = "Q2_SURPI_CACHE_MAX_BYTES"
+DEFAULT_CACHE_MAX_BYTES = 10 * 2 ** 30
+RESULT_CACHE_MAX_BYTES_ENV_VAR = "Q2_SURPI_RESULT_CACHE_MAX_BYTES"
+DEFAULT_RESULT_CACHE_MAX_BYTES = 2 ** 30
+_MAX_BYTES_SETTINGS = {
+    COUNTTABLE_ENTRIES: (CACHE_MAX_BYTES_ENV_VAR, DEFAULT_CACHE_MAX_BYTES),
+    RESULT_ENTRIES: (RESULT_CACHE_MAX_BYTES_ENV_VAR,
+                     DEFAULT_RESULT_CACHE_MAX_BYTES)}
+RESULTS_DIRNAME = "results"
+ARROW_CACHE_EXT = ".arrow"
+MATRIX_CACHE_EXT = ".matrix"
+# entries that are still being written end in this suffix and are skipped
+TEMP_SUFFIX = ".tmp"
+# the cache directory may be shared, so only names this module writes are
+# ever listed or removed: <sha256>.arrow and <sha256>.matrix for parsed
+# counttables, and results/<sha256> for stored results
+_COUNTTABLE_ENTRY_RE = re.compile(
+    f"^[0-9a-f]{{64}}({re.escape(ARROW_CACHE_EXT)}|"
+    f"{re.escape(MATRIX_CACHE_EXT)})$")
+_RESULT_ENTRY_RE = re.compile("^[0-9a-f]{64}$")
+
+
+@functools.lru_cache(maxsize=None)
+def get_pyarrow():
+    """Return the pyarrow module, or None if it is not installed.
+
+    pyarrow is only needed for the arrow counttable cache and takes a large
+    share of the plugin's import time, so it is imported on first use rather
+    than when the plugin is loaded.
+    """
+
+    try:
+        import pyarrow
+        import pyarrow.ipc  # noqa: F401
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def get_cache_dir() -> str:
+    """Return the cache directory, or None if caching is not enabled."""
+    return os.environ.get(CACHE_DIR_ENV_VAR) or None
+
+
+def get_cache_max_bytes(kind: str = COUNTTABLE_ENTRIES) -> int:
+    """Return the size to which one kind of cache entry is trimmed.
+
+    Raises
+    ------
+    ValueError
+        If the environment variable that sets the size is not a
+        non-negative integer.
+    """
+
+    env_var, default_max_bytes = _MAX_BYTES_SETTINGS[kind]
+    env_value = os.environ.get(env_var, "").strip()
+    if env_value == "":
+        return default_max_bytes
+
+    try:
+        max_bytes = int(env_value)
+    except ValueError:
+        max_bytes = -1
+    if max_bytes < 0:
+        raise ValueError(
+            f"Expected {env_var} to be a non-negative integer, but got "
+            f"'{env_value}'")
+    return max_bytes
+
+
+def get_file_digest(fp: str, block_size: int = 2 ** 20) -> str:
+    """Return the SHA-256 hex digest of a file's contents."""
+    hasher = hashlib.sha256()
+    with open(fp, "rb") as f:
+        for curr_block in iter(lambda: f.read(block_size), b""):
+            hasher.update(curr_block)
+    return hasher.hexdigest()
+
+
+def get_result_key(method_name: str, input_digests: list,
+                   params: dict) -> str:
+    """Return the cache key of a method's result.
+
+    The key covers the digests of the inputs, the parameters that affect the
+    result and the plugin version, so a new release never reuses results
+    computed by an older one.
+    """
+
+    key_json = json.dumps(
+        {"method": method_name, "inputs": input_digests, "params": params,
+         "version": get_versions()['version']},
+        sort_keys=True)
+    return hashlib.sha256(key_json.encode("utf-8")).hexdigest()
+
+
+def get_result_dir(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, RESULTS_DIRNAME, key)
+
+
+def touch_cache_entry(entry_fp: str):
+    """Mark a cache entry as just used, for least-recently-used eviction."""
+    os.utime(entry_fp)
+
+
+def list_cache_entries(cache_dir: str, kind: str = None) -> list:
+    """Return (path, size in bytes, last used time) of each cache entry.
+
+    Each parsed counttable and each stored result is one entry; entries are
+    listed from least to most recently used. If kind is COUNTTABLE_ENTRIES
+    or RESULT_ENTRIES, only the entries of that kind are listed. Any other
+    files in cache_dir, including entries that are still being written, are
+    not entries, so they are never removed by evict_cache or clear_cache.
+    """
+
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return entries
+
+    results_dir = os.path.join(cache_dir, RESULTS_DIRNAME)
+    candidate_fps = []
+    if kind != RESULT_ENTRIES:
+        candidate_fps.extend(
+            os.path.join(cache_dir, x) for x in os.listdir(cache_dir)
+            if _COUNTTABLE_ENTRY_RE.match(x))
+    if kind != COUNTTABLE_ENTRIES and os.path.isdir(results_dir):
+        candidate_fps.extend(
+            os.path.join(results_dir, x) for x in os.listdir(results_dir)
+            if _RESULT_ENTRY_RE.match(x))
+
+    for curr_fp in candidate_fps:
+        entries.append(
+            (curr_fp, _get_size(curr_fp), os.stat(curr_fp).st_mtime))
+    # endfor each candidate
+
+    return sorted(entries, key=lambda x: x[2])
+
+
+def evict_cache(cache_dir: str, max_bytes: int = None,
+                keep_fps: list = (), kind: str = None) -> list:
+    """Remove least recently used entries until the cache fits in max_bytes.
+
+    If kind is given, only entries of that kind are counted and removed,
+    and max_bytes defaults to the size limit of that kind. If neither is
+    given, each kind is trimmed to its own limit. Entries in keep_fps, such
+    as one that was just written and is about to be read, are never
+    removed. Returns the paths of the removed entries.
+    """
+
+    if max_bytes is None:
+        if kind is None:
+            return [x for curr_kind in _MAX_BYTES_SETTINGS
+                    for x in evict_cache(cache_dir, keep_fps=keep_fps,
+                                         kind=curr_kind)]
+        max_bytes = get_cache_max_bytes(kind)
+    entries = list_cache_entries(cache_dir, kind)
+    total_bytes = sum(x[1] for x in entries)
+    keep_fps = set(os.path.abspath(x) for x in keep_fps)
+
+    removed_fps = []
+    for curr_fp, curr_size, _ in entries:
+        if total_bytes <= max_bytes:
+            break
+        if os.path.abspath(curr_fp) in keep_fps:
+            continue
+        _remove(curr_fp)
+        total_bytes -= curr_size
+        removed_fps.append(curr_fp)
+    # endfor each entry, least recently used first
+
+    return removed_fps
+
+
+def clear_cache(cache_dir: str) -> int:
+    """Remove every cache entry, and return how many were removed."""
+    entries = list_cache_entries(cache_dir)
+    for curr_fp, _, _ in entries:
+        _remove(curr_fp)
+    return len(entries)
+
+
+def store_result_files(cache_dir: str, key: str, write_fn):
+    """Store a result in the cache, then trim the stored results to theirs.
+
+    write_fn is called with a temporary directory in which to write the
+    result's files; the directory becomes the result's entry only once
+    write_fn returns, so a partly written result is never read.
+    """
+
+    results_dir = os.path.join(cache_dir, RESULTS_DIRNAME)
+    result_dir = get_result_dir(cache_dir, key)
+    os.makedirs(results_dir, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(dir=results_dir, suffix=TEMP_SUFFIX)
+    try:
+        write_fn(temp_dir)
+        if not os.path.exists(result_dir):
+            os.replace(temp_dir, result_dir)
+    finally:
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+    # endtry
+
+    evict_cache(cache_dir, keep_fps=[result_dir], kind=RESULT_ENTRIES)
+
+
+def _get_size(fp):
+    if not os.path.isdir(fp):
+        return os.path.getsize(fp)
+
+    total_size = 0
+    for curr_dir, _, curr_fnames in os.walk(fp):
+        total_size += sum(
+            os.path.getsize(os.path.join(curr_dir, x)) for x in curr_fnames)
+    return total_size
+
+
+def _remove(fp):
+    if os.path.isdir(fp):
+        shutil.rmtree(fp, ignore_errors=True)
+    elif os.path.exists(fp):
+        os.remove(fp)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="q2-surpi-cache",
+        description="Inspect or clear the q2-surpi cache of parsed "
+                    "counttables and extract results.")
+    parser.add_argument("command", choices=["info", "clear", "trim"],
+                        help="'info' lists the cache entries, 'clear' "
+                             "removes them all and 'trim' removes the least "
+                             "recently used ones until the cache fits in "
+                             "its size limit")
+    parser.add_argument("--cache-dir", default=get_cache_dir(),
+                        help=f"cache directory; defaults to "
+                             f"${CACHE_DIR_ENV_VAR}")
+    parser.add_argument("--max-bytes", type=int, default=None,
+                        help=f"size limit of the whole cache used by "
+                             f"'trim'; by default, parsed counttables are "
+                             f"trimmed to ${CACHE_MAX_BYTES_ENV_VAR} (or "
+                             f"{DEFAULT_CACHE_MAX_BYTES}) and results to "
+                             f"${RESULT_CACHE_MAX_BYTES_ENV_VAR} (or "
+                             f"{DEFAULT_RESULT_CACHE_MAX_BYTES})")
+    args = parser.parse_args(argv)
+
+    if args.cache_dir is None:
+        parser.error(f"no cache directory; set {CACHE_DIR_ENV_VAR} or pass "
+                     f"--cache-dir")
+
+    if args.command == "info":
+        entries = list_cache_entries(args.cache_dir)
+        for curr_fp, curr_size, curr_mtime in entries:
+            last_used = time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(curr_mtime))
+            print(f"{last_used}\t{curr_size}\t"
+                  f"{os.path.relpath(curr_fp, args.cache_dir)}")
+        # endfor each entry
+        print(f"{len(entries)} entries, "
+              f"{sum(x[1] for x in entries)} bytes in {args.cache_dir}")
+    elif args.command == "clear":
+        num_removed = clear_cache(args.cache_dir)
+        print(f"Removed {num_removed} entries from {args.cache_dir}")
+    else:
+        removed_fps = evict_cache(args.cache_dir, args.max_bytes)
+        print(f"Removed {len(removed_fps)} entries from {args.cache_dir}")
+    # endif args.command
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import bz2
+import functools
+import gzip
+import io
+
+# compressions by the magic bytes that start a compressed file, named as
+# pandas names them
+COMPRESSION_MAGICS = {
+    "gzip": b"\x1f\x8b",
+    "bz2": b"BZh",
+    "zstd": b"\x28\xb5\x2f\xfd",
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_zstandard():
+    """Return the zstandard module, or None if it is not installed.
+
+    zstandard is only needed to read zstandard compressed inputs, so, like
+    pyarrow, it is imported on first use.
+    """
+
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def get_compression(fp: str) -> str:
+    """Return the compression of a file, or None if it is not compressed.
+
+    The compression is read from the file's first bytes rather than from its
+    extension, since QIIME 2 does not keep the names of imported files.
+    """
+
+    max_magic_len = max(len(x) for x in COMPRESSION_MAGICS.values())
+    with open(fp, "rb") as f:
+        first_bytes = f.read(max_magic_len)
+
+    for curr_compression, curr_magic in COMPRESSION_MAGICS.items():
+        if first_bytes.startswith(curr_magic):
+            return curr_compression
+    return None
+
+
+def open_decompressed(fp: str, mode: str = "rb"):
+    """Open a file that may be compressed, decompressing it as it is read.
+
+    Parameters
+    ----------
+    fp : str
+        Path of a gzip, bzip2 or zstandard compressed file, or of an
+        uncompressed one.
+    mode : str, optional
+        "rb" to read the decompressed bytes or "r" to read the decompressed
+        text. Default is "rb".
+
+    Returns
+    -------
+    A file object from which the decompressed contents are streamed; the
+    whole file is never decompressed into memory or onto disk.
+    """
+
+    compression = get_compression(fp)
+    if compression == "gzip":
+        f = gzip.open(fp, "rb")
+    elif compression == "bz2":
+        f = bz2.open(fp, "rb")
+    elif compression == "zstd":
+        zstandard = get_zstandard()
+        if zstandard is None:
+            raise ImportError(
+                "zstandard is required to read zstandard compressed files")
+        f = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+            open(fp, "rb"), closefd=True))
+    else:
+        f = open(fp, "rb")
+    # endif compression
+
+    if mode == "r":
+        return io.TextIOWrapper(f)
+    return f
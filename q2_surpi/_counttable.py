@@ -0,0 +1,521 @@
+import os
+import shutil
+import tempfile
+import numpy
+import pandas
+from q2_surpi._formats_and_types import SPECIES_KEY, GENUS_KEY, FAMILY_KEY, \
+    TAG_KEY
+from q2_surpi._cache import ARROW_CACHE_EXT, MATRIX_CACHE_EXT, TEMP_SUFFIX, \
+    COUNTTABLE_ENTRIES, evict_cache, get_file_digest, get_pyarrow, \
+    touch_cache_entry
+
+DEFAULT_CHUNK_SIZE = 100000
+COUNTS_FNAME = "counts.npy"
+TAXA_FNAME = "taxa.tsv"
+SAMPLES_FNAME = "samples.txt"
+COUNT_DTYPE = numpy.uint32
+# candidate dtypes for counts held in memory, from smallest to largest
+COMPACT_COUNT_DTYPES = [numpy.uint8, numpy.uint16, numpy.uint32, numpy.uint64]
+TAXA_KEYS = [SPECIES_KEY, GENUS_KEY, FAMILY_KEY, TAG_KEY]
+# species names are nearly all distinct, but genera, families and tags repeat
+# across many rows, so those are held as categorical codes
+TAXA_DTYPES = {SPECIES_KEY: str, GENUS_KEY: "category",
+               FAMILY_KEY: "category", TAG_KEY: "category"}
+
+
+class SurpiCountTableReader:
+    """Lazily reads a tab-delimited SURPI+ counttable in chunks of rows.
+
+    Nothing beyond the header line is read until the chunks are iterated, so
+    peak memory depends on the chunk size rather than on the size of the file.
+    If an Arrow cache of the counttable is given, the chunks are read from a
+    memory map of the cache instead of being parsed from the text. If a
+    cache directory is given instead, the counttable's Arrow cache there is
+    found, or written, only when the chunks are first iterated, so a reader
+    whose chunks are never needed (for example because extract finds its
+    result already stored) never parses the counttable.
+
+    Parameters
+    ----------
+    fp : str
+        The path to the SURPI+ counttable file.
+    arrow_fp : str, optional
+        The path to an Arrow IPC cache of the same counttable, as written by
+        write_arrow_cache. Ignored if pyarrow is not installed.
+    cache_dir : str, optional
+        The directory that holds the Arrow caches of counttables, as used by
+        get_cached_arrow_fp. Ignored if arrow_fp is given or if pyarrow is
+        not installed.
+    """
+
+    def __init__(self, fp: str, arrow_fp: str = None,
+                 cache_dir: str = None):
+        self.fp = str(fp)
+        self.arrow_fp = None
+        if arrow_fp is not None and get_pyarrow() is not None:
+            self.arrow_fp = str(arrow_fp)
+        self.cache_dir = cache_dir
+        self._columns = None
+        self._digest = None
+
+    @property
+    def digest(self) -> str:
+        """The SHA-256 hex digest of the counttable file, computed once."""
+        if self._digest is None:
+            self._digest = get_file_digest(self.fp)
+        return self._digest
+
+    @property
+    def columns(self) -> list:
+        if self._columns is None:
+            if self.arrow_fp is not None:
+                with get_pyarrow().ipc.open_file(self.arrow_fp) as reader:
+                    self._columns = reader.schema.names
+            else:
+                header_df = pandas.read_csv(
+                    self.fp, sep='\t', header=0, nrows=0)
+                self._columns = header_df.columns.tolist()
+        # endif the columns haven't been read yet
+        return self._columns
+
+    @property
+    def sample_columns(self) -> list:
+        return [x for x in self.columns if x not in TAXA_KEYS]
+
+    def iter_chunks(self, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                    usecols: list = None):
+        """Yield the counttable as DataFrames of at most chunk_size rows.
+
+        If usecols is given, only the taxa columns and the sample columns in
+        usecols are read; the other columns are skipped by the parser, or
+        never touched in the memory-mapped Arrow cache. The counts keep the
+        dtype they are read in, since the chunks are only a step on the way
+        to a sparse table; compact_count_columns shrinks them if they are
+        to be kept.
+        """
+        sample_columns = self.sample_columns
+        columns = None
+        if usecols is not None:
+            usecols = set(usecols)
+            sample_columns = [x for x in sample_columns if x in usecols]
+            columns = [x for x in self.columns if x in TAXA_KEYS] + \
+                sample_columns
+        # endif only some columns are used
+
+        if self.arrow_fp is None and self.cache_dir is not None and \
+                get_pyarrow() is not None:
+            self.arrow_fp = get_cached_arrow_fp(
+                self.fp, self.cache_dir, chunk_size, digest=self.digest)
+        if self.arrow_fp is not None:
+            yield from _iter_arrow_chunks(self.arrow_fp, chunk_size, columns)
+            return
+
+        with pandas.read_csv(
+                self.fp, sep='\t', header=0, chunksize=chunk_size,
+                usecols=columns, dtype=TAXA_DTYPES) as chunks:
+            yield from chunks
+        # endwith chunks
+
+
+class SurpiCountMatrix:
+    """A SURPI+ counttable as a memory-mapped count matrix and a taxa index.
+
+    The counts are held in an .npy file that is memory-mapped rather than
+    read, so slicing out some barcodes or taxa only touches those parts of
+    the file. The matrix is stored in column-major order, so the counts of
+    each barcode are contiguous on disk.
+
+    Parameters
+    ----------
+    counts : numpy.ndarray
+        The counts, with one row per taxon and one column per barcode.
+    taxa : pandas.DataFrame
+        The species, genus, family and tag of each row of counts.
+    sample_columns : list
+        The barcode (or sample id) of each column of counts.
+    """
+
+    def __init__(self, counts: numpy.ndarray, taxa: pandas.DataFrame,
+                 sample_columns: list):
+        if counts.shape != (len(taxa), len(sample_columns)):
+            raise ValueError(
+                f"Expected counts of shape {(len(taxa), len(sample_columns))}"
+                f", but got {counts.shape}")
+        self.counts = counts
+        self.taxa = taxa
+        self.sample_columns = list(sample_columns)
+        # keeps a temporary directory holding the counts alive as long as
+        # the matrix is
+        self._temp_dir = None
+
+    @classmethod
+    def load(cls, matrix_dir: str):
+        """Memory-map a count matrix written by write_count_matrix."""
+        counts = numpy.load(
+            os.path.join(matrix_dir, COUNTS_FNAME), mmap_mode="r")
+        taxa = pandas.read_csv(
+            os.path.join(matrix_dir, TAXA_FNAME), sep='\t', header=0,
+            dtype=TAXA_DTYPES)
+        with open(os.path.join(matrix_dir, SAMPLES_FNAME)) as f:
+            sample_columns = f.read().splitlines()
+        return cls(counts, taxa, sample_columns)
+
+    @property
+    def columns(self) -> list:
+        return TAXA_KEYS + self.sample_columns
+
+    def iter_chunks(self, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                    usecols: list = None):
+        """Yield the counttable as DataFrames of at most chunk_size rows.
+
+        If usecols is given, only the sample columns in usecols are sliced
+        out of the memory-mapped counts.
+        """
+        col_idxs = slice(None)
+        sample_columns = self.sample_columns
+        if usecols is not None:
+            usecols = set(usecols)
+            col_idxs = [i for i, x in enumerate(self.sample_columns)
+                        if x in usecols]
+            sample_columns = [self.sample_columns[i] for i in col_idxs]
+        # endif only some columns are used
+
+        for start in range(0, len(self.taxa), chunk_size):
+            curr_taxa = self.taxa.iloc[start:start + chunk_size]
+            curr_counts = pandas.DataFrame(
+                self.counts[start:start + chunk_size, col_idxs],
+                columns=sample_columns, index=curr_taxa.index)
+            yield pandas.concat([curr_taxa, curr_counts], axis=1)
+        # endfor each chunk of rows
+
+
+def get_sample_columns(surpi_output) -> list:
+    """Return the sample column names of a counttable view."""
+    if isinstance(surpi_output, (SurpiCountTableReader, SurpiCountMatrix)):
+        return surpi_output.sample_columns
+    return [x for x in surpi_output.columns if x not in TAXA_KEYS]
+
+
+def iter_counttable_chunks(surpi_output, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                           usecols: list = None):
+    """Yield row chunks of a counttable view or an in-memory DataFrame.
+
+    If usecols is given, each chunk holds only the taxa columns and the
+    sample columns in usecols.
+    """
+    if isinstance(surpi_output, (SurpiCountTableReader, SurpiCountMatrix)):
+        yield from surpi_output.iter_chunks(chunk_size, usecols)
+        return
+
+    if usecols is not None:
+        usecols = set(usecols)
+        surpi_output = surpi_output[
+            [x for x in surpi_output.columns
+             if x in TAXA_KEYS or x in usecols]]
+    for start in range(0, len(surpi_output), chunk_size):
+        yield surpi_output.iloc[start:start + chunk_size]
+
+
+def get_compact_count_dtype(max_count: int) -> numpy.dtype:
+    """Return the smallest unsigned integer dtype that can hold max_count."""
+    for curr_dtype in COMPACT_COUNT_DTYPES:
+        if max_count <= numpy.iinfo(curr_dtype).max:
+            return numpy.dtype(curr_dtype)
+    # endfor each candidate dtype
+
+    raise ValueError(
+        f"Expected counts of at most {numpy.iinfo(numpy.uint64).max}, but "
+        f"got {max_count}")
+
+
+def compact_count_columns(counttable_df: pandas.DataFrame,
+                          sample_columns: list = None) -> pandas.DataFrame:
+    """Hold a counttable's counts in the smallest safe unsigned dtype.
+
+    One dtype is chosen for all the count columns, from the range of their
+    values, so that they stay in a single block of memory; converting the
+    columns one by one is many times slower for wide counttables. Counts
+    that are not all non-negative integers are left as they are.
+
+    Parameters
+    ----------
+    counttable_df : pandas.DataFrame
+        A counttable, or a chunk of the rows of one.
+    sample_columns : list, optional
+        The count columns of the counttable. Default is every column that is
+        not a taxa column.
+
+    Returns
+    -------
+    compact_df : pandas.DataFrame
+        The counttable with its counts in the chosen dtype, or the input
+        counttable itself if its counts are already in that dtype or can't
+        be held in an unsigned dtype.
+    """
+
+    if sample_columns is None:
+        sample_columns = get_sample_columns(counttable_df)
+    counts = counttable_df[sample_columns].to_numpy()
+    if counts.size == 0 or counts.dtype.kind not in "iu" or counts.min() < 0:
+        return counttable_df
+
+    compact_dtype = get_compact_count_dtype(counts.max())
+    if compact_dtype == counts.dtype:
+        return counttable_df
+
+    sample_columns_set = set(sample_columns)
+    other_columns = [
+        x for x in counttable_df.columns if x not in sample_columns_set]
+    result = pandas.concat(
+        [counttable_df[other_columns],
+         pandas.DataFrame(counts.astype(compact_dtype),
+                          columns=sample_columns, index=counttable_df.index)],
+        axis=1)
+    if result.columns.tolist() != counttable_df.columns.tolist():
+        result = result[counttable_df.columns]
+    return result
+
+
+def read_compact_counttable(fp: str, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                            compression: str = None) -> pandas.DataFrame:
+    """Read a counttable into a DataFrame with compactly held counts.
+
+    The counttable is read a chunk of rows at a time, and each chunk's counts
+    are range-checked and cast by compact_count_columns before the next chunk
+    is read, so the whole counttable is never held with int64 counts. Each
+    count column ends up in the largest dtype chosen for any of its chunks.
+    Only this DataFrame view is compacted: extraction reads the counttable
+    through SurpiCountTableReader, whose chunks keep the dtype they are read
+    in.
+
+    Parameters
+    ----------
+    fp : str
+        The path of the counttable.
+    chunk_size : int, optional
+        The number of rows read at a time. Default is DEFAULT_CHUNK_SIZE.
+    compression : str, optional
+        The compression of the counttable, as accepted by pandas.read_csv.
+        Default is None, for an uncompressed counttable.
+
+    Returns
+    -------
+    counttable_df : pandas.DataFrame
+        The counttable, with its counts in the smallest safe unsigned dtypes.
+    """
+
+    with pandas.read_csv(fp, sep='\t', header=0, chunksize=chunk_size,
+                         compression=compression) as chunks:
+        compact_chunks = [compact_count_columns(x) for x in chunks]
+    # endwith chunks
+
+    if len(compact_chunks) == 1:
+        return compact_chunks[0]
+    return pandas.concat(compact_chunks)
+
+
+def write_arrow_cache(counttable_fp: str, arrow_fp: str,
+                      chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """Parse a SURPI+ counttable once and write it as an Arrow IPC file.
+
+    The text is parsed in chunks of rows, so memory use depends on the chunk
+    size. The file is written under a temporary name and then renamed, so a
+    partly written cache is never picked up.
+
+    Parameters
+    ----------
+    counttable_fp : str
+        The path to the tab-delimited SURPI+ counttable.
+    arrow_fp : str
+        The path of the Arrow IPC file to write.
+    chunk_size : int, optional
+        Number of counttable rows parsed and written at a time.
+    """
+
+    pyarrow = get_pyarrow()
+    if pyarrow is None:
+        raise ImportError("pyarrow is required to write an Arrow cache")
+
+    reader = SurpiCountTableReader(counttable_fp)
+    # taxa are stored as plain strings, since each chunk's categories differ;
+    # counts are stored as uint32, which holds any realistic read count in
+    # half the space of int64, and the conversion fails rather than wrapping
+    schema = pyarrow.schema(
+        [(x, pyarrow.string()) for x in TAXA_KEYS] +
+        [(x, pyarrow.uint32()) for x in reader.sample_columns])
+
+    temp_fd, temp_fp = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(arrow_fp)), suffix=TEMP_SUFFIX)
+    os.close(temp_fd)
+    try:
+        with pyarrow.ipc.new_file(temp_fp, schema) as writer:
+            for curr_chunk in reader.iter_chunks(chunk_size):
+                curr_chunk = curr_chunk.astype(
+                    {x: object for x in TAXA_KEYS})
+                writer.write_table(pyarrow.Table.from_pandas(
+                    curr_chunk[schema.names], schema=schema,
+                    preserve_index=False))
+            # endfor each chunk
+        # endwith writer
+        os.replace(temp_fp, arrow_fp)
+    finally:
+        if os.path.exists(temp_fp):
+            os.remove(temp_fp)
+    # endtry
+
+
+def get_cached_arrow_fp(counttable_fp: str, cache_dir: str,
+                        chunk_size: int = DEFAULT_CHUNK_SIZE,
+                        digest: str = None) -> str:
+    """Return the path to the Arrow cache of a counttable, creating it if new.
+
+    The cache is keyed by the SHA-256 digest of the counttable's contents, so
+    identical counttables share a cache no matter where they are stored. If
+    the digest is already known, it can be given rather than recomputed.
+    """
+
+    if digest is None:
+        digest = get_file_digest(counttable_fp)
+    arrow_fp = os.path.join(cache_dir, digest + ARROW_CACHE_EXT)
+    if os.path.exists(arrow_fp):
+        touch_cache_entry(arrow_fp)
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_arrow_cache(counttable_fp, arrow_fp, chunk_size)
+        evict_cache(cache_dir, keep_fps=[arrow_fp], kind=COUNTTABLE_ENTRIES)
+    # endif the arrow cache exists
+
+    return arrow_fp
+
+
+def write_count_matrix(surpi_output: SurpiCountTableReader, matrix_dir: str,
+                       chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """Write a counttable as an .npy count matrix plus a taxa index.
+
+    The counttable is read in chunks of rows, each of which is copied into a
+    memory-mapped .npy file, so memory use depends on the chunk size rather
+    than on the size of the counttable.
+
+    Parameters
+    ----------
+    surpi_output : SurpiCountTableReader
+        A reader for the counttable to write.
+    matrix_dir : str
+        The directory in which to write the count matrix; it is created if
+        it doesn't exist.
+    chunk_size : int, optional
+        Number of counttable rows read and written at a time.
+
+    Raises
+    ------
+    ValueError
+        If any count does not fit in the count matrix's unsigned 32-bit
+        integers.
+    """
+
+    os.makedirs(matrix_dir, exist_ok=True)
+    sample_columns = surpi_output.sample_columns
+    num_rows = _count_rows(surpi_output)
+    counts = numpy.lib.format.open_memmap(
+        os.path.join(matrix_dir, COUNTS_FNAME), mode="w+", dtype=COUNT_DTYPE,
+        shape=(num_rows, len(sample_columns)), fortran_order=True)
+    max_count = numpy.iinfo(COUNT_DTYPE).max
+
+    start = 0
+    taxa_fp = os.path.join(matrix_dir, TAXA_FNAME)
+    for curr_chunk in surpi_output.iter_chunks(chunk_size):
+        curr_counts = curr_chunk[sample_columns].to_numpy()
+        if len(curr_counts) > 0 and (curr_counts.min() < 0 or
+                                     curr_counts.max() > max_count):
+            raise ValueError(
+                f"Expected counts from 0 to {max_count} in rows {start} to "
+                f"{start + len(curr_counts) - 1}, but got counts outside "
+                f"that range")
+        counts[start:start + len(curr_counts)] = curr_counts
+        curr_chunk[TAXA_KEYS].to_csv(
+            taxa_fp, sep='\t', index=False, header=(start == 0),
+            mode="w" if start == 0 else "a")
+        start += len(curr_counts)
+    # endfor each chunk
+
+    if start == 0:
+        pandas.DataFrame(columns=TAXA_KEYS).to_csv(
+            taxa_fp, sep='\t', index=False)
+    counts.flush()
+    del counts
+
+    with open(os.path.join(matrix_dir, SAMPLES_FNAME), "w") as f:
+        f.write("".join(f"{x}\n" for x in sample_columns))
+
+
+def get_count_matrix(surpi_output: SurpiCountTableReader,
+                     cache_dir: str = None,
+                     chunk_size: int = DEFAULT_CHUNK_SIZE) -> SurpiCountMatrix:
+    """Return a memory-mapped count matrix of a counttable.
+
+    If a cache directory is given, the matrix is kept there, keyed by the
+    SHA-256 digest of the counttable's contents, and reused by later calls;
+    otherwise it is written to a temporary directory that is removed when
+    the returned matrix is garbage-collected.
+    """
+
+    if cache_dir is None:
+        temp_dir = tempfile.TemporaryDirectory(prefix="q2-surpi-matrix-")
+        write_count_matrix(surpi_output, temp_dir.name, chunk_size)
+        result = SurpiCountMatrix.load(temp_dir.name)
+        result._temp_dir = temp_dir
+        return result
+
+    matrix_dir = os.path.join(
+        cache_dir, surpi_output.digest + MATRIX_CACHE_EXT)
+    if os.path.exists(matrix_dir):
+        touch_cache_entry(matrix_dir)
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(dir=cache_dir, suffix=TEMP_SUFFIX)
+        try:
+            write_count_matrix(surpi_output, temp_dir, chunk_size)
+            os.replace(temp_dir, matrix_dir)
+        finally:
+            if os.path.exists(temp_dir):
+                shutil.rmtree(temp_dir)
+        # endtry
+        evict_cache(cache_dir, keep_fps=[matrix_dir],
+                    kind=COUNTTABLE_ENTRIES)
+    # endif the matrix is cached
+
+    return SurpiCountMatrix.load(matrix_dir)
+
+
+def _count_rows(surpi_output):
+    # Count the data rows of a counttable without parsing it; blank lines are
+    # skipped, as pandas does when reading the table
+    if surpi_output.arrow_fp is not None:
+        pyarrow = get_pyarrow()
+        with pyarrow.memory_map(surpi_output.arrow_fp, "r") as source:
+            return pyarrow.ipc.open_file(source).read_all().num_rows
+
+    num_rows = 0
+    with open(surpi_output.fp, "rb") as f:
+        f.readline()
+        for line in f:
+            if line.strip():
+                num_rows += 1
+    # endwith open(surpi_output.fp, "rb") as f
+    return num_rows
+
+
+def _iter_arrow_chunks(arrow_fp, chunk_size, columns=None):
+    # The file is memory-mapped, so record batches refer to the mapped pages
+    # rather than being read into memory; only the DataFrame made from each
+    # chunk, of only the given columns if any, is materialized.
+    pyarrow = get_pyarrow()
+    categories = [x for x, y in TAXA_DTYPES.items() if y == "category"]
+    with pyarrow.memory_map(arrow_fp, "r") as source:
+        arrow_table = pyarrow.ipc.open_file(source).read_all()
+        if columns is not None:
+            arrow_table = arrow_table.select(columns)
+        for curr_batch in arrow_table.to_batches(max_chunksize=chunk_size):
+            yield pyarrow.Table.from_batches([curr_batch]).to_pandas(
+                categories=categories)
+    # endwith source
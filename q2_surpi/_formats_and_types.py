@@ -1,7 +1,10 @@
+import concurrent.futures
 import io
+import os
 import pandas
 from qiime2.plugin import SemanticType, ValidationError
 import qiime2.plugin.model as model
+from q2_surpi._compression import get_compression, open_decompressed
 
 FEATURE_ID_KEY = 'feature-id'
 SPECIES_KEY = "species"
@@ -13,6 +16,24 @@ SS_SAMPLE_ID_KEY = "Sample_ID"
 INDEX_1_KEY = "index"
 INDEX_2_KEY = "index2"
 BARCODE_KEY = 'barcode'
+# the ranks to which counts can be rolled up, from the lowest; at each level,
+# the feature ids and taxa are built from that rank and the ranks above it
+SPECIES_LEVEL = 'species'
+GENUS_LEVEL = 'genus'
+FAMILY_LEVEL = 'family'
+COLLAPSE_LEVELS = {
+    SPECIES_LEVEL: [SPECIES_KEY, GENUS_KEY, FAMILY_KEY],
+    GENUS_LEVEL: [GENUS_KEY, FAMILY_KEY],
+    FAMILY_LEVEL: [FAMILY_KEY]}
+# 'max' validation of a counttable at least this large is split into
+# newline-aligned byte ranges of about VALIDATION_SHARD_BYTES each, which are
+# checked in parallel
+PARALLEL_VALIDATION_MIN_BYTES = 256 * 2 ** 20
+VALIDATION_SHARD_BYTES = 32 * 2 ** 20
+# number of processes used for parallel validation; defaults to the number of
+# CPUs (as does 'auto'), and 1 turns parallel validation off
+VALIDATION_JOBS_ENV_VAR = "Q2_SURPI_VALIDATION_JOBS"
+VALIDATION_JOBS_AUTO = "auto"
 
 
 # Types
@@ -27,65 +48,248 @@ class SurpiCountTableFormat(model.TextFileFormat):
     def _validate_(self, level):
         # Validate that the file is a tsv and that it has the expected columns
         # for those that are fixed. Note that we don't validate the values in
-        # the columns, as we don't know what they should be.
-        with self.path.open("r") as f:
-            df = pandas.read_csv(f, header=0, sep='\t')
+        # the taxa columns, as we don't know what they should be. 'min'
+        # validation reads only the header and the first data row, while
+        # 'max' validation streams every row; neither builds a DataFrame.
+        # Large counttables are streamed by several processes at once.
+        # The number of processes is only read for those, so that a bad
+        # VALIDATION_JOBS_ENV_VAR setting doesn't break other validation.
+        fp = str(self.path)
+        n_jobs = 1
+        if level == 'max' and \
+                os.path.getsize(fp) >= PARALLEL_VALIDATION_MIN_BYTES:
+            n_jobs = _get_validation_jobs()
+        # endif
 
-        if (len(df.columns) < 5) or (df.columns[0] != SPECIES_KEY) or \
-                (df.columns[1] != GENUS_KEY) or (df.columns[2] != FAMILY_KEY) \
-                or (df.columns[3] != TAG_KEY):
+        if n_jobs > 1:
+            num_rows = _validate_counttable_sharded(fp, n_jobs)
+        else:
+            with open(fp, "r") as f:
+                num_rows = _validate_counttable_lines(f, level)
+
+        if num_rows == 0:
+            raise ValidationError("Expected at least one row, but got none")
+
+
+class SurpiCountTableCompressedFormat(model.BinaryFileFormat):
+    """Represents a gzip, bzip2 or zstandard compressed SURPI+ counttable."""
+
+    def _validate_(self, level):
+        # The counttable is validated as it is decompressed, exactly as an
+        # uncompressed one is, except that a compressed stream can't be split
+        # into byte ranges, so 'max' validation is never sharded.
+        if get_compression(str(self.path)) is None:
             raise ValidationError(
-                f"Expected columns for {SPECIES_KEY}, {GENUS_KEY}, "
-                f"{FAMILY_KEY}, {TAG_KEY}, and at least one sample, but got "
-                f"{df.columns}")
+                "Expected a gzip, bzip2 or zstandard compressed file")
 
-        if len(df) == 0:
+        with open_decompressed(str(self.path), "r") as f:
+            num_rows = _validate_counttable_lines(f, level)
+        if num_rows == 0:
             raise ValidationError("Expected at least one row, but got none")
 
 
+def _get_validation_jobs():
+    env_value = os.environ.get(VALIDATION_JOBS_ENV_VAR, "").strip()
+    if env_value == "" or env_value.lower() == VALIDATION_JOBS_AUTO:
+        return os.cpu_count() or 1
+
+    try:
+        n_jobs = int(env_value)
+    except ValueError:
+        n_jobs = 0
+    if n_jobs < 1:
+        raise ValueError(
+            f"Expected {VALIDATION_JOBS_ENV_VAR} to be a positive integer or "
+            f"'{VALIDATION_JOBS_AUTO}', but got '{env_value}'")
+    return n_jobs
+
+
+def _validate_counttable_lines(f, level):
+    # Validate the counttable read from the text file f, one line at a time,
+    # and return its number of data rows
+    header = f.readline().rstrip("\r\n").split("\t")
+    _validate_counttable_header(header)
+
+    num_rows = 0
+    for line_num, line in enumerate(f, start=2):
+        # skip blank lines, as pandas does when reading the table
+        if line.strip() == "":
+            continue
+
+        _validate_counttable_row(
+            line.rstrip("\r\n").split("\t"), len(header), line_num)
+        num_rows += 1
+        if level == 'min':
+            break
+    # endfor line_num, line in enumerate(f, start=2)
+
+    return num_rows
+
+
+def _validate_counttable_sharded(fp, n_jobs):
+    # Split the rows into newline-aligned byte ranges and check each range in
+    # a worker process. Every worker also counts the lines in its range, so
+    # the line number at which each range starts is known exactly, and the
+    # first bad line of the first range that has one is the first bad line of
+    # the file.
+    with open(fp, "rb") as f:
+        header = f.readline().decode("utf-8").rstrip("\r\n").split("\t")
+        _validate_counttable_header(header)
+
+        file_size = os.fstat(f.fileno()).st_size
+        shard_starts = [f.tell()]
+        while shard_starts[-1] + VALIDATION_SHARD_BYTES < file_size:
+            # move to the start of the first line after the nominal boundary
+            f.seek(shard_starts[-1] + VALIDATION_SHARD_BYTES - 1)
+            f.readline()
+            if f.tell() >= file_size:
+                break
+            shard_starts.append(f.tell())
+        # endwhile the last shard is too large
+    # endwith open(fp, "rb") as f
+    shard_ends = shard_starts[1:] + [file_size]
+
+    num_rows = 0
+    first_line_num = 2
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(n_jobs, len(shard_starts))) as executor:
+        futures = [
+            executor.submit(_validate_counttable_shard, fp, curr_start,
+                            curr_end, len(header))
+            for curr_start, curr_end in zip(shard_starts, shard_ends)]
+        try:
+            for curr_future in futures:
+                num_lines, shard_rows, bad_line = curr_future.result()
+                if bad_line is not None:
+                    # check the bad line again with its line number in the
+                    # file, which raises the error for it
+                    bad_idx, bad_line_str = bad_line
+                    _validate_counttable_row(
+                        bad_line_str.rstrip("\r\n").split("\t"),
+                        len(header), first_line_num + bad_idx)
+                num_rows += shard_rows
+                first_line_num += num_lines
+            # endfor each shard, in file order
+        finally:
+            # once a bad line is found, shards that haven't started are moot
+            for curr_future in futures:
+                curr_future.cancel()
+        # endtry
+    # endwith executor
+
+    return num_rows
+
+
+def _validate_counttable_shard(fp, start, end, num_cols):
+    # Return the number of lines and of data rows in the byte range, plus the
+    # index in the range and text of its first bad line, or None if there is
+    # no bad line
+    with open(fp, "rb") as f:
+        f.seek(start)
+        shard_str = f.read(end - start).decode("utf-8")
+
+    num_rows = 0
+    for line_idx, line in enumerate(shard_str.split("\n")):
+        # skip blank lines, as pandas does when reading the table
+        if line.strip() == "":
+            continue
+
+        try:
+            _validate_counttable_row(
+                line.rstrip("\r").split("\t"), num_cols, line_idx)
+        except ValidationError:
+            return None, num_rows, (line_idx, line)
+        num_rows += 1
+    # endfor line_idx, line
+
+    return shard_str.count("\n"), num_rows, None
+
+
+def _validate_counttable_header(header):
+    if (len(header) < 5) or (header[0] != SPECIES_KEY) or \
+            (header[1] != GENUS_KEY) or (header[2] != FAMILY_KEY) \
+            or (header[3] != TAG_KEY):
+        raise ValidationError(
+            f"Expected columns for {SPECIES_KEY}, {GENUS_KEY}, "
+            f"{FAMILY_KEY}, {TAG_KEY}, and at least one sample, but got "
+            f"{header}")
+
+
+def _validate_counttable_row(fields, num_cols, line_num):
+    if len(fields) != num_cols:
+        raise ValidationError(
+            f"Expected {num_cols} fields on line {line_num}, but got "
+            f"{len(fields)}")
+
+    for curr_field in fields[4:]:
+        if not curr_field.isdigit() and not _is_integer_str(curr_field):
+            raise ValidationError(
+                f"Expected integer counts on line {line_num}, but got "
+                f"'{curr_field}'")
+    # endfor curr_field in fields[4:]
+
+
+def _is_integer_str(a_str):
+    try:
+        return float(a_str).is_integer()
+    except ValueError:
+        return False
+
+
 class SurpiSampleSheetFormat(model.TextFileFormat):
     """Represents a csv-delimited sample sheet file used by SURPI+."""
 
     def _validate_(self, level):
-        _ = surpi_sample_sheet_fp_to_df(self.path)
+        _ = self.to_dataframe()
+
+    def to_dataframe(self) -> pandas.DataFrame:
+        # The [Data] section is parsed only once per format instance, so
+        # validation and transformation of the same instance share it.
+        if getattr(self, "_data_df", None) is None:
+            self._data_df = surpi_sample_sheet_fp_to_df(str(self.path))
+        return self._data_df
+
+
+class SurpiSampleSheetCompressedFormat(model.BinaryFileFormat):
+    """Represents a gzip, bzip2 or zstandard compressed SURPI+ sample sheet."""
+
+    def _validate_(self, level):
+        if get_compression(str(self.path)) is None:
+            raise ValidationError(
+                "Expected a gzip, bzip2 or zstandard compressed file")
+        _ = self.to_dataframe()
+
+    def to_dataframe(self) -> pandas.DataFrame:
+        # Sample sheets are small, so the decompressed sheet is held in
+        # memory, where its [Data] section can be found and parsed as in an
+        # uncompressed sheet.
+        if getattr(self, "_data_df", None) is None:
+            with open_decompressed(str(self.path)) as f:
+                self._data_df = _surpi_sample_sheet_file_to_df(
+                    io.BytesIO(f.read()))
+        return self._data_df
 
 
 def surpi_sample_sheet_fp_to_df(fp: str) -> pandas.DataFrame:
-    # open the file and count each line until we find one that starts with
-    # [Data]
+    with open(fp, "rb") as f:
+        return _surpi_sample_sheet_file_to_df(f)
 
-    data_table_lines = []
-    is_data = False
-    with open(fp, "r") as f:
-        for line in f:
-            if line.startswith("[Data]"):
-                is_data = True
-                continue
-            # endif line.startswith("[Data]")
-
-            if is_data:
-                if line.startswith("["):
-                    # if we've reached the beginning of the next section, stop
-                    break
-
-                if not line.startswith(','):
-                    # add non-empty lines to the data table
-                    data_table_lines.append(line)
-            # endif is_data and not line.startswith(',')
-        # endfor line in f
-    # endwith self.path.open("r") as f
-
-    if len(data_table_lines) == 0:
+
+def _surpi_sample_sheet_file_to_df(f):
+    # Parse the sample sheet in the seekable binary file f
+    header_offset, skip_rows, num_rows = _index_data_section(f)
+    if header_offset is None:
         raise ValidationError(
             "Expected section starting with '[Data]', but didn't find one")
 
-    # create a streamio object from the list of lines
-    data_table_stream = io.StringIO("\n".join(data_table_lines))
-
-    # Validate that the file is a tsv and that it has the expected columns
+    # Parse the [Data] section in place, starting from its header line and
+    # skipping the blank lines inside it, rather than copying it out.
+    # Validate that the file is a csv and that it has the expected columns
     # for those that are fixed. Note that we don't validate the values in
     # the columns, as we don't know what they should be.
-    df = pandas.read_csv(data_table_stream, header=0, sep=',')
+    f.seek(header_offset)
+    df = pandas.read_csv(
+        f, header=0, sep=',', skiprows=skip_rows, nrows=num_rows)
 
     if ((SAMPLE_NAME_KEY not in df.columns) or
             (INDEX_1_KEY not in df.columns) or
@@ -101,10 +305,53 @@ def surpi_sample_sheet_fp_to_df(fp: str) -> pandas.DataFrame:
     return df
 
 
+def _index_data_section(f):
+    # Make one pass over the lines of the binary file f to find the byte
+    # offset of the [Data] section's header line, the line indices (relative
+    # to that header line) of the empty lines within the section, and the
+    # number of data rows in it. The section ends at the next line starting
+    # with "[" or at the end of the file. Empty lines are those that are
+    # blank or start with a comma.
+    header_offset = None
+    skip_rows = []
+    num_rows = 0
+    rel_line_idx = 0
+    is_data = False
+    offset = 0
+    for line in f:
+        curr_offset = offset
+        offset += len(line)
+
+        if not is_data:
+            is_data = line.startswith(b"[Data]")
+            continue
+
+        # if we've reached the beginning of the next section, stop
+        if line.startswith(b"["):
+            break
+
+        is_empty = line.startswith(b",") or line.strip() == b""
+        if header_offset is None:
+            if not is_empty:
+                header_offset = curr_offset
+            continue
+        # endif header_offset is None
+
+        rel_line_idx += 1
+        if is_empty:
+            skip_rows.append(rel_line_idx)
+        else:
+            num_rows += 1
+    # endfor line in f
+
+    return header_offset, skip_rows, num_rows
+
+
 SurpiCountTableDirectoryFormat = model.SingleFileDirectoryFormat(
     'SurpiCountTableDirectoryFormat', 'surpi_output.counttable',
     SurpiCountTableFormat)
 
+
 SurpiSampleSheetDirectoryFormat = model.SingleFileDirectoryFormat(
     'SurpiSampleSheetDirectoryFormat', 'surpi_sample_info.txt',
     SurpiSampleSheetFormat)
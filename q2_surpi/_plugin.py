@@ -1,90 +1,1101 @@
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import tracemalloc
+import biom
+import numpy
 import pandas
-from q2_surpi._formats_and_types import FEATURE_ID_KEY, FAMILY_KEY, \
-    GENUS_KEY, SPECIES_KEY, BARCODE_KEY, TAG_KEY, SAMPLE_NAME_KEY, \
-    SS_SAMPLE_ID_KEY
+import qiime2
+import scipy.sparse
+from q2_surpi._formats_and_types import FAMILY_KEY, GENUS_KEY, \
+    SPECIES_KEY, TAG_KEY, BARCODE_KEY, SAMPLE_NAME_KEY, SS_SAMPLE_ID_KEY, \
+    SPECIES_LEVEL, COLLAPSE_LEVELS
+from q2_surpi._counttable import SurpiCountTableReader, DEFAULT_CHUNK_SIZE, \
+    COMPACT_COUNT_DTYPES, get_compact_count_dtype, get_sample_columns, \
+    iter_counttable_chunks
+from q2_surpi._cache import get_cache_dir, get_result_key, \
+    get_result_dir, store_result_files, touch_cache_entry
+
+try:
+    import resource
+except ImportError:  # resource is not available on windows
+    resource = None
 
 SAMPLE_ID_KEY = 'sample-id'
 TAXON_KEY = 'Taxon'
 FEATURE_KEY = 'Feature ID'
+# when duplicate feature ids are collapsed, the taxonomy lists every tag of
+# each feature in this column, separated by TAG_SEPARATOR
+TAGS_KEY = 'Tags'
+TAG_SEPARATOR = ' '
+# the feature id, and taxon, of the rows that have no name at any rank of a
+# genus or family level
+UNASSIGNED_FEATURE_ID = 'Unassigned'
+RESULT_COUNTS_FNAME = "counts.npz"
+RESULT_IDS_FNAME = "ids.json"
+
+_logger = logging.getLogger(__name__)
 
 
 # NB: Because there is a transformer on the plugin that can turn a
 # SurpiCountTable (which is what the plugin gets as its first
-# argument) into a pandas.DataFrame, and another that can turn a
+# argument) into a SurpiCountTableReader, and another that can turn a
 # SurpiSampleSheet (which is what the plugin gets as its second argument)
 # into a pandas.DataFrame, those transformations will be done
-# automagically and this will receive pandas.DataFrames as its arguments.
+# automagically and this will receive those views as its arguments.
+# Called directly, it also accepts the counttable as a SurpiCountMatrix or a
+# pandas.DataFrame.
 def extract(
-        surpi_output: pandas.DataFrame,
+        surpi_output: SurpiCountTableReader,
         surpi_sample_info: pandas.DataFrame,
-        ids_are_barcodes: bool = True) -> \
-        (pandas.DataFrame, pandas.DataFrame):
+        ids_are_barcodes: bool = True,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        collapse_duplicates: bool = False,
+        collapse_level: str = SPECIES_LEVEL,
+        include_tags: list = None,
+        exclude_tags: list = None,
+        min_total_count: int = 0,
+        min_prevalence: int = 0,
+        min_sample_depth: int = 0,
+        sample_names: list = None,
+        sample_metadata: qiime2.Metadata = None,
+        where: str = None,
+        profile_memory: bool = False) -> \
+        (biom.Table, pandas.DataFrame):
 
-    """Turn SURPI data into a feature table dataframe and a taxonomy dataframe.
+    """Turn SURPI data into a sparse feature table and a taxonomy dataframe.
 
     Parameters
     ----------
-    surpi_counts_df : pandas.DataFrame
-        A DataFrame containing the content of a SURPI counttable [sic] file.
+    surpi_counts_df : SurpiCountTableReader, SurpiCountMatrix or
+            pandas.DataFrame
+        A lazy reader for, a memory-mapped matrix of, or a DataFrame
+        containing the content of, a SURPI counttable [sic] file.
     surpi_sample_info_df : pandas.DataFrame
         A DataFrame containing the content of a SURPI sample sheet file.
     ids_are_barcodes : bool, optional
         True if the sample ids are barcodes. False if the sample ids are
         sample sheet sample ids. Default is True.
+    chunk_size : int, optional
+        The number of counttable rows read and converted at a time. Peak
+        memory use depends on this rather than on the size of the counttable.
+        Default is DEFAULT_CHUNK_SIZE.
+    collapse_duplicates : bool, optional
+        True to sum the counts of counttable rows that have the same feature
+        id, as rows with the same species, genus and family but different
+        tags do, and to list every tag of each feature in the taxonomy's
+        TAGS_KEY column. False to raise an error for such rows. Default is
+        False.
+    collapse_level : str, optional
+        The rank to which counts are rolled up: SPECIES_LEVEL for one feature
+        per species, genus and family, GENUS_LEVEL for one per genus and
+        family or FAMILY_LEVEL for one per family. Counts are summed while
+        they are extracted, so the species-level table is never made.
+        Default is SPECIES_LEVEL.
+    include_tags : list of str, optional
+        Regular expressions, of which a row's tag must match at least one
+        for the row to be extracted. Default is None, which keeps rows with
+        any tag.
+    exclude_tags : list of str, optional
+        Regular expressions, of which a row's tag must match none for the
+        row to be extracted. Rows are filtered as each chunk is read, so the
+        excluded rows never reach the feature table. Default is None, which
+        excludes no rows.
+    min_total_count : int, optional
+        The smallest total count, across all samples, of a feature that is
+        kept. Default is 0, which keeps every feature.
+    min_prevalence : int, optional
+        The smallest number of samples with a nonzero count of a feature
+        that is kept. Default is 0, which keeps every feature.
+    min_sample_depth : int, optional
+        The smallest total count, across the features that are kept, of a
+        sample that is kept. Default is 0, which keeps every sample.
+    sample_names : list of str, optional
+        The sample sheet sample names of the only samples to extract. Their
+        barcodes (or sample ids) are looked up in the sample sheet before
+        any counts are read, and only those columns of the counttable are
+        read. Default is None, which extracts every sample.
+    sample_metadata : qiime2.Metadata, optional
+        Metadata whose ids are the sample names of the only samples to
+        extract, as for sample_names. If both are given, only the samples
+        in both are extracted. Default is None.
+    where : str, optional
+        A SQLite WHERE clause that selects the ids of sample_metadata to
+        use. Default is None, which uses every id.
+    profile_memory : bool, optional
+        True to record the peak RSS and the memory allocated by each stage of
+        the extraction and print them, as JSON, to stdout. Default is
+        False.
 
     Returns
     -------
-    surpi_feature_table_df : pandas.DataFrame
-        A DataFrame containing the SURPI counts linked to sample ids and the
-        original surpi taxon-based feature ids.
+    surpi_feature_table : biom.Table
+        A sparse table containing the SURPI counts for each of the original
+        surpi taxon-based feature ids (observations) in each sample id
+        (samples).
     surpi_taxonomy_df : pandas.DataFrame
         A DataFrame linking the original surpi taxon-based feature ids to
         the QIIME 2 taxonomy format.
+
+    Raises
+    ------
+    ValueError
+        If any of sample_names or of the selected ids of sample_metadata is
+        not a sample in both the sample sheet and the counttable, if where
+        is given without sample_metadata, if any of include_tags or
+        exclude_tags is not a valid regular
+        expression, if collapse_level is not a key of COLLAPSE_LEVELS, or if
+        collapse_level is SPECIES_LEVEL, collapse_duplicates is False and any
+        feature id appears on more than one row of the counttable.
+    """
+
+    # If a cache directory is set, results are memoized there, keyed by the
+    # digests of the inputs and the parameters that change the result
+    selected_names = _get_selected_sample_names(
+        sample_names, sample_metadata, where)
+    cache_dir = get_cache_dir()
+    cache_key = None
+    if cache_dir is not None:
+        cache_key = _get_extract_cache_key(
+            surpi_output, surpi_sample_info, ids_are_barcodes,
+            collapse_duplicates, collapse_level, include_tags, exclude_tags,
+            min_total_count, min_prevalence, min_sample_depth,
+            selected_names)
+    if cache_key is not None:
+        cached_result = _load_cached_result(cache_dir, cache_key)
+        if cached_result is not None:
+            return cached_result
+
+    with _MemoryProfile(profile_memory) as profile:
+        counts, feature_dict, sample_ids = _extract_counts(
+            surpi_output, surpi_sample_info, ids_are_barcodes, chunk_size,
+            collapse_duplicates, collapse_level, include_tags, exclude_tags,
+            selected_names, profile)
+        with profile.stage("filter_counts"):
+            counts, feature_dict, sample_ids = _filter_counts(
+                counts, feature_dict, sample_ids, min_total_count,
+                min_prevalence, min_sample_depth)
+        with profile.stage("build_outputs"):
+            result = _decode_outputs(counts, feature_dict, sample_ids)
+    # endwith profile
+
+    profile.report()
+    if cache_key is not None:
+        store_result_files(cache_dir, cache_key,
+                           lambda x: _write_result_files(x, *result))
+    return result
+
+
+def extract_batch(
+        surpi_outputs: SurpiCountTableReader,
+        surpi_sample_infos: pandas.DataFrame,
+        ids_are_barcodes: bool = True,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        n_jobs: int = 1,
+        collapse_duplicates: bool = False,
+        collapse_level: str = SPECIES_LEVEL,
+        include_tags: list = None,
+        exclude_tags: list = None,
+        min_total_count: int = 0,
+        min_prevalence: int = 0,
+        min_sample_depth: int = 0,
+        profile_memory: bool = False) -> \
+        (biom.Table, pandas.DataFrame):
+
+    """Turn many SURPI runs into one merged feature table and taxonomy.
+
+    Parameters
+    ----------
+    surpi_outputs : list of SurpiCountTableReader or pandas.DataFrame
+        The SURPI counttable [sic] of each run.
+    surpi_sample_infos : list of pandas.DataFrame
+        The SURPI sample sheet of each run, in the same order as
+        surpi_outputs.
+    ids_are_barcodes : bool, optional
+        True if the sample ids are barcodes. False if the sample ids are
+        sample sheet sample ids. Default is True.
+    chunk_size : int, optional
+        The number of counttable rows read and converted at a time.
+        Default is DEFAULT_CHUNK_SIZE.
+    n_jobs : int, optional
+        The number of worker processes that parse and convert counttables in
+        parallel, one run per worker; their sparse results are merged in the
+        calling process. Default is 1, which does all the work in the calling
+        process.
+    collapse_duplicates : bool, optional
+        True to sum the counts of rows of the same counttable that have the
+        same feature id and to list every tag of each feature in the
+        taxonomy's TAGS_KEY column, as extract does. Default is False.
+    collapse_level : str, optional
+        The rank to which counts are rolled up, as for extract. Default is
+        SPECIES_LEVEL.
+    include_tags : list of str, optional
+        Regular expressions, of which a row's tag must match at least one
+        for the row to be extracted, as for extract. Default is None.
+    exclude_tags : list of str, optional
+        Regular expressions, of which a row's tag must match none for the
+        row to be extracted, as for extract. Default is None.
+    min_total_count : int, optional
+        The smallest total count, across the samples of all runs, of a
+        feature that is kept. Default is 0.
+    min_prevalence : int, optional
+        The smallest number of samples, in all runs, with a nonzero count of
+        a feature that is kept. Default is 0.
+    min_sample_depth : int, optional
+        The smallest total count, across the features that are kept, of a
+        sample that is kept. Default is 0.
+    profile_memory : bool, optional
+        True to record the peak RSS and the memory allocated by each stage of
+        the extraction and print them, as JSON, to stdout. Worker
+        processes are not profiled. Default is False.
+
+    Returns
+    -------
+    surpi_feature_table : biom.Table
+        A sparse table containing the SURPI counts of every run, with one
+        observation per distinct surpi taxon-based feature id across all runs.
+    surpi_taxonomy_df : pandas.DataFrame
+        A DataFrame linking each distinct surpi taxon-based feature id to
+        the QIIME 2 taxonomy format.
     """
 
+    if len(surpi_outputs) == 0:
+        raise ValueError("Expected at least one counttable, but got none")
+
+    if len(surpi_outputs) != len(surpi_sample_infos):
+        raise ValueError(
+            f"Expected one sample sheet per counttable, but got "
+            f"{len(surpi_outputs)} counttables and {len(surpi_sample_infos)} "
+            f"sample sheets")
+
+    run_args = [
+        (curr_output, curr_sample_info, ids_are_barcodes, chunk_size,
+         collapse_duplicates, collapse_level, include_tags, exclude_tags)
+        for curr_output, curr_sample_info in
+        zip(surpi_outputs, surpi_sample_infos)]
+    with _MemoryProfile(profile_memory) as profile:
+        if n_jobs > 1 and len(run_args) > 1:
+            with profile.stage("extract_runs"):
+                with concurrent.futures.ProcessPoolExecutor(
+                        max_workers=min(n_jobs, len(run_args))) as executor:
+                    run_results = list(
+                        executor.map(_extract_counts, *zip(*run_args)))
+        else:
+            run_results = [
+                _extract_counts(*x, profile=profile) for x in run_args]
+        # endif n_jobs > 1
+
+        with profile.stage("merge_runs"):
+            counts, feature_dict, sample_ids = _merge_run_results(run_results)
+            del run_results
+        with profile.stage("filter_counts"):
+            counts, feature_dict, sample_ids = _filter_counts(
+                counts, feature_dict, sample_ids, min_total_count,
+                min_prevalence, min_sample_depth)
+        with profile.stage("build_outputs"):
+            result = _decode_outputs(counts, feature_dict, sample_ids)
+    # endwith profile
+
+    profile.report()
+    return result
+
+
+def extract_append(
+        existing_table: biom.Table,
+        existing_taxonomy: pandas.DataFrame,
+        surpi_output: SurpiCountTableReader,
+        surpi_sample_info: pandas.DataFrame,
+        ids_are_barcodes: bool = True,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        collapse_duplicates: bool = False,
+        collapse_level: str = SPECIES_LEVEL,
+        include_tags: list = None,
+        exclude_tags: list = None,
+        profile_memory: bool = False) -> \
+        (biom.Table, pandas.DataFrame):
+
+    """Add the samples of a new SURPI run to an existing table and taxonomy.
+
+    Parameters
+    ----------
+    existing_table : biom.Table
+        A feature table made by an earlier extraction.
+    existing_taxonomy : pandas.DataFrame
+        The taxonomy made by the same earlier extraction; it must include
+        every feature id in existing_table. If it has a TAGS_KEY column,
+        the existing tags are kept.
+    surpi_output : SurpiCountTableReader, SurpiCountMatrix or
+            pandas.DataFrame
+        The SURPI counttable [sic] of the new run.
+    surpi_sample_info : pandas.DataFrame
+        The SURPI sample sheet of the new run.
+    ids_are_barcodes : bool, optional
+        True if the sample ids are barcodes. False if the sample ids are
+        sample sheet sample ids. Default is True.
+    chunk_size : int, optional
+        The number of counttable rows read and converted at a time.
+        Default is DEFAULT_CHUNK_SIZE.
+    collapse_duplicates : bool, optional
+        True to sum the counts of rows of the new counttable that have the
+        same feature id and to list every tag of each feature in the
+        taxonomy's TAGS_KEY column, as extract does. Default is False.
+    collapse_level : str, optional
+        The rank to which counts are rolled up, as for extract. Default is
+        SPECIES_LEVEL.
+    include_tags : list of str, optional
+        Regular expressions, of which a row's tag must match at least one
+        for the row to be extracted, as for extract. Default is None.
+    exclude_tags : list of str, optional
+        Regular expressions, of which a row's tag must match none for the
+        row to be extracted, as for extract. Default is None.
+    profile_memory : bool, optional
+        True to record the peak RSS and the memory allocated by each stage of
+        the extraction and print them, as JSON, to stdout. Default is
+        False.
+
+    Returns
+    -------
+    surpi_feature_table : biom.Table
+        A sparse table containing the existing samples followed by the new
+        run's samples. Existing features keep their order, and features that
+        are new in this run follow them.
+    surpi_taxonomy_df : pandas.DataFrame
+        A DataFrame linking every existing and new surpi taxon-based feature
+        id to the QIIME 2 taxonomy format.
+
+    Raises
+    ------
+    ValueError
+        If the existing table has feature ids that are not in the existing
+        taxonomy, if any of the new run's samples are already in the
+        existing table, or if the existing taxonomy was extracted at another
+        collapse_level or with another collapse_duplicates setting.
+    """
+
+    _check_existing_taxonomy(
+        existing_taxonomy, collapse_duplicates, collapse_level)
+
+    # Only the new counttable is parsed; the existing table's sparse counts
+    # are reused as they are, with their features encoded first so that the
+    # new run is mapped onto the existing feature id space.
+    with _MemoryProfile(profile_memory) as profile:
+        with profile.stage("load_existing"):
+            existing_result = _encode_existing_outputs(
+                existing_table, existing_taxonomy)
+        new_result = _extract_counts(
+            surpi_output, surpi_sample_info, ids_are_barcodes, chunk_size,
+            collapse_duplicates, collapse_level, include_tags, exclude_tags,
+            profile=profile)
+        with profile.stage("merge_runs"):
+            counts, feature_dict, sample_ids = _merge_run_results(
+                [existing_result, new_result])
+            del existing_result, new_result
+        with profile.stage("build_outputs"):
+            result = _decode_outputs(counts, feature_dict, sample_ids)
+    # endwith profile
+
+    profile.report()
+    return result
+
+
+def _get_extract_cache_key(surpi_output, surpi_sample_info,
+                           ids_are_barcodes, collapse_duplicates,
+                           collapse_level, include_tags, exclude_tags,
+                           min_total_count, min_prevalence,
+                           min_sample_depth, sample_names):
+    # Only counttables read from files are cached, since their contents can
+    # be digested without parsing them; chunk_size and profile_memory don't
+    # change the result, so they aren't part of the key
+    if not isinstance(surpi_output, SurpiCountTableReader):
+        return None
+
+    sample_info_hasher = hashlib.sha256(
+        json.dumps([str(x) for x in surpi_sample_info.columns]).encode())
+    sample_info_hasher.update(pandas.util.hash_pandas_object(
+        surpi_sample_info, index=True).to_numpy().tobytes())
+    return get_result_key(
+        "extract",
+        [surpi_output.digest, sample_info_hasher.hexdigest()],
+        {"ids_are_barcodes": ids_are_barcodes,
+         "collapse_duplicates": collapse_duplicates,
+         "collapse_level": collapse_level,
+         "include_tags": include_tags,
+         "exclude_tags": exclude_tags,
+         "min_total_count": min_total_count,
+         "min_prevalence": min_prevalence,
+         "min_sample_depth": min_sample_depth,
+         "sample_names":
+             None if sample_names is None else sorted(sample_names)})
+
+
+def _write_result_files(result_dir, surpi_feature_table, surpi_taxonomy_df):
+    scipy.sparse.save_npz(
+        os.path.join(result_dir, RESULT_COUNTS_FNAME),
+        surpi_feature_table.matrix_data.tocsr())
+    ids = {
+        "observation_ids":
+            surpi_feature_table.ids(axis='observation').tolist(),
+        "sample_ids": surpi_feature_table.ids(axis='sample').tolist(),
+        "feature_ids": surpi_taxonomy_df.index.tolist(),
+        "taxa": surpi_taxonomy_df[TAXON_KEY].tolist()}
+    if TAGS_KEY in surpi_taxonomy_df.columns:
+        ids["tags"] = surpi_taxonomy_df[TAGS_KEY].tolist()
+    with open(os.path.join(result_dir, RESULT_IDS_FNAME), "w") as f:
+        json.dump(ids, f)
+
+
+def _load_cached_result(cache_dir, cache_key):
+    # Return the cached feature table and taxonomy, or None if they aren't
+    # cached, including if they are evicted while being read
+    result_dir = get_result_dir(cache_dir, cache_key)
+    try:
+        touch_cache_entry(result_dir)
+        counts = scipy.sparse.load_npz(
+            os.path.join(result_dir, RESULT_COUNTS_FNAME))
+        with open(os.path.join(result_dir, RESULT_IDS_FNAME)) as f:
+            ids = json.load(f)
+    except OSError:
+        return None
+    # endtry
+
+    surpi_feature_table = biom.Table(
+        counts, observation_ids=ids["observation_ids"],
+        sample_ids=ids["sample_ids"])
+    surpi_taxonomy_df = pandas.DataFrame(
+        {TAXON_KEY: pandas.Series(ids["taxa"], dtype=object)})
+    if "tags" in ids:
+        surpi_taxonomy_df[TAGS_KEY] = pandas.Series(ids["tags"], dtype=object)
+    surpi_taxonomy_df.index = pandas.Index(
+        ids["feature_ids"], dtype=object, name=FEATURE_KEY)
+    return surpi_feature_table, surpi_taxonomy_df
+
+
+def _check_existing_taxonomy(existing_taxonomy, collapse_duplicates,
+                             collapse_level):
+    # Reject an existing taxonomy that was not extracted with the same
+    # collapse_duplicates and collapse_level as the new run, since its
+    # features could not be merged with the new run's. Whether duplicates
+    # were collapsed shows in the Tags column, and the level in the lowest
+    # rank that any taxon names.
+    has_tags = TAGS_KEY in existing_taxonomy.columns
+    if has_tags != collapse_duplicates:
+        raise ValueError(
+            f"Expected an existing taxonomy "
+            f"{'with' if collapse_duplicates else 'without'} a {TAGS_KEY} "
+            f"column, as collapse_duplicates is {collapse_duplicates}, but "
+            f"got one {'with' if has_tags else 'without'}")
+
+    existing_level = _infer_collapse_level(existing_taxonomy[TAXON_KEY])
+    if collapse_level in COLLAPSE_LEVELS and existing_level is not None \
+            and existing_level != collapse_level:
+        raise ValueError(
+            f"Expected an existing taxonomy extracted at the "
+            f"'{collapse_level}' collapse level, but got one extracted at "
+            f"the '{existing_level}' level")
+
+
+def _infer_collapse_level(taxa):
+    # Return the level whose lowest rank is the lowest rank named by any of
+    # the taxa, or None if no taxon names any rank
+    for curr_level, curr_rank_keys in COLLAPSE_LEVELS.items():
+        curr_prefix = _RANK_PREFIXES[curr_rank_keys[0]]
+        if taxa.str.contains(f"(?:^|; ){curr_prefix}", regex=True).any():
+            return curr_level
+    # endfor each level, from the lowest
+    return None
+
+
+def _encode_existing_outputs(existing_table, existing_taxonomy):
+    # Put an existing feature table and taxonomy in the same form as the
+    # result of extracting a run, so they can be merged like one. Only the
+    # taxonomy of the table's features is kept, so that features filtered
+    # out of the table don't come back as all-zero rows.
+    table_ids = existing_table.ids(axis='observation')
+    existing_taxonomy = existing_taxonomy[
+        existing_taxonomy.index.isin(table_ids)]
+    has_tags = TAGS_KEY in existing_taxonomy.columns
+    feature_dict = _FeatureDictionary(keep_tags=has_tags)
+    existing_codes = feature_dict.encode(
+        existing_taxonomy.index, existing_taxonomy[TAXON_KEY].to_numpy())
+    if has_tags:
+        # split each feature's tags back out, keeping its codes alongside
+        tags = pandas.Series(
+            existing_taxonomy[TAGS_KEY].fillna("").to_numpy(dtype=object),
+            index=existing_codes).str.split(TAG_SEPARATOR).explode()
+        tags = tags[tags != ""]
+        feature_dict.add_tags(tags.index.to_numpy(),
+                              tags.to_numpy(dtype=object))
+
+    table_codes = feature_dict.get_codes(table_ids)
+    if (table_codes < 0).any():
+        missing_ids = set(table_ids[table_codes < 0])
+        raise ValueError(
+            f"The following feature ids in the existing feature table are "
+            f"not in the existing taxonomy: {missing_ids}")
+
+    table_coo = existing_table.matrix_data.tocoo()
+    counts = scipy.sparse.coo_matrix(
+        (table_coo.data, (table_codes[table_coo.row], table_coo.col)),
+        shape=(len(feature_dict), table_coo.shape[1]))
+    return counts, feature_dict, list(existing_table.ids(axis='sample'))
+
+
+def _extract_counts(surpi_output, surpi_sample_info, ids_are_barcodes,
+                    chunk_size, collapse_duplicates=False,
+                    collapse_level=SPECIES_LEVEL, include_tags=None,
+                    exclude_tags=None, sample_names=None, profile=None):
+    if profile is None:
+        profile = _MemoryProfile()
+    if collapse_level not in COLLAPSE_LEVELS:
+        raise ValueError(
+            f"Expected collapse_level to be one of "
+            f"{list(COLLAPSE_LEVELS)} but received '{collapse_level}'")
+    rank_keys = COLLAPSE_LEVELS[collapse_level]
+    # above the species level, rows that share the kept ranks are expected,
+    # and rolling them up is the same sum as collapsing duplicates
+    is_rolled_up = collapse_level != SPECIES_LEVEL
+    # the tag patterns are compiled once, into one regex per filter
+    include_regex = _compile_tag_patterns(include_tags)
+    exclude_regex = _compile_tag_patterns(exclude_tags)
+    num_excluded = 0
     ss_sample_id_key = BARCODE_KEY if ids_are_barcodes else SS_SAMPLE_ID_KEY
 
-    # Generate the taxonomy result
-    taxonomy = surpi_output[[SPECIES_KEY, GENUS_KEY, FAMILY_KEY]].copy()
-    taxonomy[TAXON_KEY] = surpi_output.apply(
-        lambda x: _generate_taxonomy_str(x), axis=1)
-    taxonomy.fillna("", inplace=True)
-    taxonomy[FEATURE_ID_KEY] = taxonomy[SPECIES_KEY] + "_" + \
-        taxonomy[GENUS_KEY] + "_" + taxonomy[FAMILY_KEY]
-    # drop the SPECIES_KEY, GENUS_KEY, and FAMILY_KEY columns
-    taxonomy.drop(columns=[SPECIES_KEY, GENUS_KEY, FAMILY_KEY], inplace=True)
-    taxonomy = taxonomy.set_index(FEATURE_ID_KEY)
-    taxonomy.index.name = FEATURE_KEY
-
-    # Generate the feature table
-    surpi_feature_table_df = surpi_output.copy()
-    surpi_feature_table_df.drop(
-        columns=[SPECIES_KEY, GENUS_KEY, FAMILY_KEY, TAG_KEY], inplace=True)
-    surpi_feature_table_df[FEATURE_ID_KEY] = taxonomy.index
-    surpi_feature_table_df = surpi_feature_table_df.set_index(FEATURE_ID_KEY)
-    surpi_feature_table_df = surpi_feature_table_df.T
-    surpi_feature_table_df.index.name = ss_sample_id_key
-    surpi_feature_table_df = surpi_feature_table_df.reset_index()
-    feature_barcodes = surpi_feature_table_df[ss_sample_id_key].unique()
-
-    # merge the sample info with the feature table
-    limited_sample_info_df = \
-        surpi_sample_info[[ss_sample_id_key, SAMPLE_NAME_KEY]]
-    surpi_feature_table_df = surpi_feature_table_df.merge(
-        limited_sample_info_df, on=ss_sample_id_key, how='inner',
-        validate='one_to_one')
-    identified_barcodes = surpi_feature_table_df[ss_sample_id_key].unique()
-    unidentified_barcodes = set(feature_barcodes) - set(identified_barcodes)
-    if len(unidentified_barcodes) > 0:
+    # Link the counttable's sample columns to the sample sheet's sample names
+    # before reading any counts, so a bad sample sheet fails fast
+    with profile.stage("link_samples"):
+        count_cols = get_sample_columns(surpi_output)
+        usecols = None
+        if sample_names is not None:
+            # only the columns of the selected samples are read at all
+            count_cols = usecols = _select_sample_columns(
+                count_cols, surpi_sample_info, ss_sample_id_key, sample_names)
+        sample_ids = _link_sample_ids(
+            count_cols, surpi_sample_info, ss_sample_id_key)
+
+    # Generate the taxonomy and the feature table one chunk of rows at a
+    # time; the counttable already has one row per feature and one column
+    # per sample, which is the orientation biom uses, so the counts never
+    # need to be transposed or densified; only the nonzero counts are ever
+    # copied out of each chunk. Each row's feature id is encoded as an
+    # integer code, which is used as its row in the feature table; when
+    # rolling up, the feature id is that of the row's genus or family.
+    feature_dict = _FeatureDictionary(keep_tags=collapse_duplicates)
+    chunk_codes = []
+    rows, cols, data = [], [], []
+    with profile.stage("read_counts"):
+        for curr_chunk in iter_counttable_chunks(
+                surpi_output, chunk_size, usecols):
+            # drop the rows excluded by tag before anything is built from
+            # the chunk, so they never reach the feature table
+            curr_keep = _get_tag_mask(
+                curr_chunk[TAG_KEY], include_regex, exclude_regex)
+            if curr_keep is not None and not curr_keep.all():
+                num_excluded += len(curr_keep) - curr_keep.sum()
+                curr_chunk = curr_chunk[curr_keep]
+            if len(curr_chunk) == 0:
+                continue
+
+            curr_codes = feature_dict.encode(
+                _generate_feature_ids(curr_chunk, rank_keys),
+                _generate_taxonomy_strs(curr_chunk, rank_keys).to_numpy())
+            curr_rows, curr_cols, curr_data = _nonzero_coords(
+                curr_chunk, count_cols)
+            if collapse_duplicates:
+                feature_dict.add_tags(
+                    curr_codes, curr_chunk[TAG_KEY].to_numpy(dtype=object))
+            chunk_codes.append(curr_codes)
+            rows.append(curr_codes[curr_rows])
+            cols.append(curr_cols)
+            data.append(curr_data)
+        # endfor each chunk
+    # endwith profile.stage("read_counts")
+
+    if num_excluded > 0:
+        _logger.info("Excluded %d counttable rows by tag", num_excluded)
+
+    num_rows = sum(len(x) for x in chunk_codes)
+    is_duplicated = None
+    if num_rows > len(feature_dict):
+        code_counts = numpy.bincount(numpy.concatenate(chunk_codes))
+        is_duplicated = code_counts > 1
+        if not (collapse_duplicates or is_rolled_up):
+            duplicated_ids = set(
+                feature_dict.decode(numpy.flatnonzero(is_duplicated)))
+            raise ValueError(
+                f"The following feature ids appear more than once in a "
+                f"counttable: {duplicated_ids}")
+    # endif any feature id appears more than once
+
+    with profile.stage("assemble_counts"):
+        counts = _concat_coo(
+            rows, cols, data, len(feature_dict), len(count_cols))
+    if is_duplicated is not None:
+        with profile.stage("collapse_duplicates"):
+            counts = _sum_duplicate_counts(counts)
+        _logger.info(
+            "Collapsed %d counttable rows with duplicate feature ids into %d "
+            "features", code_counts[is_duplicated].sum(),
+            is_duplicated.sum())
+    # endif duplicates are collapsed
+
+    return counts, feature_dict, sample_ids
+
+
+def _merge_run_results(run_results):
+    # Intern each feature id once across all runs: the first run that has a
+    # feature assigns it the next code, and every later run's counts for
+    # that feature are remapped onto the same code
+    feature_dict = _FeatureDictionary(
+        keep_tags=any(x[1].tag_pairs is not None for x in run_results))
+    rows, cols, data = [], [], []
+    sample_ids = []
+    for curr_counts, curr_feature_dict, curr_sample_ids in run_results:
+        curr_codes = feature_dict.encode(
+            curr_feature_dict.feature_ids, curr_feature_dict.taxa)
+        curr_tag_pairs = curr_feature_dict.tag_pairs
+        if curr_tag_pairs is not None:
+            feature_dict.add_tags(curr_codes[curr_tag_pairs["code"]],
+                                  curr_tag_pairs["tag"].to_numpy())
+        rows.append(curr_codes[curr_counts.row])
+        cols.append(curr_counts.col + len(sample_ids))
+        data.append(curr_counts.data)
+        sample_ids.extend(curr_sample_ids)
+    # endfor each run
+
+    duplicated_samples = set(
+        pandas.Index(sample_ids)[pandas.Index(sample_ids).duplicated()])
+    if len(duplicated_samples) > 0:
         raise ValueError(
+            f"The following sample identifiers appear in more than one run: "
+            f"{duplicated_samples}")
+
+    counts = _concat_coo(rows, cols, data, len(feature_dict), len(sample_ids))
+    return counts, feature_dict, sample_ids
+
+
+def _filter_counts(counts, feature_dict, sample_ids, min_total_count,
+                   min_prevalence, min_sample_depth):
+    # Drop the features below the total count or prevalence thresholds, then
+    # the samples whose remaining counts are below the depth threshold. The
+    # totals are summed straight from the coordinates read in the single
+    # pass over the counttable, so the feature table is only ever built
+    # from what is kept. The counts must have no duplicate coordinates.
+    if max(min_total_count, min_prevalence, min_sample_depth) <= 0:
+        return counts, feature_dict, sample_ids
+
+    # float64 weights sum exactly up to 2**53 and cannot overflow the
+    # compact count dtypes
+    weights = counts.data.astype(numpy.float64)
+    feature_totals = numpy.bincount(
+        counts.row, weights=weights, minlength=counts.shape[0])
+    feature_prevalences = numpy.bincount(
+        counts.row[counts.data > 0], minlength=counts.shape[0])
+    keep_features = (feature_totals >= min_total_count) & \
+        (feature_prevalences >= min_prevalence)
+    keep_cells = keep_features[counts.row]
+
+    sample_depths = numpy.bincount(
+        counts.col[keep_cells], weights=weights[keep_cells],
+        minlength=counts.shape[1])
+    keep_samples = sample_depths >= min_sample_depth
+    keep_cells &= keep_samples[counts.col]
+
+    num_removed_features = len(keep_features) - keep_features.sum()
+    num_removed_samples = len(keep_samples) - keep_samples.sum()
+    if num_removed_features == 0 and num_removed_samples == 0:
+        return counts, feature_dict, sample_ids
+    _logger.info(
+        "Removed %d features and %d samples below the count, prevalence or "
+        "depth thresholds", num_removed_features, num_removed_samples)
+
+    # the kept features and samples are renumbered in their original order
+    new_rows = numpy.cumsum(keep_features) - 1
+    new_cols = numpy.cumsum(keep_samples) - 1
+    filtered_counts = scipy.sparse.coo_matrix(
+        (counts.data[keep_cells],
+         (new_rows[counts.row[keep_cells]], new_cols[counts.col[keep_cells]])),
+        shape=(keep_features.sum(), keep_samples.sum()))
+    filtered_sample_ids = [
+        x for x, y in zip(sample_ids, keep_samples) if y]
+    return (filtered_counts,
+            feature_dict.subset(numpy.flatnonzero(keep_features)),
+            filtered_sample_ids)
+
+
+def _decode_outputs(counts, feature_dict, sample_ids):
+    # Feature ids and taxa are held as integer codes until here, where they
+    # are turned back into strings for the output artifacts. biom converts
+    # the coordinate-format counts to CSR itself, so this is the only time
+    # the assembled counts are copied.
+    surpi_feature_table = biom.Table(
+        counts, observation_ids=feature_dict.feature_ids,
+        sample_ids=sample_ids)
+    taxonomy = feature_dict.to_taxonomy_df()
+    return surpi_feature_table, taxonomy
+
+
+def _concat_coo(rows, cols, data, num_rows, num_cols):
+    # concatenate lists of coordinate-format pieces into one COO matrix; the
+    # counts keep the smallest dtype that holds all of the pieces
+    empty_idxs = [numpy.empty(0, dtype=numpy.int64)]
+    return scipy.sparse.coo_matrix(
+        (_concat_counts(data),
+         (numpy.concatenate(empty_idxs + rows),
+          numpy.concatenate(empty_idxs + cols))),
+        shape=(num_rows, num_cols))
+
+
+def _sum_duplicate_counts(counts):
+    # Sum the counts that rows with the same feature id put in the same cell,
+    # with one sort of the coordinates. Compact unsigned counts are widened
+    # first, since a sum can overflow the dtype of its parts, and then
+    # narrowed to the smallest dtype that holds the sums.
+    is_compact = numpy.issubdtype(counts.dtype, numpy.unsignedinteger)
+    summed = scipy.sparse.coo_matrix(
+        (counts.data.astype(numpy.uint64) if is_compact else counts.data,
+         (counts.row, counts.col)),
+        shape=counts.shape)
+    summed.sum_duplicates()
+    if is_compact:
+        max_count = summed.data.max() if summed.nnz > 0 else 0
+        summed.data = summed.data.astype(get_compact_count_dtype(max_count))
+    return summed
+
+
+class _FeatureDictionary:
+    """Interns feature ids, encoding each distinct one as an integer code.
+
+    Codes are assigned in order of first appearance, and the taxon string of
+    each feature is stored once, against its code. If keep_tags is True, the
+    distinct tags of each feature are kept too.
+    """
+
+    def __init__(self, keep_tags: bool = False):
+        self._codes = {}
+        self._taxa = []
+        self._tag_pairs = [] if keep_tags else None
+
+    def __len__(self):
+        return len(self._taxa)
+
+    @property
+    def feature_ids(self) -> list:
+        # dicts keep insertion order, which is also code order
+        return list(self._codes)
+
+    @property
+    def taxa(self) -> list:
+        return self._taxa
+
+    def encode(self, feature_ids, taxa) -> numpy.ndarray:
+        """Return the codes of feature_ids, adding any that are new."""
+        num_known = len(self._codes)
+        codes = numpy.fromiter(
+            (self._codes.setdefault(x, len(self._codes))
+             for x in feature_ids),
+            dtype=numpy.int64, count=len(feature_ids))
+
+        # new codes were assigned in increasing order, so taking the first
+        # row that has each one keeps the taxa in code order
+        unique_codes, first_idxs = numpy.unique(codes, return_index=True)
+        is_new = unique_codes >= num_known
+        self._taxa.extend(numpy.asarray(taxa, dtype=object)[
+            first_idxs[is_new]])
+        return codes
+
+    @property
+    def tag_pairs(self) -> pandas.DataFrame:
+        """Return the distinct (code, tag) pairs, or None if not kept."""
+        if self._tag_pairs is None:
+            return None
+        if len(self._tag_pairs) != 1:
+            self._tag_pairs = [
+                pandas.concat(self._tag_pairs + [_make_tag_pairs([], [])],
+                              ignore_index=True).drop_duplicates(
+                    ignore_index=True)]
+        return self._tag_pairs[0]
+
+    def add_tags(self, codes, tags):
+        """Record the tags of the features with codes; nulls are skipped."""
+        # the pairs of each call are deduplicated as they are added, and all
+        # of them together only when they are next read
+        self._tag_pairs.append(
+            _make_tag_pairs(codes, tags).dropna().drop_duplicates())
+
+    def subset(self, codes) -> "_FeatureDictionary":
+        """Return a dictionary of only the features with codes, in order."""
+        subset_dict = _FeatureDictionary(
+            keep_tags=self._tag_pairs is not None)
+        subset_dict.encode(self.decode(codes),
+                           [self._taxa[x] for x in codes])
+        if self._tag_pairs is not None:
+            # map the kept codes to their new ones and drop the others' tags
+            new_codes = numpy.full(len(self), -1, dtype=numpy.int64)
+            new_codes[codes] = numpy.arange(len(codes))
+            tag_pairs = self.tag_pairs
+            tag_codes = new_codes[tag_pairs["code"].to_numpy()]
+            is_kept = tag_codes >= 0
+            subset_dict.add_tags(tag_codes[is_kept],
+                                 tag_pairs["tag"].to_numpy()[is_kept])
+        return subset_dict
+
+    def get_codes(self, feature_ids) -> numpy.ndarray:
+        """Return the codes of feature_ids, or -1 for any that are unknown."""
+        return numpy.fromiter(
+            (self._codes.get(x, -1) for x in feature_ids),
+            dtype=numpy.int64, count=len(feature_ids))
+
+    def decode(self, codes) -> list:
+        """Return the feature ids of codes."""
+        feature_ids = self.feature_ids
+        return [feature_ids[x] for x in codes]
+
+    def to_taxonomy_df(self) -> pandas.DataFrame:
+        taxonomy = pandas.DataFrame(
+            {TAXON_KEY: pandas.Series(self._taxa, dtype=object)})
+        if self._tag_pairs is not None:
+            # one hashed group-by joins each feature's tags, in order of
+            # first appearance; features without tags get an empty string
+            feature_tags = self.tag_pairs.groupby("code", sort=False)[
+                "tag"].agg(TAG_SEPARATOR.join)
+            taxonomy[TAGS_KEY] = feature_tags.reindex(
+                range(len(self)), fill_value="").to_numpy(dtype=object)
+        taxonomy.index = pandas.Index(
+            self.feature_ids, dtype=object, name=FEATURE_KEY)
+        return taxonomy
+
+
+def _make_tag_pairs(codes, tags):
+    return pandas.DataFrame({
+        "code": numpy.asarray(codes, dtype=numpy.int64),
+        "tag": numpy.asarray(tags, dtype=object)})
+
+
+def _get_selected_sample_names(sample_names, sample_metadata, where):
+    # Return the set of sample names to extract, or None to extract all
+    if where is not None and sample_metadata is None:
+        raise ValueError(
+            "Expected sample_metadata to filter with where, but got none")
+
+    selected_names = None
+    if sample_names is not None:
+        selected_names = set(sample_names)
+    if sample_metadata is not None:
+        metadata_names = set(sample_metadata.get_ids(where=where))
+        selected_names = metadata_names if selected_names is None else \
+            selected_names & metadata_names
+
+    # an empty selection would otherwise give an empty feature table
+    if selected_names is not None and len(selected_names) == 0:
+        raise ValueError(
+            "Expected at least one sample to extract, but the sample names, "
+            "sample metadata and where clause given select none")
+    return selected_names
+
+
+def _select_sample_columns(count_cols, surpi_sample_info, ss_sample_id_key,
+                           sample_names):
+    # Resolve the sample names to the counttable columns that hold their
+    # counts through the sample sheet, keeping the counttable's order
+    is_selected = surpi_sample_info[SAMPLE_NAME_KEY].isin(sample_names)
+    missing_names = set(sample_names) - \
+        set(surpi_sample_info.loc[is_selected, SAMPLE_NAME_KEY])
+    selected_ids = set(surpi_sample_info.loc[is_selected, ss_sample_id_key])
+    missing_ids = selected_ids - set(count_cols)
+
+    error_msgs = []
+    if len(missing_names) > 0:
+        error_msgs.append(
+            f"The following sample names are not in the sample sheet: "
+            f"{missing_names}")
+    if len(missing_ids) > 0:
+        error_msgs.append(
+            f"The following sample identifiers of the selected samples are "
+            f"not in the counttable: {missing_ids}")
+    if len(error_msgs) > 0:
+        raise ValueError("\n".join(error_msgs))
+
+    return [x for x in count_cols if x in selected_ids]
+
+
+def _link_sample_ids(count_cols, surpi_sample_info, ss_sample_id_key):
+    # Map each counttable sample column to its sample sheet name with a
+    # dictionary lookup, so the cost depends only on the number of samples.
+    # Sheet ids listed more than once are only a problem if a column uses
+    # them, so they are reported from the same pass as unlinked barcodes.
+    id_to_name = {}
+    repeated_ids = set()
+    for curr_id, curr_name in zip(surpi_sample_info[ss_sample_id_key],
+                                  surpi_sample_info[SAMPLE_NAME_KEY]):
+        if curr_id in id_to_name:
+            repeated_ids.add(curr_id)
+        id_to_name[curr_id] = curr_name
+    # endfor each sample sheet row
+
+    sample_ids = []
+    unidentified_barcodes = set()
+    duplicated_ids = set()
+    for curr_col in count_cols:
+        if curr_col not in id_to_name:
+            unidentified_barcodes.add(curr_col)
+        elif curr_col in repeated_ids:
+            duplicated_ids.add(curr_col)
+        sample_ids.append(id_to_name.get(curr_col))
+    # endfor each sample column
+
+    error_msgs = []
+    if len(unidentified_barcodes) > 0:
+        error_msgs.append(
             f"The following barcodes were not linked to sample identifiers "
             f"in the sample sheet: {unidentified_barcodes}")
+    if len(duplicated_ids) > 0:
+        error_msgs.append(
+            f"The following sample identifiers appear more than once in the "
+            f"sample sheet: {duplicated_ids}")
+    if len(error_msgs) > 0:
+        raise ValueError("\n".join(error_msgs))
+
+    return sample_ids
+
+
+def _compile_tag_patterns(patterns):
+    # Combine the patterns into one alternation, which matches a tag if any
+    # of them does; None if there are no patterns
+    if not patterns:
+        return None
+
+    try:
+        return re.compile("|".join(f"(?:{x})" for x in patterns))
+    except re.error as e:
+        raise ValueError(
+            f"Expected tag patterns to be valid regular expressions but "
+            f"received {list(patterns)}: {e}") from e
+
+
+def _get_tag_mask(tags, include_regex, exclude_regex):
+    # Return a boolean array that is True for each tag that matches
+    # include_regex, if any, and does not match exclude_regex, if any; None
+    # if there is no filter. Null tags match neither. For a categorical
+    # column, each category is matched once rather than each row.
+    if include_regex is None and exclude_regex is None:
+        return None
+
+    if isinstance(tags.dtype, pandas.CategoricalDtype):
+        category_keep = _get_tag_mask(
+            pandas.Series(tags.cat.categories.astype(object)),
+            include_regex, exclude_regex)
+        # null values have code -1, which picks out the trailing null result
+        null_keep = include_regex is None
+        return numpy.append(category_keep, null_keep)[
+            tags.cat.codes.to_numpy()]
+
+    tags = tags.astype(object)
+    keep = numpy.ones(len(tags), dtype=bool)
+    if include_regex is not None:
+        keep &= tags.str.contains(include_regex, na=False).to_numpy(
+            dtype=bool)
+    if exclude_regex is not None:
+        keep &= ~tags.str.contains(exclude_regex, na=False).to_numpy(
+            dtype=bool)
+    return keep
+
+
+def _nonzero_coords(surpi_output, count_cols):
+    # Return the row numbers, column numbers and values of the nonzero cells
+    # of the count columns, gathered one sample column at a time
+    rows, cols, data = [], [], []
+    for curr_col_idx, curr_col in enumerate(count_cols):
+        curr_values = surpi_output[curr_col].to_numpy()
+        curr_nonzero = numpy.flatnonzero(curr_values)
+        rows.append(curr_nonzero)
+        cols.append(numpy.full(len(curr_nonzero), curr_col_idx,
+                               dtype=numpy.int64))
+        data.append(curr_values[curr_nonzero])
+    # endfor each sample column
+
+    empty_idxs = [numpy.empty(0, dtype=numpy.int64)]
+    return (numpy.concatenate(empty_idxs + rows),
+            numpy.concatenate(empty_idxs + cols),
+            _concat_counts(data))
+
+
+def _concat_counts(data):
+    # Concatenate arrays of counts, which numpy promotes to the smallest
+    # dtype that holds them all; an empty float array would instead promote
+    # every count to float64
+    if len(data) == 0:
+        return numpy.empty(0, dtype=COMPACT_COUNT_DTYPES[0])
+    return numpy.concatenate(data)
+
+
+class _MemoryProfile:
+    """Records the memory used by each stage of an extraction, if enabled.
+
+    Allocation sizes come from tracemalloc, which sees both Python objects
+    and numpy arrays. The recorded values are plain numbers, so the whole
+    profile can be serialized as JSON.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.stages = []
+        self._started_tracing = False
+
+    def __enter__(self):
+        if self.enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        return self
+
+    def __exit__(self, *args):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Record the memory allocated while the with-block runs."""
+        if not self.enabled:
+            yield
+            return
 
-    surpi_feature_table_df.drop(columns=[ss_sample_id_key], inplace=True)
-    surpi_feature_table_df.set_index(SAMPLE_NAME_KEY, inplace=True)
-    surpi_feature_table_df.index.name = SAMPLE_ID_KEY
+        start_bytes, _ = tracemalloc.get_traced_memory()
+        # reset_peak is only available from python 3.9
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            end_bytes, peak_bytes = tracemalloc.get_traced_memory()
+            self.stages.append({
+                "stage": name,
+                "allocated_bytes": end_bytes - start_bytes,
+                "peak_bytes": max(peak_bytes - start_bytes, 0),
+                "max_rss_bytes": _get_max_rss_bytes()})
 
-    return surpi_feature_table_df, taxonomy
+    def to_dict(self) -> dict:
+        return {"max_rss_bytes": _get_max_rss_bytes(),
+                "stages": list(self.stages)}
+
+    def report(self):
+        # printed rather than logged, so it shows up on the command line,
+        # where the q2_surpi logger is not configured
+        if self.enabled:
+            print(json.dumps({"memory_profile": self.to_dict()}), flush=True)
+
+
+def _get_max_rss_bytes():
+    if resource is None:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, while macos reports bytes
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
 
 
 def _generate_taxonomy_str(row):
@@ -97,3 +1108,62 @@ def _generate_taxonomy_str(row):
 
     result = fam_str + gen_str + spc_str
     return result.strip()
+
+
+def _generate_taxonomy_strs(surpi_output,
+                            rank_keys=COLLAPSE_LEVELS[SPECIES_LEVEL]):
+    # Column-wise equivalent of applying _generate_taxonomy_str to every row:
+    # each rank contributes its prefixed name, or nothing if it is null, and
+    # the concatenation is stripped exactly as the row-wise version does.
+    # Only the ranks in rank_keys, lowest first, are included.
+    result = ""
+    for curr_key in reversed(rank_keys):
+        result = result + _affix_strs(
+            surpi_output[curr_key], _RANK_PREFIXES[curr_key], "; ")
+    result = pandas.Series(result, index=surpi_output.index).str.strip()
+    if rank_keys != COLLAPSE_LEVELS[SPECIES_LEVEL]:
+        result[_get_unassigned_mask(surpi_output, rank_keys)] = \
+            UNASSIGNED_FEATURE_ID
+    # endif
+    return result
+
+
+def _generate_feature_ids(surpi_output,
+                          rank_keys=COLLAPSE_LEVELS[SPECIES_LEVEL]):
+    result = _affix_strs(surpi_output[rank_keys[0]], "", "")
+    for curr_key in rank_keys[1:]:
+        result = result + "_" + _affix_strs(surpi_output[curr_key], "", "")
+    # below the species level, an id built only from empty ranks, such as ""
+    # or "_", is unassigned; species-level ids are always kept as built
+    if rank_keys != COLLAPSE_LEVELS[SPECIES_LEVEL]:
+        result[_get_unassigned_mask(surpi_output, rank_keys)] = \
+            UNASSIGNED_FEATURE_ID
+    # endif
+    return result
+
+
+def _get_unassigned_mask(surpi_output, rank_keys):
+    # Return a boolean array that is True for each row with no name at any
+    # of the ranks in rank_keys
+    result = numpy.ones(len(surpi_output), dtype=bool)
+    for curr_key in rank_keys:
+        result &= surpi_output[curr_key].isna().to_numpy()
+    return result
+
+
+_RANK_PREFIXES = {FAMILY_KEY: "f__", GENUS_KEY: "g__", SPECIES_KEY: "s__"}
+
+
+def _affix_strs(a_col, prefix, suffix):
+    # Return an object array holding prefix + value + suffix for each
+    # non-null value of a_col and "" for each null one. For a categorical
+    # column, the strings are built once per category rather than per row.
+    if isinstance(a_col.dtype, pandas.CategoricalDtype):
+        category_strs = (prefix + a_col.cat.categories.astype(object) +
+                         suffix).to_numpy(dtype=object)
+        # null values have code -1, which picks out the trailing ""
+        return numpy.append(category_strs, "")[a_col.cat.codes.to_numpy()]
+
+    a_col = a_col.astype(object)
+    result = (prefix + a_col + suffix).where(a_col.notna(), "")
+    return result.to_numpy(dtype=object)
@@ -0,0 +1,250 @@
+import argparse
+import os
+
+import numpy
+
+from q2_surpi._formats_and_types import SPECIES_KEY, GENUS_KEY, FAMILY_KEY, \
+    TAG_KEY
+
+COUNTTABLE_FNAME = "surpi_output.counttable"
+SAMPLE_SHEET_FNAME = "surpi_sample_info.csv"
+PLACEHOLDER_SPECIES = "*"
+TAGS = ["host-bacteria;", "host-apicomplexans|fungi|plants;",
+        "host-vertebrates;", "host-invertebrates|vertebrates;",
+        "host-plants;"]
+# roughly 20 species per genus and 20 genera per family
+SPECIES_PER_GENUS = 20
+GENERA_PER_FAMILY = 20
+# number of counttable cells generated and written at a time
+CELLS_PER_CHUNK = 10000000
+
+
+def simulate_surpi_run(
+        output_dir: str, num_barcodes: int, num_taxa: int,
+        density: float = 0.005, nan_genus_rate: float = 0.3,
+        nan_family_rate: float = 0.02, duplicate_species_rate: float = 0.0,
+        placeholder_rate: float = 0.0, max_count: int = 20,
+        seed: int = 0) -> (str, str):
+
+    """Write a synthetic SURPI+ counttable and its sample sheet.
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory in which to write the counttable and sample sheet; it is
+        created if it doesn't exist.
+    num_barcodes : int
+        Number of barcodes (sample columns) in the counttable.
+    num_taxa : int
+        Number of taxa (rows) in the counttable.
+    density : float, optional
+        Fraction of count cells that are nonzero. Default is 0.005.
+    nan_genus_rate : float, optional
+        Fraction of rows with no genus. Default is 0.3.
+    nan_family_rate : float, optional
+        Fraction of rows with no family. Default is 0.02.
+    duplicate_species_rate : float, optional
+        Fraction of rows that repeat the species, genus and family of an
+        earlier row with a different tag, giving duplicate feature ids.
+        Default is 0.
+    placeholder_rate : float, optional
+        Fraction of rows whose species is the "*" placeholder, with no genus;
+        two such rows in the same family give duplicate feature ids.
+        Default is 0.
+    max_count : int, optional
+        Nonzero counts are drawn uniformly from 1 to max_count. Default is 20.
+    seed : int, optional
+        Seed for the random number generator; the same seed and parameters
+        always produce the same files. Default is 0.
+
+    Returns
+    -------
+    counttable_fp : str
+        Path of the written counttable.
+    sample_sheet_fp : str
+        Path of the written sample sheet.
+    """
+
+    rng = numpy.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    counttable_fp = os.path.join(output_dir, COUNTTABLE_FNAME)
+    sample_sheet_fp = os.path.join(output_dir, SAMPLE_SHEET_FNAME)
+
+    barcodes = _simulate_barcodes(num_barcodes, rng)
+    taxa = _simulate_taxa(num_taxa, nan_genus_rate, nan_family_rate,
+                          duplicate_species_rate, placeholder_rate, rng)
+    _write_counttable(counttable_fp, barcodes, taxa, density, max_count, rng)
+    _write_sample_sheet(sample_sheet_fp, barcodes)
+
+    return counttable_fp, sample_sheet_fp
+
+
+def _simulate_barcodes(num_barcodes, rng):
+    barcodes = set()
+    while len(barcodes) < num_barcodes:
+        curr_bases = rng.choice(list("ACGT"), size=(num_barcodes, 16))
+        barcodes.update("".join(x[:8]) + "+" + "".join(x[8:])
+                        for x in curr_bases)
+    # endwhile not enough distinct barcodes
+
+    return sorted(barcodes)[:num_barcodes]
+
+
+def _simulate_taxa(num_taxa, nan_genus_rate, nan_family_rate,
+                   duplicate_species_rate, placeholder_rate, rng):
+    # Return a list of (species, genus, family, tag) tuples, using "" for
+    # missing ranks, as they are written in SURPI+ counttables
+    row_nums = numpy.arange(num_taxa)
+    species = [f"Synthetic virus {x}" for x in row_nums]
+    genus_nums = row_nums // SPECIES_PER_GENUS
+    genera = [f"Synthetic{x}virus" for x in genus_nums]
+    families = [f"Synthetic{x}viridae"
+                for x in genus_nums // GENERA_PER_FAMILY]
+    tags = numpy.array(TAGS, dtype=object)[
+        rng.integers(0, len(TAGS), num_taxa)]
+
+    for curr_idx in numpy.flatnonzero(rng.random(num_taxa) < nan_genus_rate):
+        genera[curr_idx] = ""
+    for curr_idx in numpy.flatnonzero(rng.random(num_taxa) < nan_family_rate):
+        families[curr_idx] = ""
+    for curr_idx in numpy.flatnonzero(
+            rng.random(num_taxa) < placeholder_rate):
+        species[curr_idx] = PLACEHOLDER_SPECIES
+        genera[curr_idx] = ""
+
+    # a duplicate repeats an earlier row's names, under a different tag than
+    # the original and any other copies of it
+    original_idxs = {}
+    num_copies = {}
+    for curr_idx in numpy.flatnonzero(
+            rng.random(num_taxa) < duplicate_species_rate):
+        if curr_idx == 0:
+            continue
+        source_idx = rng.integers(0, curr_idx)
+        source_idx = original_idxs.get(source_idx, source_idx)
+        original_idxs[curr_idx] = source_idx
+        num_copies[source_idx] = num_copies.get(source_idx, 0) + 1
+        species[curr_idx] = species[source_idx]
+        genera[curr_idx] = genera[source_idx]
+        families[curr_idx] = families[source_idx]
+        tags[curr_idx] = TAGS[(TAGS.index(tags[source_idx]) +
+                               num_copies[source_idx]) % len(TAGS)]
+    # endfor each duplicate row
+
+    return list(zip(species, genera, families, tags))
+
+
+def _write_counttable(fp, barcodes, taxa, density, max_count, rng):
+    num_barcodes = len(barcodes)
+    rows_per_chunk = max(1, CELLS_PER_CHUNK // max(num_barcodes, 1))
+    # every count is written as a tab followed by its value, so a run of k
+    # zeros is the first 2k characters of this string
+    zeros_str = "\t0" * num_barcodes
+
+    with open(fp, "w") as f:
+        f.write("\t".join(
+            [SPECIES_KEY, GENUS_KEY, FAMILY_KEY, TAG_KEY] + barcodes) + "\n")
+
+        for start in range(0, len(taxa), rows_per_chunk):
+            num_rows = min(rows_per_chunk, len(taxa) - start)
+            # draw the nonzero cells directly, rather than a dense matrix,
+            # so the work depends on the number of nonzero counts
+            num_cells = num_rows * num_barcodes
+            cell_idxs = numpy.unique(rng.integers(
+                0, num_cells, rng.binomial(num_cells, density)))
+            cell_values = rng.integers(1, max_count + 1, len(cell_idxs))
+            row_starts = numpy.searchsorted(
+                cell_idxs, numpy.arange(num_rows + 1) * num_barcodes)
+
+            lines = []
+            for curr_row in range(num_rows):
+                pieces = ["\t".join(taxa[start + curr_row])]
+                prev_col = 0
+                for curr_cell in range(row_starts[curr_row],
+                                       row_starts[curr_row + 1]):
+                    curr_col = cell_idxs[curr_cell] % num_barcodes
+                    pieces.append(zeros_str[:2 * (curr_col - prev_col)])
+                    pieces.append(f"\t{cell_values[curr_cell]}")
+                    prev_col = curr_col + 1
+                # endfor each nonzero cell in the row
+                pieces.append(zeros_str[:2 * (num_barcodes - prev_col)])
+                lines.append("".join(pieces))
+            # endfor each row in the chunk
+
+            f.write("\n".join(lines) + "\n")
+        # endfor each chunk of rows
+    # endwith open(fp, "w") as f
+
+
+def _write_sample_sheet(fp, barcodes):
+    # Mimic the layout of the sample sheets SURPI+ uses, including the blank
+    # lines of commas between every line
+    num_cols = 10
+    blank_line = "," * (num_cols - 1) + "\n"
+
+    def pad(a_str):
+        return a_str + "," * (num_cols - 1 - a_str.count(",")) + "\n"
+
+    with open(fp, "w") as f:
+        for curr_line in ["[Header]", "IEMFileVersion,4",
+                          "Experiment Name,q2_surpi_synthetic",
+                          "Workflow,GenerateFASTQ", "Chemistry,Amplicon",
+                          "[Reads]", "150", "[Settings]",
+                          "ReverseComplement,0", "[Data]",
+                          "Sample_ID,Sample_Name,Sample_Plate,Sample_Well,"
+                          "I7_Index_ID,index,I5_Index_ID,index2,Prep,Type"]:
+            f.write(pad(curr_line) + blank_line)
+        # endfor each header line
+
+        for i, curr_barcode in enumerate(barcodes):
+            index_1, index_2 = curr_barcode.split("+")
+            well = f"{'ABCDEFGH'[i % 8]}{i // 8 % 12 + 1}"
+            sample_id = f"sample-{i}"
+            f.write(f"{sample_id},{sample_id},plate{i // 96 + 1},{well},"
+                    f"7-{i},{index_1},5-{i},{index_2},DNA,Analytical\n")
+            f.write(blank_line)
+        # endfor each barcode
+    # endwith open(fp, "w") as f
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="q2-surpi-simulate",
+        description="Write a synthetic SURPI+ counttable and sample sheet "
+                    "for scale testing.")
+    parser.add_argument("output_dir",
+                        help="directory in which to write the files")
+    parser.add_argument("--barcodes", type=int, required=True,
+                        help="number of barcodes (sample columns)")
+    parser.add_argument("--taxa", type=int, required=True,
+                        help="number of taxa (rows)")
+    parser.add_argument("--density", type=float, default=0.005,
+                        help="fraction of count cells that are nonzero")
+    parser.add_argument("--nan-genus-rate", type=float, default=0.3,
+                        help="fraction of rows with no genus")
+    parser.add_argument("--nan-family-rate", type=float, default=0.02,
+                        help="fraction of rows with no family")
+    parser.add_argument("--duplicate-species-rate", type=float, default=0.0,
+                        help="fraction of rows repeating an earlier row's "
+                             "species, genus and family under another tag")
+    parser.add_argument("--placeholder-rate", type=float, default=0.0,
+                        help="fraction of rows with the '*' placeholder "
+                             "species")
+    parser.add_argument("--max-count", type=int, default=20,
+                        help="largest nonzero count")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random seed")
+    args = parser.parse_args(argv)
+
+    counttable_fp, sample_sheet_fp = simulate_surpi_run(
+        args.output_dir, args.barcodes, args.taxa, density=args.density,
+        nan_genus_rate=args.nan_genus_rate,
+        nan_family_rate=args.nan_family_rate,
+        duplicate_species_rate=args.duplicate_species_rate,
+        placeholder_rate=args.placeholder_rate, max_count=args.max_count,
+        seed=args.seed)
+    print(f"Wrote {counttable_fp} and {sample_sheet_fp}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,21 @@
+import os
+import shutil
 import pandas
 from q2_types.feature_table import FeatureTable, Frequency
 from q2_types.feature_data import FeatureData, Taxonomy
-from qiime2.plugin import (Plugin, Citations, Bool)
+from qiime2.plugin import (Plugin, Citations, Bool, Int, Range, List, Str,
+                           Choices, Metadata)
 import q2_surpi
 from q2_surpi._formats_and_types import (
-    SurpiCountTable, SurpiCountTableFormat, SurpiCountTableDirectoryFormat,
+    COLLAPSE_LEVELS, SurpiCountTable, SurpiCountTableFormat,
+    SurpiCountTableDirectoryFormat, SurpiCountTableCompressedFormat,
     SurpiSampleSheet, SurpiSampleSheetFormat, SurpiSampleSheetDirectoryFormat,
-    surpi_sample_sheet_fp_to_df)
+    SurpiSampleSheetCompressedFormat)
+from q2_surpi._counttable import SurpiCountTableReader, SurpiCountMatrix, \
+    get_count_matrix, read_compact_counttable
+from q2_surpi._cache import CACHE_DIR_ENV_VAR
+from q2_surpi._plugin import extract, extract_batch, extract_append
+from q2_surpi._compression import get_compression, open_decompressed
 
 
 plugin = Plugin(
@@ -20,29 +29,94 @@ plugin = Plugin(
     short_description=q2_surpi.__description__,
 )
 
-plugin.register_formats(SurpiCountTableFormat, SurpiCountTableDirectoryFormat)
+plugin.register_formats(SurpiCountTableFormat, SurpiCountTableDirectoryFormat,
+                        SurpiCountTableCompressedFormat)
 plugin.register_semantic_types(SurpiCountTable)
 plugin.register_semantic_type_to_format(
     SurpiCountTable, SurpiCountTableDirectoryFormat)
 
 plugin.register_semantic_types(SurpiSampleSheet)
 plugin.register_formats(SurpiSampleSheetFormat,
-                        SurpiSampleSheetDirectoryFormat)
+                        SurpiSampleSheetDirectoryFormat,
+                        SurpiSampleSheetCompressedFormat)
 plugin.register_semantic_type_to_format(
     SurpiSampleSheet, SurpiSampleSheetDirectoryFormat)
 
 
 @plugin.register_transformer
-# load a SurpiCountTableFormat into a dataframe
+# load a SurpiCountTableFormat into a dataframe, with the counts held in the
+# smallest unsigned integer dtype that fits them as each chunk is read
 def _1(ff: SurpiCountTableFormat) -> pandas.DataFrame:
-    result = pandas.read_csv(str(ff), sep='\t', header=0)
+    result = read_compact_counttable(str(ff))
     return result
 
 
 @plugin.register_transformer
 # load a SurpiSampleSheetFormat into a dataframe
 def _2(ff: SurpiSampleSheetFormat) -> pandas.DataFrame:
-    result = surpi_sample_sheet_fp_to_df(str(ff))
+    result = ff.to_dataframe()
+    return result
+
+
+@plugin.register_transformer
+# wrap a SurpiCountTableFormat in a reader that loads it lazily, in chunks;
+# if a cache directory is set, the reader uses the counttable's arrow cache,
+# which is only looked up (or written) once the chunks are first read
+def _3(ff: SurpiCountTableFormat) -> SurpiCountTableReader:
+    result = SurpiCountTableReader(
+        str(ff), cache_dir=os.environ.get(CACHE_DIR_ENV_VAR) or None)
+    return result
+
+
+@plugin.register_transformer
+# load a SurpiCountTableFormat as a memory-mapped count matrix, which is kept
+# in the cache directory if one is set
+def _4(ff: SurpiCountTableFormat) -> SurpiCountMatrix:
+    result = get_count_matrix(
+        SurpiCountTableReader(str(ff)),
+        cache_dir=os.environ.get(CACHE_DIR_ENV_VAR) or None)
+    return result
+
+
+@plugin.register_transformer
+# load a compressed counttable into a dataframe, decompressing it as it is
+# parsed, with the counts held in the smallest unsigned integer dtype that
+# fits them as each chunk is read
+def _5(ff: SurpiCountTableCompressedFormat) -> pandas.DataFrame:
+    result = read_compact_counttable(
+        str(ff), compression=get_compression(str(ff)))
+    return result
+
+
+@plugin.register_transformer
+# store a compressed counttable in an artifact, decompressing it straight
+# into the artifact rather than into a temporary file
+def _6(ff: SurpiCountTableCompressedFormat) -> \
+        SurpiCountTableDirectoryFormat:
+    result = SurpiCountTableDirectoryFormat()
+    with open_decompressed(str(ff)) as in_f, \
+            open(os.path.join(str(result), 'surpi_output.counttable'),
+                 'wb') as out_f:
+        shutil.copyfileobj(in_f, out_f)
+    return result
+
+
+@plugin.register_transformer
+# load a compressed sample sheet into a dataframe
+def _7(ff: SurpiSampleSheetCompressedFormat) -> pandas.DataFrame:
+    result = ff.to_dataframe()
+    return result
+
+
+@plugin.register_transformer
+# store a compressed sample sheet in an artifact, decompressed
+def _8(ff: SurpiSampleSheetCompressedFormat) -> \
+        SurpiSampleSheetDirectoryFormat:
+    result = SurpiSampleSheetDirectoryFormat()
+    with open_decompressed(str(ff)) as in_f, \
+            open(os.path.join(str(result), 'surpi_sample_info.txt'),
+                 'wb') as out_f:
+        shutil.copyfileobj(in_f, out_f)
     return result
 
 
@@ -61,7 +135,7 @@ def _2(ff: SurpiSampleSheetFormat) -> pandas.DataFrame:
 # )
 
 plugin.methods.register_function(
-    function=q2_surpi.extract,
+    function=extract,
     name='Extract SURPI data for use in QIIME.',
     description=(
         'Extract SURPI data into a feature table and a feature taxonomy.'),
@@ -70,14 +144,192 @@ plugin.methods.register_function(
     input_descriptions={
         'surpi_output': "SURPI counts per species per barcode.",
         'surpi_sample_info': 'Info linking sample ids to barcodes.'},
-    parameters={'ids_are_barcodes': Bool},
+    parameters={'ids_are_barcodes': Bool,
+                'chunk_size': Int % Range(1, None),
+                'collapse_duplicates': Bool,
+                'collapse_level': Str % Choices(*COLLAPSE_LEVELS),
+                'include_tags': List[Str],
+                'exclude_tags': List[Str],
+                'min_total_count': Int % Range(0, None),
+                'min_prevalence': Int % Range(0, None),
+                'min_sample_depth': Int % Range(0, None),
+                'sample_names': List[Str],
+                'sample_metadata': Metadata,
+                'where': Str,
+                'profile_memory': Bool},
     parameter_descriptions={
         'ids_are_barcodes': ("True if the sample ids in the count tables are "
                              "barcodes. False if they are the sample sheet's "
-                             "sample ids. Default is True.")},
+                             "sample ids. Default is True."),
+        'chunk_size': ("Number of count table rows read and converted at a "
+                       "time. Peak memory use depends on this rather than "
+                       "on the size of the count table."),
+        'collapse_duplicates': ("True to sum the counts of count table rows "
+                                "with the same feature id and list all of "
+                                "each feature's tags in the taxonomy's Tags "
+                                "column. False to reject such rows. Default "
+                                "is False."),
+        'collapse_level': ("Rank to which the counts are rolled up while "
+                           "they are extracted: 'species' for one feature "
+                           "per species, genus and family, 'genus' for one "
+                           "per genus and family, or 'family' for one per "
+                           "family. Default is 'species'."),
+        'include_tags': ("Regular expressions; only count table rows whose "
+                         "tag matches at least one of them are extracted. "
+                         "By default, rows with any tag are extracted."),
+        'exclude_tags': ("Regular expressions; count table rows whose tag "
+                         "matches any of them are skipped as the count "
+                         "table is read. By default, no rows are skipped."),
+        'min_total_count': ("Features whose total count across all samples "
+                            "is below this are removed. Default is 0."),
+        'min_prevalence': ("Features with a nonzero count in fewer samples "
+                           "than this are removed. Default is 0."),
+        'min_sample_depth': ("Samples whose total count, after features are "
+                             "removed, is below this are removed. Default "
+                             "is 0."),
+        'sample_names': ("Sample names of the only samples to extract. Only "
+                         "the count table columns of these samples, found "
+                         "through the sample sheet, are read. By default, "
+                         "every sample is extracted."),
+        'sample_metadata': ("Metadata whose ids are the sample names of the "
+                            "only samples to extract. If sample names are "
+                            "also given, only samples in both are "
+                            "extracted."),
+        'where': ("SQLite WHERE clause selecting the ids of the sample "
+                  "metadata to extract. By default, every id is used."),
+        'profile_memory': ("True to print the peak RSS and the memory "
+                           "allocated by each extraction stage as JSON "
+                           "to stdout. Default is False.")},
     outputs=[('table', FeatureTable[Frequency]),
              ('taxonomy', FeatureData[Taxonomy])],
     output_descriptions={
         'table': 'Output feature table.',
         'taxonomy': 'Output feature metadata.'},
 )
+
+plugin.methods.register_function(
+    function=extract_batch,
+    name='Extract and merge SURPI data from many runs for use in QIIME.',
+    description=(
+        'Extract the SURPI data of many runs into one merged feature table '
+        'and one deduplicated feature taxonomy.'),
+    inputs={'surpi_outputs': List[SurpiCountTable],
+            'surpi_sample_infos': List[SurpiSampleSheet]},
+    input_descriptions={
+        'surpi_outputs': "SURPI counts per species per barcode for each run.",
+        'surpi_sample_infos': ('Info linking sample ids to barcodes for each '
+                               'run, in the same order as the counts.')},
+    parameters={'ids_are_barcodes': Bool,
+                'chunk_size': Int % Range(1, None),
+                'n_jobs': Int % Range(1, None),
+                'collapse_duplicates': Bool,
+                'collapse_level': Str % Choices(*COLLAPSE_LEVELS),
+                'include_tags': List[Str],
+                'exclude_tags': List[Str],
+                'min_total_count': Int % Range(0, None),
+                'min_prevalence': Int % Range(0, None),
+                'min_sample_depth': Int % Range(0, None),
+                'profile_memory': Bool},
+    parameter_descriptions={
+        'ids_are_barcodes': ("True if the sample ids in the count tables are "
+                             "barcodes. False if they are the sample sheet's "
+                             "sample ids. Default is True."),
+        'chunk_size': ("Number of count table rows read and converted at a "
+                       "time. Peak memory use depends on this rather than "
+                       "on the size of the count tables."),
+        'n_jobs': ("Number of worker processes that extract runs in "
+                   "parallel, one run per worker. Default is 1."),
+        'collapse_duplicates': ("True to sum the counts of count table rows "
+                                "with the same feature id and list all of "
+                                "each feature's tags in the taxonomy's Tags "
+                                "column. False to reject such rows. Default "
+                                "is False."),
+        'collapse_level': ("Rank to which the counts are rolled up while "
+                           "they are extracted: 'species' for one feature "
+                           "per species, genus and family, 'genus' for one "
+                           "per genus and family, or 'family' for one per "
+                           "family. Default is 'species'."),
+        'include_tags': ("Regular expressions; only count table rows whose "
+                         "tag matches at least one of them are extracted. "
+                         "By default, rows with any tag are extracted."),
+        'exclude_tags': ("Regular expressions; count table rows whose tag "
+                         "matches any of them are skipped as the count "
+                         "table is read. By default, no rows are skipped."),
+        'min_total_count': ("Features whose total count across all samples "
+                            "is below this are removed. Default is 0."),
+        'min_prevalence': ("Features with a nonzero count in fewer samples "
+                           "than this are removed. Default is 0."),
+        'min_sample_depth': ("Samples whose total count, after features are "
+                             "removed, is below this are removed. Default "
+                             "is 0."),
+        'profile_memory': ("True to print the peak RSS and the memory "
+                           "allocated by each extraction stage as JSON "
+                           "to stdout. Worker processes are not profiled. "
+                           "Default is False.")},
+    outputs=[('table', FeatureTable[Frequency]),
+             ('taxonomy', FeatureData[Taxonomy])],
+    output_descriptions={
+        'table': 'Output feature table merged across all runs.',
+        'taxonomy': 'Output feature metadata for every feature in any run.'},
+)
+
+plugin.methods.register_function(
+    function=extract_append,
+    name='Add a new SURPI run to an existing feature table and taxonomy.',
+    description=(
+        'Extract the SURPI data of one new run and add its samples and any '
+        'new features to a feature table and taxonomy made by an earlier '
+        'extraction. Only the new run is parsed; the existing counts are '
+        'reused as they are, and existing features keep their order.'),
+    inputs={'existing_table': FeatureTable[Frequency],
+            'existing_taxonomy': FeatureData[Taxonomy],
+            'surpi_output': SurpiCountTable,
+            'surpi_sample_info': SurpiSampleSheet},
+    input_descriptions={
+        'existing_table': 'Feature table made by an earlier extraction.',
+        'existing_taxonomy': ('Feature taxonomy made by the same earlier '
+                              'extraction.'),
+        'surpi_output': "SURPI counts per species per barcode for the new "
+                        "run.",
+        'surpi_sample_info': ('Info linking sample ids to barcodes for the '
+                              'new run.')},
+    parameters={'ids_are_barcodes': Bool,
+                'chunk_size': Int % Range(1, None),
+                'collapse_duplicates': Bool,
+                'collapse_level': Str % Choices(*COLLAPSE_LEVELS),
+                'include_tags': List[Str],
+                'exclude_tags': List[Str],
+                'profile_memory': Bool},
+    parameter_descriptions={
+        'ids_are_barcodes': ("True if the sample ids in the count table are "
+                             "barcodes. False if they are the sample sheet's "
+                             "sample ids. Default is True."),
+        'chunk_size': ("Number of count table rows read and converted at a "
+                       "time. Peak memory use depends on this rather than "
+                       "on the size of the count table."),
+        'collapse_duplicates': ("True to sum the counts of count table rows "
+                                "with the same feature id and list all of "
+                                "each feature's tags in the taxonomy's Tags "
+                                "column. False to reject such rows. Default "
+                                "is False."),
+        'collapse_level': ("Rank to which the counts are rolled up while "
+                           "they are extracted: 'species' for one feature "
+                           "per species, genus and family, 'genus' for one "
+                           "per genus and family, or 'family' for one per "
+                           "family. Default is 'species'."),
+        'include_tags': ("Regular expressions; only count table rows whose "
+                         "tag matches at least one of them are extracted. "
+                         "By default, rows with any tag are extracted."),
+        'exclude_tags': ("Regular expressions; count table rows whose tag "
+                         "matches any of them are skipped as the count "
+                         "table is read. By default, no rows are skipped."),
+        'profile_memory': ("True to print the peak RSS and the memory "
+                           "allocated by each extraction stage as JSON "
+                           "to stdout. Default is False.")},
+    outputs=[('table', FeatureTable[Frequency]),
+             ('taxonomy', FeatureData[Taxonomy])],
+    output_descriptions={
+        'table': 'Output feature table with the existing and new samples.',
+        'taxonomy': 'Output feature metadata for every existing and new '
+                    'feature.'},
+)
@@ -0,0 +1,207 @@
+import contextlib
+import io
+import os
+import unittest.mock
+from qiime2.plugin.testing import TestPluginBase
+from q2_surpi import __package_name__
+from q2_surpi._cache import get_file_digest, get_result_key, \
+    get_result_dir, list_cache_entries, evict_cache, clear_cache, \
+    store_result_files, main, RESULTS_DIRNAME, TEMP_SUFFIX, \
+    CACHE_MAX_BYTES_ENV_VAR, RESULT_CACHE_MAX_BYTES_ENV_VAR, \
+    ARROW_CACHE_EXT, MATRIX_CACHE_EXT, COUNTTABLE_ENTRIES, RESULT_ENTRIES, \
+    get_cache_max_bytes
+
+
+def _entry_name(char, ext=""):
+    # cache entries are named by sha256 hex digests
+    return char * 64 + ext
+
+
+class TestCache(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = os.path.join(self.temp_dir.name, "cache")
+        os.makedirs(self.cache_dir)
+
+    def _make_entry(self, fname, num_bytes, mtime):
+        entry_fp = os.path.join(self.cache_dir, fname)
+        with open(entry_fp, "wb") as f:
+            f.write(b"0" * num_bytes)
+        os.utime(entry_fp, (mtime, mtime))
+        return entry_fp
+
+    def test_get_file_digest(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        copy_fp = self._make_entry("copy", 0, 0)
+        with open(input_fp, "rb") as in_f, open(copy_fp, "wb") as out_f:
+            out_f.write(in_f.read())
+
+        self.assertEqual(get_file_digest(input_fp, block_size=7),
+                         get_file_digest(copy_fp))
+        self.assertEqual(len(get_file_digest(input_fp)), 64)
+
+    def test_get_result_key(self):
+        key = get_result_key("extract", ["a", "b"], {"x": True})
+
+        self.assertEqual(key, get_result_key("extract", ["a", "b"],
+                                             {"x": True}))
+        for other_key in [get_result_key("other", ["a", "b"], {"x": True}),
+                          get_result_key("extract", ["b", "a"], {"x": True}),
+                          get_result_key("extract", ["a", "b"],
+                                         {"x": False})]:
+            self.assertNotEqual(key, other_key)
+
+    def test_list_cache_entries(self):
+        newer_fp = self._make_entry(_entry_name("b", ARROW_CACHE_EXT), 5, 2000)
+        older_fp = self._make_entry(_entry_name("a", ARROW_CACHE_EXT), 3, 1000)
+        self._make_entry("partial" + TEMP_SUFFIX, 100, 500)
+        self._make_entry("notes.txt", 100, 500)
+        result_dir = get_result_dir(self.cache_dir, _entry_name("c"))
+        os.makedirs(result_dir)
+        with open(os.path.join(result_dir, "counts.npz"), "wb") as f:
+            f.write(b"0" * 7)
+        os.utime(result_dir, (1500, 1500))
+
+        obs_entries = list_cache_entries(self.cache_dir)
+
+        self.assertEqual([x[:2] for x in obs_entries],
+                         [(older_fp, 3), (result_dir, 7), (newer_fp, 5)])
+        self.assertEqual(list_cache_entries(
+            os.path.join(self.temp_dir.name, "missing")), [])
+
+    def test_evict_cache(self):
+        oldest_fp = self._make_entry(_entry_name("a", ARROW_CACHE_EXT),
+                                     10, 1000)
+        middle_fp = self._make_entry(_entry_name("b", ARROW_CACHE_EXT),
+                                     10, 2000)
+        newest_fp = self._make_entry(_entry_name("c", MATRIX_CACHE_EXT),
+                                     10, 3000)
+
+        obs_removed = evict_cache(self.cache_dir, max_bytes=15,
+                                  keep_fps=[oldest_fp])
+
+        # the oldest entry is kept, so the next oldest ones go instead
+        self.assertEqual(obs_removed, [middle_fp, newest_fp])
+        self.assertTrue(os.path.exists(oldest_fp))
+        self.assertEqual(evict_cache(self.cache_dir, max_bytes=10), [])
+
+    def test_clear_cache(self):
+        self._make_entry(_entry_name("a", ARROW_CACHE_EXT), 10, 1000)
+        os.makedirs(get_result_dir(self.cache_dir, _entry_name("b")))
+
+        self.assertEqual(clear_cache(self.cache_dir), 2)
+        self.assertEqual(os.listdir(self.cache_dir), [RESULTS_DIRNAME])
+
+    def test_foreign_files_are_kept(self):
+        # the cache directory may be shared with files the cache didn't write
+        foreign_fps = [
+            self._make_entry("thesis.docx", 100, 1000),
+            self._make_entry("abc" + ARROW_CACHE_EXT, 100, 1000),
+            self._make_entry(_entry_name("a", ".docx"), 100, 1000)]
+        os.makedirs(os.path.join(self.cache_dir, RESULTS_DIRNAME))
+        foreign_fps.append(self._make_entry(
+            os.path.join(RESULTS_DIRNAME, "summary.csv"), 100, 1000))
+        entry_fp = self._make_entry(
+            _entry_name("b", ARROW_CACHE_EXT), 10, 2000)
+
+        self.assertEqual([x[0] for x in list_cache_entries(self.cache_dir)],
+                         [entry_fp])
+        self.assertEqual(evict_cache(self.cache_dir, max_bytes=0),
+                         [entry_fp])
+        with contextlib.redirect_stdout(io.StringIO()):
+            main(["trim", "--cache-dir", self.cache_dir, "--max-bytes", "0"])
+            main(["clear", "--cache-dir", self.cache_dir])
+        for curr_fp in foreign_fps:
+            self.assertTrue(os.path.exists(curr_fp))
+
+    def _make_result_entry(self, key, num_bytes, mtime):
+        result_dir = get_result_dir(self.cache_dir, key)
+        os.makedirs(result_dir)
+        with open(os.path.join(result_dir, "counts.npz"), "wb") as f:
+            f.write(b"0" * num_bytes)
+        os.utime(result_dir, (mtime, mtime))
+        return result_dir
+
+    def test_store_result_files(self):
+        counttable_fp = self._make_entry(
+            _entry_name("a", ARROW_CACHE_EXT), 100, 1000)
+        old_result_dir = self._make_result_entry(_entry_name("c"), 10, 1000)
+        key = _entry_name("b")
+
+        def write_fn(result_dir):
+            with open(os.path.join(result_dir, "result.txt"), "w") as f:
+                f.write("a" * 20)
+
+        with unittest.mock.patch.dict(
+                os.environ, {CACHE_MAX_BYTES_ENV_VAR: "0",
+                             RESULT_CACHE_MAX_BYTES_ENV_VAR: "25"}):
+            store_result_files(self.cache_dir, key, write_fn)
+
+        result_dir = get_result_dir(self.cache_dir, key)
+        self.assertEqual(os.listdir(result_dir), ["result.txt"])
+        # no partly written results are left, and the oldest result was
+        # evicted to make room; parsed counttables have their own limit, so
+        # storing a result never evicts them
+        self.assertEqual(os.listdir(os.path.dirname(result_dir)), [key])
+        self.assertFalse(os.path.exists(old_result_dir))
+        self.assertTrue(os.path.exists(counttable_fp))
+
+    def test_evict_cache_kinds(self):
+        counttable_fp = self._make_entry(
+            _entry_name("a", ARROW_CACHE_EXT), 100, 1000)
+        result_dir = self._make_result_entry(_entry_name("b"), 100, 2000)
+
+        self.assertEqual(
+            [x[0] for x in list_cache_entries(self.cache_dir,
+                                              COUNTTABLE_ENTRIES)],
+            [counttable_fp])
+        self.assertEqual(
+            [x[0] for x in list_cache_entries(self.cache_dir,
+                                              RESULT_ENTRIES)],
+            [result_dir])
+        # each kind is trimmed to its own limit
+        with unittest.mock.patch.dict(
+                os.environ, {CACHE_MAX_BYTES_ENV_VAR: "100",
+                             RESULT_CACHE_MAX_BYTES_ENV_VAR: "99"}):
+            self.assertEqual(evict_cache(self.cache_dir), [result_dir])
+        self.assertTrue(os.path.exists(counttable_fp))
+
+    def test_get_cache_max_bytes(self):
+        with unittest.mock.patch.dict(
+                os.environ, {CACHE_MAX_BYTES_ENV_VAR: " 42 ",
+                             RESULT_CACHE_MAX_BYTES_ENV_VAR: ""}):
+            self.assertEqual(get_cache_max_bytes(), 42)
+            self.assertEqual(get_cache_max_bytes(RESULT_ENTRIES), 2 ** 30)
+
+        for curr_value in ["-1", "10GB", "1.5"]:
+            with unittest.mock.patch.dict(
+                    os.environ, {CACHE_MAX_BYTES_ENV_VAR: curr_value}), \
+                    self.assertRaisesRegex(
+                        ValueError,
+                        f"Expected {CACHE_MAX_BYTES_ENV_VAR} to be a "
+                        f"non-negative integer, but got '{curr_value}'"):
+                get_cache_max_bytes()
+        # endfor each invalid value
+
+    def test_main(self):
+        a_fname = _entry_name("a", ARROW_CACHE_EXT)
+        b_fname = _entry_name("b", ARROW_CACHE_EXT)
+        self._make_entry(a_fname, 10, 1000)
+        self._make_entry(b_fname, 10, 2000)
+
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            main(["info", "--cache-dir", self.cache_dir])
+        self.assertIn(a_fname, stdout.getvalue())
+        self.assertIn("2 entries, 20 bytes", stdout.getvalue())
+
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            main(["trim", "--cache-dir", self.cache_dir, "--max-bytes", "10"])
+        self.assertIn("Removed 1 entries", stdout.getvalue())
+        self.assertEqual(os.listdir(self.cache_dir), [b_fname])
+
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            main(["clear", "--cache-dir", self.cache_dir])
+        self.assertIn("Removed 1 entries", stdout.getvalue())
+        self.assertEqual(os.listdir(self.cache_dir), [])
@@ -0,0 +1,44 @@
+import unittest
+from qiime2.plugin.testing import TestPluginBase
+from q2_surpi import __package_name__
+from q2_surpi._compression import get_compression, get_zstandard, \
+    open_decompressed
+
+
+class TestCompression(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def setUp(self):
+        super().setUp()
+        with open(self.get_data_path("surpi_output.counttable"), "rb") as f:
+            self.expected_bytes = f.read()
+
+    def test_get_compression(self):
+        for fname, expected_compression in [
+                ("surpi_output.counttable", None),
+                ("surpi_output.counttable.gz", "gzip"),
+                ("surpi_output.counttable.bz2", "bz2"),
+                ("surpi_output.counttable.zst", "zstd")]:
+            self.assertEqual(get_compression(self.get_data_path(fname)),
+                             expected_compression)
+
+    def test_open_decompressed(self):
+        fnames = ["surpi_output.counttable", "surpi_output.counttable.gz",
+                  "surpi_output.counttable.bz2"]
+        if get_zstandard() is not None:
+            fnames.append("surpi_output.counttable.zst")
+
+        for curr_fname in fnames:
+            with open_decompressed(self.get_data_path(curr_fname)) as f:
+                self.assertEqual(f.read(), self.expected_bytes)
+            with open_decompressed(self.get_data_path(curr_fname), "r") as f:
+                self.assertEqual(f.readline(),
+                                 self.expected_bytes.decode().split("\n")[0] +
+                                 "\n")
+        # endfor each file
+
+    @unittest.skipIf(get_zstandard() is not None, "zstandard is installed")
+    def test_open_decompressed_no_zstandard(self):
+        with self.assertRaisesRegex(ImportError, "zstandard is required"):
+            open_decompressed(
+                self.get_data_path("surpi_output.counttable.zst"))
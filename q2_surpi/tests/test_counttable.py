@@ -0,0 +1,332 @@
+import os
+import unittest
+import numpy as np
+import pandas
+from pandas.testing import assert_frame_equal
+from qiime2.plugin.testing import TestPluginBase
+from q2_surpi import __package_name__, SurpiCountTableReader, \
+    SurpiCountMatrix
+from q2_surpi._formats_and_types import (
+    SPECIES_KEY, GENUS_KEY, FAMILY_KEY, TAG_KEY)
+from q2_surpi._counttable import get_sample_columns, \
+    iter_counttable_chunks, write_arrow_cache, get_cached_arrow_fp, \
+    write_count_matrix, get_count_matrix, get_compact_count_dtype, \
+    compact_count_columns, read_compact_counttable
+from q2_surpi._cache import get_pyarrow
+
+
+class TestSurpiCountTableReader(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.input_fp = self.get_data_path("surpi_output.counttable")
+        self.expected_df = pandas.read_csv(self.input_fp, sep='\t', header=0)
+
+    def test_columns(self):
+        reader = SurpiCountTableReader(self.input_fp)
+
+        self.assertEqual(reader.columns, self.expected_df.columns.tolist())
+        self.assertEqual(reader.sample_columns,
+                         self.expected_df.columns[4:].tolist())
+        self.assertEqual(get_sample_columns(reader), reader.sample_columns)
+        self.assertEqual(get_sample_columns(self.expected_df),
+                         reader.sample_columns)
+
+    def test_iter_chunks(self):
+        reader = SurpiCountTableReader(self.input_fp)
+
+        obs_chunks = list(reader.iter_chunks(chunk_size=5))
+
+        self.assertEqual([len(x) for x in obs_chunks], [5, 5, 5, 1])
+        obs_df = pandas.concat(obs_chunks).astype(
+            {x: object for x in (GENUS_KEY, FAMILY_KEY, TAG_KEY)})
+        # the counts are not compacted, since extraction only keeps the
+        # nonzero ones
+        assert_frame_equal(obs_df, self.expected_df)
+
+    def test_iter_chunks_taxa_dtypes(self):
+        reader = SurpiCountTableReader(self.input_fp)
+
+        # the last chunk has no genus values at all, which would otherwise
+        # be read as a float column
+        last_chunk = list(reader.iter_chunks(chunk_size=5))[-1]
+
+        self.assertEqual(last_chunk[SPECIES_KEY].dtype, object)
+        for curr_key in (GENUS_KEY, FAMILY_KEY, TAG_KEY):
+            self.assertIsInstance(
+                last_chunk[curr_key].dtype, pandas.CategoricalDtype)
+
+    def test_iter_chunks_usecols(self):
+        reader = SurpiCountTableReader(self.input_fp)
+        # the counttable's column order is kept, whatever the order given
+        usecols = [reader.sample_columns[7], reader.sample_columns[2]]
+        expected_df = self.expected_df[
+            self.expected_df.columns[:4].tolist() + usecols[::-1]]
+
+        for curr_output in [reader, self.expected_df]:
+            obs_df = pandas.concat(
+                iter_counttable_chunks(curr_output, 5, usecols)).astype(
+                {x: object for x in (GENUS_KEY, FAMILY_KEY, TAG_KEY)})
+            assert_frame_equal(obs_df, expected_df, check_dtype=False)
+        # endfor each counttable view
+
+    def test_iter_counttable_chunks_dataframe(self):
+        obs_chunks = list(iter_counttable_chunks(self.expected_df, 7))
+
+        self.assertEqual([len(x) for x in obs_chunks], [7, 7, 2])
+        assert_frame_equal(pandas.concat(obs_chunks), self.expected_df)
+
+
+@unittest.skipIf(get_pyarrow() is None, "pyarrow is not installed")
+class TestArrowCache(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.input_fp = self.get_data_path("surpi_output.counttable")
+        self.expected_df = pandas.read_csv(self.input_fp, sep='\t', header=0)
+
+    def test_write_arrow_cache(self):
+        arrow_fp = os.path.join(self.temp_dir.name, "surpi_output.arrow")
+        write_arrow_cache(self.input_fp, arrow_fp, chunk_size=3)
+        reader = SurpiCountTableReader(self.input_fp, arrow_fp=arrow_fp)
+
+        obs_chunks = list(reader.iter_chunks(chunk_size=5))
+
+        self.assertEqual(reader.columns, self.expected_df.columns.tolist())
+        self.assertTrue(all(len(x) <= 5 for x in obs_chunks))
+        for curr_key in (GENUS_KEY, FAMILY_KEY, TAG_KEY):
+            self.assertIsInstance(
+                obs_chunks[0][curr_key].dtype, pandas.CategoricalDtype)
+        self.assertEqual(obs_chunks[0][reader.sample_columns[0]].dtype,
+                         np.uint32)
+        obs_df = pandas.concat(obs_chunks, ignore_index=True).astype(
+            {x: object for x in (GENUS_KEY, FAMILY_KEY, TAG_KEY)}).astype(
+            {x: np.int64 for x in reader.sample_columns})
+        assert_frame_equal(obs_df, self.expected_df)
+        # no temporary files are left behind
+        self.assertEqual(os.listdir(self.temp_dir.name),
+                         ["surpi_output.arrow"])
+
+    def test_iter_chunks_usecols(self):
+        arrow_fp = os.path.join(self.temp_dir.name, "surpi_output.arrow")
+        write_arrow_cache(self.input_fp, arrow_fp)
+        reader = SurpiCountTableReader(self.input_fp, arrow_fp=arrow_fp)
+        usecols = reader.sample_columns[3:5]
+
+        obs_df = pandas.concat(
+            reader.iter_chunks(chunk_size=5, usecols=usecols),
+            ignore_index=True)
+
+        self.assertEqual(obs_df.columns.tolist(),
+                         self.expected_df.columns[:4].tolist() + usecols)
+        assert_frame_equal(obs_df[usecols], self.expected_df[usecols],
+                           check_dtype=False)
+
+    def test_get_cached_arrow_fp(self):
+        cache_dir = os.path.join(self.temp_dir.name, "cache")
+        copy_fp = os.path.join(self.temp_dir.name, "copy.counttable")
+        with open(self.input_fp) as in_f, open(copy_fp, "w") as out_f:
+            out_f.write(in_f.read())
+
+        first_fp = get_cached_arrow_fp(self.input_fp, cache_dir)
+        first_inode = os.stat(first_fp).st_ino
+        second_fp = get_cached_arrow_fp(copy_fp, cache_dir)
+
+        # identical contents share one cache, which is not rewritten
+        self.assertEqual(first_fp, second_fp)
+        self.assertEqual(os.stat(second_fp).st_ino, first_inode)
+        self.assertEqual(os.listdir(cache_dir),
+                         [os.path.basename(first_fp)])
+
+        # changing the contents changes the cache, even if the parsed table
+        # would be the same
+        with open(copy_fp, "a") as f:
+            f.write("\n")
+        self.assertNotEqual(get_cached_arrow_fp(copy_fp, cache_dir), first_fp)
+
+    def test_reader_without_arrow_fp(self):
+        reader = SurpiCountTableReader(self.input_fp)
+
+        self.assertIsNone(reader.arrow_fp)
+
+
+class TestSurpiCountMatrix(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.input_fp = self.get_data_path("surpi_output.counttable")
+        self.expected_df = pandas.read_csv(self.input_fp, sep='\t', header=0)
+        self.sample_columns = self.expected_df.columns[4:].tolist()
+
+    def _assert_matrix_matches_input(self, obs_matrix):
+        self.assertIsInstance(obs_matrix.counts, np.memmap)
+        self.assertEqual(obs_matrix.counts.dtype, np.uint32)
+        self.assertTrue(obs_matrix.counts.flags.f_contiguous)
+        np.testing.assert_array_equal(
+            obs_matrix.counts,
+            self.expected_df[self.sample_columns].to_numpy())
+        self.assertEqual(obs_matrix.sample_columns, self.sample_columns)
+        self.assertEqual(obs_matrix.columns,
+                         self.expected_df.columns.tolist())
+        assert_frame_equal(
+            obs_matrix.taxa.astype(
+                {x: object for x in (GENUS_KEY, FAMILY_KEY, TAG_KEY)}),
+            self.expected_df[[SPECIES_KEY, GENUS_KEY, FAMILY_KEY, TAG_KEY]])
+
+    def test_write_count_matrix(self):
+        matrix_dir = os.path.join(self.temp_dir.name, "matrix")
+
+        write_count_matrix(SurpiCountTableReader(self.input_fp), matrix_dir,
+                           chunk_size=5)
+        obs_matrix = SurpiCountMatrix.load(matrix_dir)
+
+        self._assert_matrix_matches_input(obs_matrix)
+
+    @unittest.skipIf(get_pyarrow() is None, "pyarrow is not installed")
+    def test_write_count_matrix_from_arrow_cache(self):
+        arrow_fp = os.path.join(self.temp_dir.name, "surpi_output.arrow")
+        write_arrow_cache(self.input_fp, arrow_fp)
+        matrix_dir = os.path.join(self.temp_dir.name, "matrix")
+
+        write_count_matrix(
+            SurpiCountTableReader(self.input_fp, arrow_fp=arrow_fp),
+            matrix_dir, chunk_size=5)
+
+        self._assert_matrix_matches_input(SurpiCountMatrix.load(matrix_dir))
+
+    def test_write_count_matrix_out_of_range(self):
+        input_fp = os.path.join(self.temp_dir.name, "big.counttable")
+        big_df = self.expected_df.copy()
+        big_df.loc[12, self.sample_columns[0]] = 2 ** 32
+        big_df.to_csv(input_fp, sep='\t', index=False)
+
+        with self.assertRaisesRegex(
+                ValueError, r"Expected counts from 0 to 4294967295 in rows "
+                            r"10 to 14, but got counts outside that range"):
+            write_count_matrix(SurpiCountTableReader(input_fp),
+                               os.path.join(self.temp_dir.name, "matrix"),
+                               chunk_size=5)
+
+    def test_get_count_matrix_temporary(self):
+        obs_matrix = get_count_matrix(SurpiCountTableReader(self.input_fp))
+        matrix_dir = obs_matrix._temp_dir.name
+
+        self._assert_matrix_matches_input(obs_matrix)
+        obs_matrix._temp_dir.cleanup()
+        self.assertFalse(os.path.exists(matrix_dir))
+
+    def test_get_count_matrix_cached(self):
+        cache_dir = os.path.join(self.temp_dir.name, "cache")
+
+        first_matrix = get_count_matrix(
+            SurpiCountTableReader(self.input_fp), cache_dir=cache_dir)
+        second_matrix = get_count_matrix(
+            SurpiCountTableReader(self.input_fp), cache_dir=cache_dir)
+
+        self._assert_matrix_matches_input(second_matrix)
+        self.assertEqual(first_matrix.counts.filename,
+                         second_matrix.counts.filename)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def test_iter_chunks(self):
+        obs_matrix = get_count_matrix(SurpiCountTableReader(self.input_fp))
+
+        obs_chunks = list(iter_counttable_chunks(obs_matrix, 5))
+
+        self.assertEqual([len(x) for x in obs_chunks], [5, 5, 5, 1])
+        self.assertEqual(get_sample_columns(obs_matrix), self.sample_columns)
+        obs_df = pandas.concat(obs_chunks).astype(
+            {x: object for x in (GENUS_KEY, FAMILY_KEY, TAG_KEY)}).astype(
+            {x: np.int64 for x in self.sample_columns})
+        assert_frame_equal(obs_df, self.expected_df)
+
+    def test_iter_chunks_usecols(self):
+        obs_matrix = get_count_matrix(SurpiCountTableReader(self.input_fp))
+        usecols = self.sample_columns[8:]
+
+        obs_df = pandas.concat(iter_counttable_chunks(obs_matrix, 5, usecols))
+
+        self.assertEqual(obs_df.columns.tolist(),
+                         self.expected_df.columns[:4].tolist() + usecols)
+        assert_frame_equal(obs_df[usecols], self.expected_df[usecols],
+                           check_dtype=False)
+
+    def test_mismatched_shape(self):
+        with self.assertRaisesRegex(
+                ValueError, r"Expected counts of shape \(16, 10\), but got "
+                            r"\(16, 9\)"):
+            SurpiCountMatrix(
+                np.zeros((16, 9), dtype=np.uint32),
+                self.expected_df.iloc[:, :4], self.sample_columns)
+
+
+class TestCompactCountColumns(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def test_get_compact_count_dtype(self):
+        for max_count, expected_dtype in [
+                (0, np.uint8), (255, np.uint8), (256, np.uint16),
+                (65535, np.uint16), (65536, np.uint32),
+                (2 ** 32, np.uint64)]:
+            self.assertEqual(get_compact_count_dtype(max_count),
+                             expected_dtype)
+
+    def test_compact_count_columns(self):
+        input_df = pandas.DataFrame({
+            SPECIES_KEY: ["a", "b"], "s1": [0, 300], "s2": [1, 2]})
+
+        obs_df = compact_count_columns(input_df)
+
+        # one dtype is chosen for all the count columns
+        assert_frame_equal(obs_df, input_df.astype(
+            {"s1": np.uint16, "s2": np.uint16}))
+        self.assertEqual(input_df["s1"].dtype, np.int64)
+
+    def test_compact_count_columns_keeps_column_order(self):
+        input_df = pandas.DataFrame({
+            "s1": [0, 3], SPECIES_KEY: ["a", "b"], "s2": [1, 2]})
+
+        obs_df = compact_count_columns(input_df)
+
+        self.assertEqual(obs_df.columns.tolist(), ["s1", SPECIES_KEY, "s2"])
+        self.assertEqual(obs_df["s1"].dtype, np.uint8)
+
+    def test_compact_count_columns_unchanged(self):
+        # negative, missing and already-compact counts are left alone
+        for input_df in [
+                pandas.DataFrame({SPECIES_KEY: ["a"], "s1": [-1]}),
+                pandas.DataFrame({SPECIES_KEY: ["a", "b"], "s1": [1, None]}),
+                pandas.DataFrame({SPECIES_KEY: ["a"], "s1": [1]}).astype(
+                    {"s1": np.uint8}),
+                pandas.DataFrame({SPECIES_KEY: [], "s1": []})]:
+            self.assertIs(compact_count_columns(input_df), input_df)
+
+    def test_read_compact_counttable(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        input_df = pandas.read_csv(input_fp, sep='\t', header=0)
+
+        for curr_chunk_size in [1, 5, 100]:
+            obs_df = read_compact_counttable(
+                input_fp, chunk_size=curr_chunk_size)
+
+            assert_frame_equal(obs_df, compact_count_columns(input_df))
+        # endfor curr_chunk_size
+
+    def test_read_compact_counttable_chunk_dtypes(self):
+        # each count column takes the largest dtype of any of its chunks
+        input_fp = os.path.join(self.temp_dir.name, "test.counttable")
+        pandas.DataFrame({
+            SPECIES_KEY: ["a", "b", "c"], GENUS_KEY: ["g", "g", "g"],
+            FAMILY_KEY: ["f", "f", "f"], TAG_KEY: ["t;", "t;", "t;"],
+            "s1": [1, 2, 300], "s2": [3, 4, 5]}).to_csv(
+                input_fp, sep='\t', index=False)
+
+        obs_df = read_compact_counttable(input_fp, chunk_size=2)
+
+        self.assertEqual(obs_df["s1"].tolist(), [1, 2, 300])
+        self.assertEqual(obs_df["s1"].dtype, np.uint16)
+        self.assertEqual(obs_df["s2"].dtype, np.uint16)
+        self.assertEqual(obs_df.index.tolist(), [0, 1, 2])
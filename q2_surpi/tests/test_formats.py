@@ -1,5 +1,15 @@
+import gzip
+import os
+import unittest
+import unittest.mock
 from q2_surpi import (
-    __package_name__, SurpiCountTableFormat, SurpiSampleSheetFormat)
+    __package_name__, SurpiCountTableFormat, SurpiSampleSheetFormat,
+    SurpiCountTableCompressedFormat,
+    SurpiSampleSheetCompressedFormat)
+from q2_surpi._formats_and_types import SAMPLE_NAME_KEY, BARCODE_KEY, \
+    VALIDATION_JOBS_ENV_VAR
+from q2_surpi._compression import get_zstandard
+from pandas.testing import assert_frame_equal
 from qiime2.plugin import ValidationError
 from qiime2.plugin.testing import TestPluginBase
 
@@ -28,6 +38,171 @@ class TestSurpiCountTableFormat(TestPluginBase):
                 test_format = SurpiCountTableFormat(filepath, mode='r')
                 test_format.validate()
 
+    def test_surpicounttable_format_invalid_rows(self):
+        filenames = ['surpi_ragged_row.counttable',
+                     'surpi_noninteger_counts.counttable']
+        expected_msgs = [r'Expected 14 fields on line 9, but got 15',
+                         r"Expected integer counts on line 12, but got '2.5'"]
+
+        for filename, expected_msg in zip(filenames, expected_msgs):
+            filepath = self.get_data_path(filename)
+            with self.assertRaisesRegex(ValidationError, expected_msg):
+                test_format = SurpiCountTableFormat(filepath, mode='r')
+                test_format.validate(level='max')
+
+    def test_surpicounttable_format_min_reads_first_row_only(self):
+        # the problems in these files are after the first data row, so they
+        # are only caught by max validation
+        filenames = ['surpi_ragged_row.counttable',
+                     'surpi_noninteger_counts.counttable']
+        filepaths = [self.get_data_path(filename)
+                     for filename in filenames]
+
+        for filepath in filepaths:
+            test_format = SurpiCountTableFormat(filepath, mode='r')
+            test_format.validate(level='min')
+
+    def test_surpicounttable_format_validation_jobs_unused(self):
+        # the number of processes is only read for 'max' validation of a
+        # counttable large enough to be sharded
+        filepath = self.get_data_path('surpi_output.counttable')
+
+        with unittest.mock.patch.dict(
+                os.environ, {VALIDATION_JOBS_ENV_VAR: "two"}):
+            for curr_level in ['min', 'max']:
+                SurpiCountTableFormat(filepath, mode='r').validate(
+                    level=curr_level)
+            # endfor curr_level
+        # endwith
+
+
+class TestSurpiCountTableFormatSharded(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def setUp(self):
+        super().setUp()
+        # split even the small test files into several shards of a few lines
+        self.patchers = [
+            unittest.mock.patch(
+                "q2_surpi._formats_and_types.PARALLEL_VALIDATION_MIN_BYTES",
+                0),
+            unittest.mock.patch(
+                "q2_surpi._formats_and_types.VALIDATION_SHARD_BYTES", 200),
+            unittest.mock.patch.dict(
+                os.environ, {VALIDATION_JOBS_ENV_VAR: "2"})]
+        for curr_patcher in self.patchers:
+            curr_patcher.start()
+
+    def tearDown(self):
+        for curr_patcher in self.patchers:
+            curr_patcher.stop()
+        super().tearDown()
+
+    def _write_counttable(self, rows):
+        header = "species\tgenus\tfamily\ttag\tAAAA+CCCC\tGGGG+TTTT"
+        fp = os.path.join(self.temp_dir.name, "test.counttable")
+        with open(fp, "w") as f:
+            f.write("\n".join([header] + rows) + "\n")
+        return fp
+
+    def test_surpicounttable_format_valid(self):
+        filepath = self.get_data_path('surpi_output.counttable')
+
+        test_format = SurpiCountTableFormat(filepath, mode='r')
+        test_format.validate(level='max')
+
+    def test_surpicounttable_format_invalid_rows(self):
+        filenames = ['surpi_ragged_row.counttable',
+                     'surpi_noninteger_counts.counttable']
+        expected_msgs = [r'Expected 14 fields on line 9, but got 15',
+                         r"Expected integer counts on line 12, but got '2.5'"]
+
+        for filename, expected_msg in zip(filenames, expected_msgs):
+            filepath = self.get_data_path(filename)
+            with self.assertRaisesRegex(ValidationError, expected_msg):
+                test_format = SurpiCountTableFormat(filepath, mode='r')
+                test_format.validate(level='max')
+
+    def test_surpicounttable_format_first_bad_line(self):
+        # blank lines count toward line numbers but are otherwise skipped,
+        # and of two bad lines in different shards the earlier is reported
+        rows = [f"virus {i}\tgenus\tfamily\thost-bacteria;\t{i}\t0"
+                for i in range(100)]
+        rows[10] = ""
+        rows[40] = "\r"
+        rows[60] = "virus 60\tgenus\tfamily\thost-bacteria;\tx\t0"
+        rows[90] = "virus 90\tgenus\tfamily\thost-bacteria;\t1"
+        filepath = self._write_counttable(rows)
+
+        with self.assertRaisesRegex(
+                ValidationError,
+                r"Expected integer counts on line 62, but got 'x'"):
+            SurpiCountTableFormat(filepath, mode='r').validate(level='max')
+
+    def test_surpicounttable_format_blank_rows_only(self):
+        filepath = self._write_counttable([""] * 100)
+
+        with self.assertRaisesRegex(ValidationError,
+                                    r"Expected at least one row"):
+            SurpiCountTableFormat(filepath, mode='r').validate(level='max')
+
+    def test_surpicounttable_format_validation_jobs(self):
+        filepath = self.get_data_path('surpi_output.counttable')
+
+        for curr_value in ["auto", " 3 ", ""]:
+            with unittest.mock.patch.dict(
+                    os.environ, {VALIDATION_JOBS_ENV_VAR: curr_value}):
+                SurpiCountTableFormat(filepath, mode='r').validate(
+                    level='max')
+        # endfor each valid value
+
+        for curr_value in ["0", "-2", "two", "1.5"]:
+            with unittest.mock.patch.dict(
+                    os.environ, {VALIDATION_JOBS_ENV_VAR: curr_value}), \
+                    self.assertRaisesRegex(
+                        ValueError,
+                        f"Expected {VALIDATION_JOBS_ENV_VAR} to be a positive "
+                        f"integer or 'auto', but got '{curr_value}'"):
+                SurpiCountTableFormat(filepath, mode='r').validate(
+                    level='max')
+        # endfor each invalid value
+
+
+class TestSurpiCountTableCompressedFormat(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def test_surpicounttablecompressed_format_valid(self):
+        filenames = ['surpi_output.counttable.gz',
+                     'surpi_output.counttable.bz2']
+        if get_zstandard() is not None:
+            filenames.append('surpi_output.counttable.zst')
+
+        for filename in filenames:
+            for level in ('min', 'max'):
+                test_format = SurpiCountTableCompressedFormat(
+                    self.get_data_path(filename), mode='r')
+                test_format.validate(level=level)
+
+    def test_surpicounttablecompressed_format_uncompressed(self):
+        filepath = self.get_data_path('surpi_output.counttable')
+
+        with self.assertRaisesRegex(ValidationError,
+                                    r'Expected a gzip, bzip2 or zstandard'):
+            test_format = SurpiCountTableCompressedFormat(filepath, mode='r')
+            test_format.validate()
+
+    def test_surpicounttablecompressed_format_invalid_rows(self):
+        filepath = os.path.join(self.temp_dir.name, 'ragged.counttable.gz')
+        with open(self.get_data_path('surpi_ragged_row.counttable'),
+                  'rb') as in_f, gzip.open(filepath, 'wb') as out_f:
+            out_f.write(in_f.read())
+
+        test_format = SurpiCountTableCompressedFormat(filepath, mode='r')
+        test_format.validate(level='min')
+        with self.assertRaisesRegex(
+                ValidationError, r'Expected 14 fields on line 9, but got 15'):
+            test_format.validate(level='max')
+
 
 class TestSurpiSampleSheetFormat(TestPluginBase):
     package = f'{__package_name__}.tests'
@@ -57,3 +232,58 @@ class TestSurpiSampleSheetFormat(TestPluginBase):
             with self.assertRaisesRegex(ValidationError, r'Expected '):
                 test_format = SurpiSampleSheetFormat(filepath, mode='r')
                 test_format.validate()
+
+    def test_surpisamplesheet_format_trailing_section(self):
+        filepath = self.get_data_path(
+            'surpi_sample_info_trailing_section.csv')
+
+        test_format = SurpiSampleSheetFormat(filepath, mode='r')
+        test_format.validate()
+        obs_df = test_format.to_dataframe()
+
+        self.assertEqual(obs_df[SAMPLE_NAME_KEY].tolist(),
+                         ["sample-R-A1", "sample-R-B1"])
+        self.assertEqual(obs_df[BARCODE_KEY].tolist(),
+                         ["AGTAGTAA+TACTGATA", "TACTAAGG+CTGACTCG"])
+        self.assertEqual(obs_df["Lane"].tolist(), [1, 2])
+
+    def test_surpisamplesheet_format_parses_once(self):
+        filepath = self.get_data_path('surpi_sample_info.csv')
+
+        test_format = SurpiSampleSheetFormat(filepath, mode='r')
+        test_format.validate()
+
+        self.assertIs(test_format.to_dataframe(), test_format.to_dataframe())
+
+
+class TestSurpiSampleSheetCompressedFormat(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def test_surpisamplesheetcompressed_format_valid(self):
+        test_format = SurpiSampleSheetCompressedFormat(
+            self.get_data_path('surpi_sample_info.csv.gz'), mode='r')
+        test_format.validate()
+
+        expected_df = SurpiSampleSheetFormat(
+            self.get_data_path('surpi_sample_info.csv'),
+            mode='r').to_dataframe()
+        assert_frame_equal(test_format.to_dataframe(), expected_df)
+
+    def test_surpisamplesheetcompressed_format_uncompressed(self):
+        filepath = self.get_data_path('surpi_sample_info.csv')
+
+        with self.assertRaisesRegex(ValidationError,
+                                    r'Expected a gzip, bzip2 or zstandard'):
+            test_format = SurpiSampleSheetCompressedFormat(filepath, mode='r')
+            test_format.validate()
+
+    def test_surpisamplesheetcompressed_format_invalid(self):
+        filepath = os.path.join(self.temp_dir.name, 'missing_index.csv.gz')
+        with open(self.get_data_path('surpi_sample_info_missing_index.csv'),
+                  'rb') as in_f, gzip.open(filepath, 'wb') as out_f:
+            out_f.write(in_f.read())
+
+        with self.assertRaisesRegex(ValidationError,
+                                    r"Expected at least 'Sample_Name'"):
+            test_format = SurpiSampleSheetCompressedFormat(filepath, mode='r')
+            test_format.validate()
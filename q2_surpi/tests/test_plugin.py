@@ -1,11 +1,35 @@
+import contextlib
+import io
+import json
+import os
+import unittest
+import unittest.mock
+import biom
 import numpy as np
 import pandas
-from pandas.testing import assert_frame_equal
+import qiime2
+from pandas.testing import assert_frame_equal, assert_series_equal
 from qiime2.plugin.testing import TestPluginBase
-from q2_surpi import __package_name__
+from q2_surpi import __package_name__, SurpiCountTableReader
 from q2_surpi._formats_and_types import (
-    SPECIES_KEY, GENUS_KEY, FAMILY_KEY, TAG_KEY, SAMPLE_NAME_KEY, BARCODE_KEY)
-from q2_surpi._plugin import extract, SAMPLE_ID_KEY, TAXON_KEY, FEATURE_KEY
+    SPECIES_KEY, GENUS_KEY, FAMILY_KEY, TAG_KEY, SAMPLE_NAME_KEY, BARCODE_KEY,
+    SS_SAMPLE_ID_KEY, GENUS_LEVEL, FAMILY_LEVEL)
+from q2_surpi._cache import CACHE_DIR_ENV_VAR, CACHE_MAX_BYTES_ENV_VAR, \
+    COUNTTABLE_ENTRIES, RESULT_ENTRIES, get_pyarrow, list_cache_entries
+from q2_surpi._plugin import (
+    extract, extract_batch, extract_append, SAMPLE_ID_KEY, TAXON_KEY,
+    FEATURE_KEY, TAGS_KEY, UNASSIGNED_FEATURE_ID,
+    _generate_taxonomy_str, _generate_taxonomy_strs, _FeatureDictionary,
+    _extract_counts)
+from q2_surpi._counttable import TAXA_DTYPES, write_arrow_cache, \
+    get_count_matrix
+
+
+def _make_sample_info_df(barcodes):
+    # a sample sheet that links the i-th barcode to the sample name sample_i
+    return pandas.DataFrame({
+        SAMPLE_NAME_KEY: [f"sample_{i}" for i in range(len(barcodes))],
+        BARCODE_KEY: barcodes})
 
 
 class TestExtractSurpiData(TestPluginBase):
@@ -142,8 +166,899 @@ class TestExtractSurpiData(TestPluginBase):
             expected_taxonomy_dict, index=feature_ids)
         expected_taxonomy_df.index.name = FEATURE_KEY
 
-        obs_feature_table_df, obs_taxonomy_df = extract(
+        obs_feature_table, obs_taxonomy_df = extract(
             input_counts_df, input_sample_info_df)
 
-        assert_frame_equal(obs_feature_table_df, expected_counts_df)
+        self.assertIsInstance(obs_feature_table, biom.Table)
+        obs_feature_table_df = obs_feature_table.to_dataframe(dense=True).T
+        obs_feature_table_df.index.name = SAMPLE_ID_KEY
+        assert_frame_equal(obs_feature_table_df,
+                           expected_counts_df.astype(float))
+        assert_frame_equal(obs_taxonomy_df, expected_taxonomy_df)
+
+    def test_extract_chunked_reader(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        input_counts_df = pandas.read_csv(input_fp, sep='\t', header=0)
+        input_sample_info_df = _make_sample_info_df(
+            input_counts_df.columns[4:])
+
+        expected_table, expected_taxonomy_df = extract(
+            input_counts_df, input_sample_info_df)
+        obs_table, obs_taxonomy_df = extract(
+            SurpiCountTableReader(input_fp), input_sample_info_df,
+            chunk_size=3)
+
+        self.assertEqual(obs_table, expected_table)
+        assert_frame_equal(obs_taxonomy_df, expected_taxonomy_df)
+
+    @unittest.skipIf(get_pyarrow() is None, "pyarrow is not installed")
+    def test_extract_arrow_cache_reader(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        arrow_fp = os.path.join(self.temp_dir.name, "surpi_output.arrow")
+        write_arrow_cache(input_fp, arrow_fp)
+        input_sample_info_df = _make_sample_info_df(
+            SurpiCountTableReader(input_fp).sample_columns)
+
+        expected_table, expected_taxonomy_df = extract(
+            SurpiCountTableReader(input_fp), input_sample_info_df)
+        obs_table, obs_taxonomy_df = extract(
+            SurpiCountTableReader(input_fp, arrow_fp=arrow_fp),
+            input_sample_info_df, chunk_size=3)
+
+        self.assertEqual(obs_table, expected_table)
         assert_frame_equal(obs_taxonomy_df, expected_taxonomy_df)
+
+    def test_extract_count_matrix(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        input_sample_info_df = _make_sample_info_df(
+            SurpiCountTableReader(input_fp).sample_columns)
+
+        expected_table, expected_taxonomy_df = extract(
+            SurpiCountTableReader(input_fp), input_sample_info_df)
+        obs_table, obs_taxonomy_df = extract(
+            get_count_matrix(SurpiCountTableReader(input_fp)),
+            input_sample_info_df, chunk_size=3)
+
+        self.assertEqual(obs_table, expected_table)
+        assert_frame_equal(obs_taxonomy_df, expected_taxonomy_df)
+
+    def test_extract_counts_keep_read_dtype(self):
+        # the nonzero counts go into the sparse table in the dtype they are
+        # read in, with no compacting copy of each chunk, since biom holds
+        # them as floats in any case
+        input_fp = self.get_data_path("surpi_output.counttable")
+        input_counts_df = pandas.read_csv(input_fp, sep='\t', header=0)
+        input_sample_info_df = _make_sample_info_df(
+            input_counts_df.columns[4:])
+
+        obs_counts, _, _ = _extract_counts(
+            SurpiCountTableReader(input_fp), input_sample_info_df, True, 5)
+
+        self.assertEqual(obs_counts.dtype, np.int64)
+        self.assertEqual(obs_counts.sum(),
+                         input_counts_df.iloc[:, 4:].to_numpy().sum())
+
+    def test_extract_memoized(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        barcodes = SurpiCountTableReader(input_fp).sample_columns
+        input_sample_info_df = _make_sample_info_df(barcodes).assign(
+            **{SS_SAMPLE_ID_KEY: barcodes})
+        cache_dir = os.path.join(self.temp_dir.name, "cache")
+
+        expected_table, expected_taxonomy_df = extract(
+            SurpiCountTableReader(input_fp), input_sample_info_df)
+        with unittest.mock.patch.dict(
+                os.environ, {CACHE_DIR_ENV_VAR: cache_dir}):
+            first_table, first_taxonomy_df = extract(
+                SurpiCountTableReader(input_fp), input_sample_info_df)
+            # a hit returns the stored result without extracting again
+            with unittest.mock.patch(
+                    "q2_surpi._plugin._extract_counts",
+                    side_effect=AssertionError("extracted again")):
+                obs_table, obs_taxonomy_df = extract(
+                    SurpiCountTableReader(input_fp), input_sample_info_df,
+                    chunk_size=3)
+            # a different parameter is a different result
+            extract(SurpiCountTableReader(input_fp), input_sample_info_df,
+                    ids_are_barcodes=False)
+        # endwith cache dir set
+
+        for curr_table, curr_taxonomy_df in [
+                (first_table, first_taxonomy_df),
+                (obs_table, obs_taxonomy_df)]:
+            self.assertEqual(curr_table, expected_table)
+            assert_frame_equal(curr_taxonomy_df, expected_taxonomy_df)
+        self.assertEqual(len(list_cache_entries(cache_dir)), 2)
+
+    @unittest.skipIf(get_pyarrow() is None, "pyarrow is not installed")
+    def test_extract_memoized_with_arrow_cache(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        input_sample_info_df = _make_sample_info_df(
+            SurpiCountTableReader(input_fp).sample_columns)
+        cache_dir = os.path.join(self.temp_dir.name, "cache")
+
+        # the parsed counttable alone is over its size limit, which must not
+        # evict the stored result, nor the result evict the parsed counttable
+        with unittest.mock.patch.dict(
+                os.environ, {CACHE_DIR_ENV_VAR: cache_dir,
+                             CACHE_MAX_BYTES_ENV_VAR: "1"}):
+            expected_table, _ = extract(
+                SurpiCountTableReader(input_fp, cache_dir=cache_dir),
+                input_sample_info_df)
+            with unittest.mock.patch(
+                    "q2_surpi._plugin._extract_counts",
+                    side_effect=AssertionError("extracted again")), \
+                    unittest.mock.patch(
+                        "q2_surpi._counttable.write_arrow_cache",
+                        side_effect=AssertionError("parsed again")):
+                for _ in range(3):
+                    obs_table, _ = extract(
+                        SurpiCountTableReader(input_fp, cache_dir=cache_dir),
+                        input_sample_info_df)
+                    self.assertEqual(obs_table, expected_table)
+                # endfor each repeated call
+        # endwith cache dir set
+
+        self.assertEqual(
+            len(list_cache_entries(cache_dir, COUNTTABLE_ENTRIES)), 1)
+        self.assertEqual(len(list_cache_entries(cache_dir, RESULT_ENTRIES)), 1)
+
+    def test_extract_profile_memory(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        input_sample_info_df = _make_sample_info_df(
+            SurpiCountTableReader(input_fp).sample_columns)
+
+        expected_table, _ = extract(
+            SurpiCountTableReader(input_fp), input_sample_info_df)
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            obs_table, _ = extract(
+                SurpiCountTableReader(input_fp), input_sample_info_df,
+                profile_memory=True)
+
+        self.assertEqual(obs_table, expected_table)
+        obs_profile = json.loads(stdout.getvalue())["memory_profile"]
+        self.assertEqual(
+            [x["stage"] for x in obs_profile["stages"]],
+            ["link_samples", "read_counts", "assemble_counts",
+             "filter_counts", "build_outputs"])
+        for curr_stage in obs_profile["stages"]:
+            self.assertGreaterEqual(curr_stage["peak_bytes"], 0)
+        self.assertGreater(obs_profile["max_rss_bytes"], 0)
+
+    def test_extract_collapse_duplicates(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        counts_df = pandas.read_csv(input_fp, sep='\t', header=0)
+        barcodes = counts_df.columns[4:].tolist()
+        sample_info_df = _make_sample_info_df(barcodes)
+        # the first feature appears twice more, once under a new tag
+        dup_rows_df = counts_df.iloc[[0, 0]].copy()
+        dup_rows_df[TAG_KEY] = ["host-plants;", "host-fungi;"]
+        dup_rows_df[barcodes[0]] = [3, 4]
+        dup_counts_df = pandas.concat(
+            [counts_df, dup_rows_df], ignore_index=True)
+
+        expected_df = counts_df.copy()
+        expected_df.loc[0, barcodes[0]] += 7
+        expected_table, expected_taxonomy_df = extract(
+            expected_df, sample_info_df)
+        with self.assertLogs("q2_surpi._plugin", level="INFO") as logs:
+            obs_table, obs_taxonomy_df = extract(
+                dup_counts_df, sample_info_df, chunk_size=5,
+                collapse_duplicates=True)
+
+        self.assertEqual(obs_table, expected_table)
+        assert_frame_equal(obs_taxonomy_df[[TAXON_KEY]], expected_taxonomy_df)
+        self.assertEqual(
+            obs_taxonomy_df[TAGS_KEY].iloc[0],
+            "host-apicomplexans|fungi|plants; host-plants; host-fungi;")
+        self.assertEqual(obs_taxonomy_df[TAGS_KEY].iloc[1], "host-bacteria;")
+        self.assertIn("Collapsed 3 counttable rows with duplicate feature ids "
+                      "into 1 features", "\n".join(logs.output))
+
+    def test_extract_collapse_duplicates_widens_dtype(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        counts_df = pandas.read_csv(input_fp, sep='\t', header=0)
+        sample_info_df = _make_sample_info_df(counts_df.columns[4:])
+        dup_counts_df = pandas.concat(
+            [counts_df, counts_df.iloc[:1]], ignore_index=True)
+        dup_counts_df.iloc[[0, -1], 4] = 200
+        dup_fp = os.path.join(self.temp_dir.name, "dup.counttable")
+        dup_counts_df.to_csv(dup_fp, sep='\t', index=False)
+
+        # the count matrix holds its counts as unsigned integers
+        obs_counts, _, _ = _extract_counts(
+            get_count_matrix(SurpiCountTableReader(dup_fp)), sample_info_df,
+            True, 5, True)
+
+        # each row fits in a uint8, but their sum does not
+        self.assertEqual(obs_counts.dtype, np.uint16)
+        self.assertEqual(obs_counts.tocsr()[0, 0], 400)
+
+    def test_extract_collapse_level_genus(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        counts_df = pandas.read_csv(input_fp, sep='\t', header=0)
+        barcodes = counts_df.columns[4:].tolist()
+        sample_info_df = _make_sample_info_df(barcodes)
+
+        # the same sums as grouping the dense table by genus and family
+        expected_df = counts_df.fillna(
+            {GENUS_KEY: "", FAMILY_KEY: ""}).groupby(
+            [GENUS_KEY, FAMILY_KEY], sort=False)[barcodes].sum()
+        expected_df.index = [f"{x}_{y}" for x, y in expected_df.index]
+        expected_df.columns = sample_info_df[SAMPLE_NAME_KEY]
+
+        obs_table, obs_taxonomy_df = extract(
+            SurpiCountTableReader(input_fp), sample_info_df,
+            chunk_size=5, collapse_level=GENUS_LEVEL)
+
+        assert_frame_equal(obs_table.to_dataframe(dense=True),
+                           expected_df.astype(float), check_names=False)
+        self.assertEqual(obs_taxonomy_df.index.tolist(),
+                         expected_df.index.tolist())
+        self.assertEqual(
+            obs_taxonomy_df.loc["Levivirus_Leviviridae", TAXON_KEY],
+            "f__Leviviridae; g__Levivirus;")
+        self.assertEqual(obs_taxonomy_df.loc["_Leviviridae", TAXON_KEY],
+                         "f__Leviviridae;")
+
+    def test_extract_collapse_level_family(self):
+        counts_df = pandas.DataFrame({
+            SPECIES_KEY: ["a", "b", "c", "d"],
+            GENUS_KEY: ["g1", "g2", np.nan, np.nan],
+            FAMILY_KEY: ["f1", "f1", np.nan, np.nan],
+            TAG_KEY: ["t1;", "t2;", "t1;", "t1;"],
+            "bc1": [1, 2, 3, 4],
+            "bc2": [0, 5, 0, 0]})
+        sample_info_df = pandas.DataFrame({
+            SAMPLE_NAME_KEY: ["s1", "s2"], BARCODE_KEY: ["bc1", "bc2"]})
+
+        obs_table, obs_taxonomy_df = extract(
+            counts_df, sample_info_df, collapse_duplicates=True,
+            collapse_level=FAMILY_LEVEL)
+
+        expected_table = biom.Table(
+            np.array([[3, 5], [7, 0]]), ["f1", UNASSIGNED_FEATURE_ID],
+            ["s1", "s2"])
+        expected_taxonomy_df = pandas.DataFrame(
+            {TAXON_KEY: ["f__f1;", UNASSIGNED_FEATURE_ID],
+             TAGS_KEY: ["t1; t2;", "t1;"]},
+            index=pandas.Index(["f1", UNASSIGNED_FEATURE_ID],
+                               name=FEATURE_KEY))
+        self.assertEqual(obs_table, expected_table)
+        assert_frame_equal(obs_taxonomy_df, expected_taxonomy_df)
+
+    def test_extract_collapse_level_genus_unassigned(self):
+        # rows with no genus and no family would otherwise get the id "_"
+        counts_df = pandas.DataFrame({
+            SPECIES_KEY: ["a", "b", "c", "d"],
+            GENUS_KEY: ["g1", np.nan, np.nan, np.nan],
+            FAMILY_KEY: ["f1", "f1", np.nan, np.nan],
+            TAG_KEY: ["t1;", "t1;", "t1;", "t2;"],
+            "bc1": [1, 2, 3, 4],
+            "bc2": [0, 5, 0, 6]})
+        sample_info_df = pandas.DataFrame({
+            SAMPLE_NAME_KEY: ["s1", "s2"], BARCODE_KEY: ["bc1", "bc2"]})
+
+        obs_table, obs_taxonomy_df = extract(
+            counts_df, sample_info_df, collapse_level=GENUS_LEVEL)
+
+        expected_table = biom.Table(
+            np.array([[1, 0], [2, 5], [7, 6]]),
+            ["g1_f1", "_f1", UNASSIGNED_FEATURE_ID], ["s1", "s2"])
+        expected_taxonomy_df = pandas.DataFrame(
+            {TAXON_KEY: ["f__f1; g__g1;", "f__f1;", UNASSIGNED_FEATURE_ID]},
+            index=pandas.Index(["g1_f1", "_f1", UNASSIGNED_FEATURE_ID],
+                               name=FEATURE_KEY))
+        self.assertEqual(obs_table, expected_table)
+        assert_frame_equal(obs_taxonomy_df, expected_taxonomy_df)
+
+    def test_extract_species_level_all_null_ranks(self):
+        # unlike the genus and family levels, a species-level row with no
+        # name at any rank keeps the id "__" and an empty taxon
+        counts_df = pandas.DataFrame({
+            SPECIES_KEY: ["a", np.nan],
+            GENUS_KEY: ["g1", np.nan],
+            FAMILY_KEY: ["f1", np.nan],
+            TAG_KEY: ["t1;", "t1;"],
+            "bc1": [1, 2],
+            "bc2": [0, 5]})
+        sample_info_df = pandas.DataFrame({
+            SAMPLE_NAME_KEY: ["s1", "s2"], BARCODE_KEY: ["bc1", "bc2"]})
+
+        obs_table, obs_taxonomy_df = extract(counts_df, sample_info_df)
+
+        expected_table = biom.Table(
+            np.array([[1, 0], [2, 5]]), ["a_g1_f1", "__"], ["s1", "s2"])
+        expected_taxonomy_df = pandas.DataFrame(
+            {TAXON_KEY: ["f__f1; g__g1; s__a;", ""]},
+            index=pandas.Index(["a_g1_f1", "__"], name=FEATURE_KEY))
+        self.assertEqual(obs_table, expected_table)
+        assert_frame_equal(obs_taxonomy_df, expected_taxonomy_df)
+
+    def test_extract_collapse_level_invalid(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        sample_info_df = _make_sample_info_df(
+            SurpiCountTableReader(input_fp).sample_columns)
+
+        with self.assertRaisesRegex(ValueError, r"collapse_level .*'order'"):
+            extract(SurpiCountTableReader(input_fp), sample_info_df,
+                    collapse_level="order")
+
+    def test_extract_tag_filters(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        counts_df = pandas.read_csv(input_fp, sep='\t', header=0)
+        counts_df.loc[[3, 7], TAG_KEY] = "host-vertebrates|plants;"
+        counts_df.loc[5, TAG_KEY] = np.nan
+        sample_info_df = _make_sample_info_df(counts_df.columns[4:])
+        tagged_fp = os.path.join(self.temp_dir.name, "tagged.counttable")
+        counts_df.to_csv(tagged_fp, sep='\t', index=False)
+
+        for curr_include, curr_exclude, curr_expected_rows in [
+                (["vertebrates"], None, [3, 7]),
+                (["plants", r"^host-bacteria;$"], ["vertebrates"],
+                 [0, 1, 2, 4, 6] + list(range(8, 16))),
+                (None, ["bacteria", "apicomplexans"], [3, 5, 7])]:
+            expected_table, expected_taxonomy_df = extract(
+                counts_df.loc[curr_expected_rows], sample_info_df)
+            # the categorical tags of the reader and the object tags of a
+            # DataFrame give the same result
+            for curr_output in [SurpiCountTableReader(tagged_fp), counts_df]:
+                with self.assertLogs(
+                        "q2_surpi._plugin", level="INFO") as logs:
+                    obs_table, obs_taxonomy_df = extract(
+                        curr_output, sample_info_df, chunk_size=4,
+                        include_tags=curr_include, exclude_tags=curr_exclude)
+
+                self.assertEqual(obs_table, expected_table)
+                assert_frame_equal(obs_taxonomy_df, expected_taxonomy_df)
+                self.assertIn(
+                    f"Excluded {16 - len(curr_expected_rows)} counttable "
+                    f"rows by tag", "\n".join(logs.output))
+            # endfor each counttable view
+        # endfor each filter
+
+    def test_extract_tag_filters_invalid(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        sample_info_df = _make_sample_info_df(
+            SurpiCountTableReader(input_fp).sample_columns)
+
+        with self.assertRaisesRegex(ValueError, r"valid regular expressions"):
+            extract(SurpiCountTableReader(input_fp), sample_info_df,
+                    exclude_tags=["host-(bacteria"])
+
+    def test_extract_filters(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        counts_df = pandas.read_csv(input_fp, sep='\t', header=0)
+        barcodes = counts_df.columns[4:].tolist()
+        sample_info_df = _make_sample_info_df(barcodes)
+        full_table, full_taxonomy_df = extract(counts_df, sample_info_df)
+        full_df = full_table.to_dataframe(dense=True)
+
+        for curr_total, curr_prevalence, curr_depth in [
+                (3, 0, 0), (0, 2, 0), (0, 0, 5), (2, 2, 10)]:
+            # the same as filtering the dense table features-first
+            expected_df = full_df.loc[
+                (full_df.sum(axis=1) >= curr_total) &
+                ((full_df > 0).sum(axis=1) >= curr_prevalence)]
+            expected_df = expected_df.loc[
+                :, expected_df.sum(axis=0) >= curr_depth]
+
+            with self.assertLogs("q2_surpi._plugin", level="INFO") as logs:
+                obs_table, obs_taxonomy_df = extract(
+                    SurpiCountTableReader(input_fp), sample_info_df,
+                    chunk_size=5, min_total_count=curr_total,
+                    min_prevalence=curr_prevalence,
+                    min_sample_depth=curr_depth)
+
+            assert_frame_equal(obs_table.to_dataframe(dense=True),
+                               expected_df, check_names=False)
+            assert_frame_equal(
+                obs_taxonomy_df,
+                full_taxonomy_df.loc[expected_df.index.tolist()])
+            self.assertIn(
+                f"Removed {len(full_df) - len(expected_df)} features and "
+                f"{10 - len(expected_df.columns)} samples",
+                "\n".join(logs.output))
+        # endfor each set of thresholds
+
+    def test_extract_filters_keep_tags(self):
+        counts_df = pandas.DataFrame({
+            SPECIES_KEY: ["a", "b", "a"],
+            GENUS_KEY: ["g1", "g2", "g1"],
+            FAMILY_KEY: ["f1", "f1", "f1"],
+            TAG_KEY: ["t1;", "t2;", "t3;"],
+            "bc1": [1, 1, 2],
+            "bc2": [0, 0, 4]})
+        sample_info_df = pandas.DataFrame({
+            SAMPLE_NAME_KEY: ["s1", "s2"], BARCODE_KEY: ["bc1", "bc2"]})
+
+        obs_table, obs_taxonomy_df = extract(
+            counts_df, sample_info_df, collapse_duplicates=True,
+            min_prevalence=2)
+
+        expected_table = biom.Table(
+            np.array([[3, 4]]), ["a_g1_f1"], ["s1", "s2"])
+        self.assertEqual(obs_table, expected_table)
+        self.assertEqual(obs_taxonomy_df[TAGS_KEY].tolist(), ["t1; t3;"])
+
+    def test_extract_sample_subset(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        reader = SurpiCountTableReader(input_fp)
+        sample_info_df = _make_sample_info_df(reader.sample_columns)
+        full_table, full_taxonomy_df = extract(reader, sample_info_df)
+        selected_names = ["sample_7", "sample_2", "sample_4"]
+        expected_table = full_table.filter(
+            selected_names, axis='sample', inplace=False)
+
+        outputs = [SurpiCountTableReader(input_fp), get_count_matrix(reader)]
+        if get_pyarrow() is not None:
+            arrow_fp = os.path.join(self.temp_dir.name, "surpi_output.arrow")
+            write_arrow_cache(input_fp, arrow_fp)
+            outputs.append(SurpiCountTableReader(input_fp, arrow_fp=arrow_fp))
+        for curr_output in outputs:
+            obs_table, obs_taxonomy_df = extract(
+                curr_output, sample_info_df, chunk_size=5,
+                sample_names=selected_names)
+
+            self.assertEqual(obs_table, expected_table)
+            assert_frame_equal(obs_taxonomy_df, full_taxonomy_df)
+        # endfor each counttable view
+
+    def test_extract_sample_subset_metadata(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        reader = SurpiCountTableReader(input_fp)
+        sample_info_df = _make_sample_info_df(reader.sample_columns)
+        sample_metadata = qiime2.Metadata(pandas.DataFrame(
+            {"cohort": ["a", "b", "a", "a"]},
+            index=pandas.Index(["sample_1", "sample_3", "sample_5",
+                                "sample_8"], name="sample-id")))
+        full_table, _ = extract(reader, sample_info_df)
+
+        obs_table, _ = extract(
+            reader, sample_info_df, sample_names=["sample_1", "sample_3",
+                                                  "sample_8"],
+            sample_metadata=sample_metadata, where="[cohort]='a'")
+
+        self.assertEqual(obs_table, full_table.filter(
+            ["sample_1", "sample_8"], axis='sample', inplace=False))
+
+    def test_extract_sample_subset_errors(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        barcodes = SurpiCountTableReader(input_fp).sample_columns
+        sample_info_df = pandas.DataFrame({
+            SAMPLE_NAME_KEY: [f"sample_{i}" for i in range(11)],
+            BARCODE_KEY: barcodes + ["AAAAAAAA+CCCCCCCC"]})
+
+        with self.assertRaisesRegex(
+                ValueError, r"(?s)not in the sample sheet: {'sample_12'}.*"
+                            r"not in the counttable: {'AAAAAAAA\+CCCCCCCC'}"):
+            extract(SurpiCountTableReader(input_fp), sample_info_df,
+                    sample_names=["sample_1", "sample_10", "sample_12"])
+        with self.assertRaisesRegex(ValueError, r"sample_metadata"):
+            extract(SurpiCountTableReader(input_fp), sample_info_df,
+                    where="[cohort]='a'")
+
+    def test_extract_sample_subset_empty(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        reader = SurpiCountTableReader(input_fp)
+        sample_info_df = _make_sample_info_df(reader.sample_columns)
+        sample_metadata = qiime2.Metadata(pandas.DataFrame(
+            {"cohort": ["a", "b"]},
+            index=pandas.Index(["sample_1", "sample_3"], name="sample-id")))
+
+        for curr_kwargs in [
+                {"sample_names": []},
+                {"sample_metadata": sample_metadata,
+                 "where": "[cohort]='c'"},
+                {"sample_names": ["sample_2"],
+                 "sample_metadata": sample_metadata}]:
+            with self.assertRaisesRegex(
+                    ValueError, r"Expected at least one sample to extract"):
+                extract(reader, sample_info_df, **curr_kwargs)
+        # endfor each selection of no samples
+
+    def test_extract_duplicate_features(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        counts_df = pandas.read_csv(input_fp, sep='\t', header=0)
+        sample_info_df = _make_sample_info_df(counts_df.columns[4:])
+        dup_counts_df = pandas.concat([counts_df, counts_df.iloc[:1]])
+
+        with self.assertRaisesRegex(ValueError, r"Dill cryptic virus 1"):
+            extract(dup_counts_df, sample_info_df)
+
+    def test_extract_unlinked_barcodes(self):
+        input_counts_df = pandas.DataFrame({
+            SPECIES_KEY: ["a virus"], GENUS_KEY: ["Avirus"],
+            FAMILY_KEY: ["Aviridae"], TAG_KEY: ["host-bacteria;"],
+            "AAAA+CCCC": [1], "GGGG+TTTT": [2]})
+        input_sample_info_df = pandas.DataFrame({
+            SAMPLE_NAME_KEY: ["sample_1"], BARCODE_KEY: ["AAAA+CCCC"]})
+
+        with self.assertRaisesRegex(ValueError, r"GGGG\+TTTT"):
+            extract(input_counts_df, input_sample_info_df)
+
+    def test_extract_duplicate_sample_sheet_ids(self):
+        input_counts_df = pandas.DataFrame({
+            SPECIES_KEY: ["a virus"], GENUS_KEY: ["Avirus"],
+            FAMILY_KEY: ["Aviridae"], TAG_KEY: ["host-bacteria;"],
+            "AAAA+CCCC": [1]})
+        input_sample_info_df = pandas.DataFrame({
+            SAMPLE_NAME_KEY: ["sample_1", "sample_2"],
+            BARCODE_KEY: ["AAAA+CCCC", "AAAA+CCCC"]})
+
+        with self.assertRaisesRegex(ValueError, r"more than once"):
+            extract(input_counts_df, input_sample_info_df)
+
+    def test_extract_unused_duplicate_sample_sheet_ids(self):
+        input_counts_df = pandas.DataFrame({
+            SPECIES_KEY: ["a virus"], GENUS_KEY: ["Avirus"],
+            FAMILY_KEY: ["Aviridae"], TAG_KEY: ["host-bacteria;"],
+            "AAAA+CCCC": [1]})
+        # the repeated barcode isn't in the counttable, so it is harmless
+        input_sample_info_df = pandas.DataFrame({
+            SAMPLE_NAME_KEY: ["sample_1", "sample_2", "sample_3"],
+            BARCODE_KEY: ["AAAA+CCCC", "GGGG+TTTT", "GGGG+TTTT"]})
+
+        obs_table, _ = extract(input_counts_df, input_sample_info_df)
+
+        self.assertEqual(obs_table.ids().tolist(), ["sample_1"])
+
+    def test_extract_unlinked_and_duplicate_ids(self):
+        input_counts_df = pandas.DataFrame({
+            SPECIES_KEY: ["a virus"], GENUS_KEY: ["Avirus"],
+            FAMILY_KEY: ["Aviridae"], TAG_KEY: ["host-bacteria;"],
+            "AAAA+CCCC": [1], "GGGG+TTTT": [2]})
+        input_sample_info_df = pandas.DataFrame({
+            SAMPLE_NAME_KEY: ["sample_1", "sample_2"],
+            BARCODE_KEY: ["AAAA+CCCC", "AAAA+CCCC"]})
+
+        # both problems are reported together
+        with self.assertRaisesRegex(
+                ValueError, r"(?s)GGGG\+TTTT.*more than once.*AAAA\+CCCC"):
+            extract(input_counts_df, input_sample_info_df)
+
+
+class TestExtractBatch(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def setUp(self):
+        super().setUp()
+        input_fp = self.get_data_path("surpi_output.counttable")
+        self.counts_df = pandas.read_csv(input_fp, sep='\t', header=0)
+        self.barcodes = self.counts_df.columns[4:].tolist()
+        self.sample_info_df = _make_sample_info_df(self.barcodes)
+
+    def test_extract_batch(self):
+        taxa_cols = self.counts_df.columns[:4].tolist()
+        # the two runs share features 5 through 9
+        run_1_df = self.counts_df.iloc[:10][taxa_cols + self.barcodes[:5]]
+        run_2_df = self.counts_df.iloc[5:][taxa_cols + self.barcodes[5:]]
+        run_1_info_df = self.sample_info_df.iloc[:5]
+        run_2_info_df = self.sample_info_df.iloc[5:]
+
+        # the merged result is the same as extracting the combined table in
+        # which each run has zero counts for the features it lacks
+        expected_df = self.counts_df.copy()
+        expected_df.loc[10:, self.barcodes[:5]] = 0
+        expected_df.loc[:4, self.barcodes[5:]] = 0
+        expected_table, expected_taxonomy_df = extract(
+            expected_df, self.sample_info_df)
+
+        obs_table, obs_taxonomy_df = extract_batch(
+            [run_1_df, run_2_df], [run_1_info_df, run_2_info_df],
+            chunk_size=4)
+
+        self.assertEqual(obs_table, expected_table)
+        assert_frame_equal(obs_taxonomy_df, expected_taxonomy_df)
+
+    def test_extract_batch_parallel(self):
+        run_dfs = [self.counts_df.iloc[:, :6], self.counts_df.iloc[:8, :4],
+                   pandas.concat([self.counts_df.iloc[3:, :4],
+                                  self.counts_df.iloc[3:, 6:]], axis=1)]
+        run_info_dfs = [self.sample_info_df.iloc[:2],
+                        self.sample_info_df.iloc[2:2],
+                        self.sample_info_df.iloc[2:]]
+
+        expected_table, expected_taxonomy_df = extract_batch(
+            run_dfs, run_info_dfs)
+        obs_table, obs_taxonomy_df = extract_batch(
+            run_dfs, run_info_dfs, n_jobs=2)
+
+        self.assertEqual(obs_table, expected_table)
+        assert_frame_equal(obs_taxonomy_df, expected_taxonomy_df)
+
+    def test_extract_batch_filters(self):
+        # feature 2 has a count of 1 in each run, so is only prevalent in
+        # the merged table
+        run_1_df = self.counts_df.iloc[:, :6].copy()
+        run_2_df = self.counts_df.iloc[:, list(range(4)) + [6, 7]].copy()
+        run_1_df.iloc[:, 4:] = 0
+        run_2_df.iloc[:, 4:] = 0
+        run_1_df.iloc[2, 4] = 1
+        run_2_df.iloc[2, 5] = 1
+        run_2_df.iloc[3, 5] = 1
+
+        obs_table, obs_taxonomy_df = extract_batch(
+            [run_1_df, run_2_df],
+            [self.sample_info_df.iloc[:2], self.sample_info_df.iloc[2:4]],
+            min_prevalence=2, min_sample_depth=1)
+
+        expected_table = biom.Table(
+            np.array([[1, 1]]), [obs_taxonomy_df.index[0]],
+            ["sample_0", "sample_3"])
+        self.assertEqual(obs_table, expected_table)
+        self.assertEqual(obs_taxonomy_df.index.tolist(),
+                         ["Dickeya phage phiDP10.3_Limestonevirus_"
+                          "Ackermannviridae"])
+
+    def test_extract_batch_mismatched_inputs(self):
+        with self.assertRaisesRegex(ValueError, r"one sample sheet per"):
+            extract_batch([self.counts_df, self.counts_df],
+                          [self.sample_info_df])
+
+    def test_extract_batch_duplicate_samples(self):
+        with self.assertRaisesRegex(ValueError, r"more than one run"):
+            extract_batch([self.counts_df, self.counts_df],
+                          [self.sample_info_df, self.sample_info_df])
+
+    def test_extract_batch_duplicate_features(self):
+        dup_counts_df = pandas.concat(
+            [self.counts_df, self.counts_df.iloc[:1]])
+
+        with self.assertRaisesRegex(ValueError, r"Dill cryptic virus 1"):
+            extract_batch([dup_counts_df], [self.sample_info_df])
+
+    def test_extract_batch_collapse_duplicates(self):
+        run_1_df = self.counts_df[self.counts_df.columns[:4].tolist() +
+                                  self.barcodes[:5]].copy()
+        run_2_df = pandas.concat(
+            [self.counts_df.iloc[:1], self.counts_df.iloc[:1]],
+            ignore_index=True)[self.counts_df.columns[:4].tolist() +
+                               self.barcodes[5:]]
+        run_2_df[TAG_KEY] = ["host-plants;", "host-fungi;"]
+
+        obs_table, obs_taxonomy_df = extract_batch(
+            [run_1_df, run_2_df],
+            [self.sample_info_df.iloc[:5], self.sample_info_df.iloc[5:]],
+            collapse_duplicates=True)
+
+        self.assertEqual(
+            obs_table.get_value_by_ids(
+                obs_taxonomy_df.index[0], "sample_5"),
+            2 * self.counts_df.iloc[0][self.barcodes[5]])
+        self.assertEqual(
+            obs_taxonomy_df[TAGS_KEY].iloc[0],
+            "host-apicomplexans|fungi|plants; host-plants; host-fungi;")
+        self.assertEqual(len(obs_taxonomy_df), len(self.counts_df))
+
+
+class TestExtractAppend(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def setUp(self):
+        super().setUp()
+        input_fp = self.get_data_path("surpi_output.counttable")
+        self.counts_df = pandas.read_csv(input_fp, sep='\t', header=0)
+        self.taxa_cols = self.counts_df.columns[:4].tolist()
+        self.barcodes = self.counts_df.columns[4:].tolist()
+        self.sample_info_df = _make_sample_info_df(self.barcodes)
+        # the new run shares features 5 through 9 with the existing one
+        self.existing_table, self.existing_taxonomy_df = extract(
+            self.counts_df.iloc[:10][self.taxa_cols + self.barcodes[:5]],
+            self.sample_info_df.iloc[:5])
+        self.new_run_df = \
+            self.counts_df.iloc[5:][self.taxa_cols + self.barcodes[5:]]
+
+    def test_extract_append(self):
+        expected_table, expected_taxonomy_df = extract_batch(
+            [self.counts_df.iloc[:10][self.taxa_cols + self.barcodes[:5]],
+             self.new_run_df],
+            [self.sample_info_df.iloc[:5], self.sample_info_df.iloc[5:]])
+
+        obs_table, obs_taxonomy_df = extract_append(
+            self.existing_table, self.existing_taxonomy_df, self.new_run_df,
+            self.sample_info_df.iloc[5:], chunk_size=4)
+
+        self.assertEqual(obs_table, expected_table)
+        assert_frame_equal(obs_taxonomy_df, expected_taxonomy_df)
+        # the existing features keep their place at the front
+        self.assertEqual(
+            obs_table.ids(axis='observation')[:10].tolist(),
+            self.existing_table.ids(axis='observation').tolist())
+
+    def test_extract_append_keeps_tags(self):
+        existing_table, existing_taxonomy_df = extract(
+            self.counts_df.iloc[:10][self.taxa_cols + self.barcodes[:5]],
+            self.sample_info_df.iloc[:5], collapse_duplicates=True)
+        new_run_df = self.new_run_df.copy()
+        new_run_df[TAG_KEY] = "host-plants;"
+
+        obs_table, obs_taxonomy_df = extract_append(
+            existing_table, existing_taxonomy_df, new_run_df,
+            self.sample_info_df.iloc[5:], collapse_duplicates=True)
+
+        # existing features gain the new run's tags; new features get only
+        # the new run's
+        self.assertEqual(obs_taxonomy_df[TAGS_KEY].tolist(),
+                         ["host-apicomplexans|fungi|plants;"] +
+                         ["host-bacteria;"] * 4 +
+                         ["host-bacteria; host-plants;"] * 5 +
+                         ["host-plants;"] * 6)
+
+    def test_extract_append_reordered_existing(self):
+        # the existing table's features need not be in taxonomy order
+        shuffled_ids = self.existing_table.ids(axis='observation')[::-1]
+        shuffled_table = self.existing_table.sort_order(
+            shuffled_ids, axis='observation')
+        expected_table, expected_taxonomy_df = extract_append(
+            self.existing_table, self.existing_taxonomy_df, self.new_run_df,
+            self.sample_info_df.iloc[5:])
+
+        obs_table, obs_taxonomy_df = extract_append(
+            shuffled_table, self.existing_taxonomy_df, self.new_run_df,
+            self.sample_info_df.iloc[5:])
+
+        self.assertEqual(obs_table, expected_table)
+        assert_frame_equal(obs_taxonomy_df, expected_taxonomy_df)
+
+    def test_extract_append_filtered_existing(self):
+        # features filtered out of the existing table, but still in its
+        # taxonomy, are not brought back
+        kept_ids = self.existing_table.ids(axis='observation')[3:]
+        filtered_table = self.existing_table.filter(
+            kept_ids, axis='observation', inplace=False)
+        expected_table, expected_taxonomy_df = extract_append(
+            filtered_table, self.existing_taxonomy_df.loc[kept_ids],
+            self.new_run_df, self.sample_info_df.iloc[5:])
+
+        obs_table, obs_taxonomy_df = extract_append(
+            filtered_table, self.existing_taxonomy_df, self.new_run_df,
+            self.sample_info_df.iloc[5:])
+
+        self.assertEqual(obs_table, expected_table)
+        assert_frame_equal(obs_taxonomy_df, expected_taxonomy_df)
+        self.assertEqual(obs_table.ids(axis='observation')[:7].tolist(),
+                         kept_ids.tolist())
+
+    def test_extract_append_missing_taxonomy(self):
+        with self.assertRaisesRegex(
+                ValueError, r"not in the existing taxonomy: .*Dill cryptic"):
+            extract_append(
+                self.existing_table, self.existing_taxonomy_df.iloc[1:],
+                self.new_run_df, self.sample_info_df.iloc[5:])
+
+    def test_extract_append_mismatched_settings(self):
+        tagged_table, tagged_taxonomy_df = extract(
+            self.counts_df.iloc[:10][self.taxa_cols + self.barcodes[:5]],
+            self.sample_info_df.iloc[:5], collapse_duplicates=True)
+        genus_table, genus_taxonomy_df = extract(
+            self.counts_df.iloc[:10][self.taxa_cols + self.barcodes[:5]],
+            self.sample_info_df.iloc[:5], collapse_level=GENUS_LEVEL)
+
+        for curr_table, curr_taxonomy_df, curr_kwargs, curr_msg in [
+                (tagged_table, tagged_taxonomy_df, {},
+                 r"without a Tags column, as collapse_duplicates is False"),
+                (self.existing_table, self.existing_taxonomy_df,
+                 {"collapse_duplicates": True},
+                 r"with a Tags column, as collapse_duplicates is True"),
+                (genus_table, genus_taxonomy_df, {},
+                 r"at the 'species' collapse level, but got one extracted "
+                 r"at the 'genus' level"),
+                (self.existing_table, self.existing_taxonomy_df,
+                 {"collapse_level": FAMILY_LEVEL},
+                 r"at the 'family' collapse level, but got one extracted "
+                 r"at the 'species' level")]:
+            with self.assertRaisesRegex(ValueError, curr_msg):
+                extract_append(
+                    curr_table, curr_taxonomy_df, self.new_run_df,
+                    self.sample_info_df.iloc[5:], **curr_kwargs)
+        # endfor each mismatched setting
+
+    def test_extract_append_collapse_level(self):
+        existing_table, existing_taxonomy_df = extract(
+            self.counts_df.iloc[:10][self.taxa_cols + self.barcodes[:5]],
+            self.sample_info_df.iloc[:5], collapse_level=GENUS_LEVEL)
+        expected_table, expected_taxonomy_df = extract_batch(
+            [self.counts_df.iloc[:10][self.taxa_cols + self.barcodes[:5]],
+             self.new_run_df],
+            [self.sample_info_df.iloc[:5], self.sample_info_df.iloc[5:]],
+            collapse_level=GENUS_LEVEL)
+
+        obs_table, obs_taxonomy_df = extract_append(
+            existing_table, existing_taxonomy_df, self.new_run_df,
+            self.sample_info_df.iloc[5:], collapse_level=GENUS_LEVEL)
+
+        self.assertEqual(obs_table, expected_table)
+        assert_frame_equal(obs_taxonomy_df, expected_taxonomy_df)
+
+    def test_extract_append_existing_samples(self):
+        with self.assertRaisesRegex(ValueError, r"more than one run"):
+            extract_append(
+                self.existing_table, self.existing_taxonomy_df,
+                self.counts_df.iloc[:, :6], self.sample_info_df.iloc[:2])
+
+
+class TestGenerateTaxonomyStrs(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def test_generate_taxonomy_strs_matches_rowwise(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        input_df = pandas.read_csv(input_fp, sep='\t', header=0)
+
+        expected = input_df.apply(
+            lambda x: _generate_taxonomy_str(x), axis=1)
+        obs = _generate_taxonomy_strs(input_df)
+
+        assert_series_equal(obs, expected)
+
+    def test_generate_taxonomy_strs_all_null_ranks(self):
+        input_df = pandas.DataFrame({
+            SPECIES_KEY: ["a virus", np.nan, np.nan],
+            GENUS_KEY: [np.nan, np.nan, np.nan],
+            FAMILY_KEY: ["Fooviridae", "Barviridae", np.nan]},
+            index=[3, 5, 7])
+
+        expected = pandas.Series(
+            ["f__Fooviridae; s__a virus;", "f__Barviridae;", ""],
+            index=[3, 5, 7])
+        obs = _generate_taxonomy_strs(input_df)
+
+        assert_series_equal(obs, expected)
+        assert_series_equal(
+            obs, input_df.apply(lambda x: _generate_taxonomy_str(x), axis=1))
+
+    def test_generate_taxonomy_strs_categorical(self):
+        input_fp = self.get_data_path("surpi_output.counttable")
+        input_df = pandas.read_csv(input_fp, sep='\t', header=0)
+        input_categorical_df = pandas.read_csv(
+            input_fp, sep='\t', header=0, dtype=TAXA_DTYPES)
+
+        expected = input_df.apply(
+            lambda x: _generate_taxonomy_str(x), axis=1)
+        obs = _generate_taxonomy_strs(input_categorical_df)
+
+        assert_series_equal(obs, expected)
+
+
+class TestFeatureDictionary(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def test_encode_decode(self):
+        feature_dict = _FeatureDictionary()
+
+        obs_codes_1 = feature_dict.encode(["a", "b", "c"],
+                                          ["t_a", "t_b", "t_c"])
+        obs_codes_2 = feature_dict.encode(["d", "b", "d", "e"],
+                                          ["t_d", "t_b", "t_d", "t_e"])
+
+        self.assertEqual(obs_codes_1.tolist(), [0, 1, 2])
+        self.assertEqual(obs_codes_2.tolist(), [3, 1, 3, 4])
+        self.assertEqual(len(feature_dict), 5)
+        self.assertEqual(feature_dict.feature_ids, ["a", "b", "c", "d", "e"])
+        self.assertEqual(feature_dict.taxa,
+                         ["t_a", "t_b", "t_c", "t_d", "t_e"])
+        self.assertEqual(feature_dict.decode([4, 0]), ["e", "a"])
+
+    def test_to_taxonomy_df(self):
+        feature_dict = _FeatureDictionary()
+        feature_dict.encode(["a", "b"], ["t_a", "t_b"])
+
+        expected_df = pandas.DataFrame(
+            {TAXON_KEY: ["t_a", "t_b"]},
+            index=pandas.Index(["a", "b"], name=FEATURE_KEY))
+
+        assert_frame_equal(feature_dict.to_taxonomy_df(), expected_df)
+
+    def test_to_taxonomy_df_tags(self):
+        feature_dict = _FeatureDictionary(keep_tags=True)
+        codes = feature_dict.encode(["a", "b", "a", "c"],
+                                    ["t_a", "t_b", "t_a", "t_c"])
+        feature_dict.add_tags(codes, ["x;", "y;", "z;", np.nan])
+        feature_dict.add_tags(codes[:1], ["x;"])
+
+        expected_df = pandas.DataFrame(
+            {TAXON_KEY: ["t_a", "t_b", "t_c"],
+             TAGS_KEY: ["x; z;", "y;", ""]},
+            index=pandas.Index(["a", "b", "c"], name=FEATURE_KEY))
+
+        assert_frame_equal(feature_dict.to_taxonomy_df(), expected_df)
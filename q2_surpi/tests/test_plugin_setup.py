@@ -1,3 +1,5 @@
+import subprocess
+import sys
 import unittest
 
 import q2_surpi
@@ -8,3 +10,63 @@ class PluginSetupTests(unittest.TestCase):
 
     def test_plugin_setup(self):
         self.assertEqual(surpi_plugin.name, q2_surpi.__plugin_name__)
+
+
+class ImportTimeTests(unittest.TestCase):
+
+    def _get_import_times(self, statement):
+        # Run the import in a fresh interpreter, since this one has already
+        # imported everything, and return the cumulative microseconds spent
+        # importing each module, as reported by -X importtime
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", statement],
+            capture_output=True, text=True, check=True)
+
+        import_times = {}
+        for curr_line in result.stderr.splitlines():
+            if not curr_line.startswith("import time:"):
+                continue
+            _, cumulative_us, module_name = curr_line.split("|")
+            if cumulative_us.strip().isdigit():
+                import_times[module_name.strip()] = int(cumulative_us)
+        # endfor each line of importtime output
+
+        return import_times
+
+    def test_import_package_is_lazy(self):
+        import_times = self._get_import_times("import q2_surpi")
+
+        self.assertIn("q2_surpi", import_times)
+        for curr_module in ["pandas", "numpy", "biom", "scipy", "pyarrow",
+                            "qiime2", "q2_surpi._plugin"]:
+            self.assertNotIn(curr_module, import_times)
+
+    def test_import_package_attribute(self):
+        import_times = self._get_import_times(
+            "from q2_surpi import SurpiCountTableFormat")
+
+        self.assertIn("q2_surpi._formats_and_types", import_times)
+        self.assertNotIn("q2_surpi._plugin", import_times)
+
+    def test_import_plugin_setup(self):
+        import_times = self._get_import_times("import q2_surpi.plugin_setup")
+
+        self.assertIn("q2_surpi.plugin_setup", import_times)
+        self.assertNotIn("q2_surpi._simulate", import_times)
+
+    def test_import_plugin_setup_adds_no_extraction_modules(self):
+        # qiime2 and q2_types are imported first, since every plugin pays
+        # for them; plugin_setup registers the extraction functions, but
+        # must not import anything heavy on top of them
+        statement = (
+            "import sys; import qiime2.plugin; "
+            "import q2_types.feature_table; import q2_types.feature_data; "
+            "before = set(sys.modules); import q2_surpi.plugin_setup; "
+            "print('\\n'.join(set(sys.modules) - before))")
+        result = subprocess.run([sys.executable, "-c", statement],
+                                capture_output=True, text=True, check=True)
+        new_modules = set(result.stdout.splitlines())
+
+        self.assertIn("q2_surpi.plugin_setup", new_modules)
+        for curr_module in ["biom", "scipy.sparse", "pyarrow"]:
+            self.assertNotIn(curr_module, new_modules)
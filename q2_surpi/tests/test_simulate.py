@@ -0,0 +1,93 @@
+import contextlib
+import filecmp
+import io
+import os
+import pandas
+from qiime2.plugin.testing import TestPluginBase
+from q2_surpi import __package_name__, SurpiCountTableReader
+from q2_surpi._formats_and_types import (
+    SurpiCountTableFormat, SurpiSampleSheetFormat, SPECIES_KEY, GENUS_KEY,
+    FAMILY_KEY, TAG_KEY)
+from q2_surpi._plugin import extract
+from q2_surpi._simulate import simulate_surpi_run, main, \
+    COUNTTABLE_FNAME, SAMPLE_SHEET_FNAME, PLACEHOLDER_SPECIES
+
+
+class TestSimulateSurpiRun(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.output_dir = os.path.join(self.temp_dir.name, "synthetic_run")
+
+    def test_simulate_surpi_run(self):
+        counttable_fp, sample_sheet_fp = simulate_surpi_run(
+            self.output_dir, 30, 500, density=0.05, seed=1)
+
+        self.assertEqual(os.path.basename(counttable_fp), COUNTTABLE_FNAME)
+        self.assertEqual(os.path.basename(sample_sheet_fp),
+                         SAMPLE_SHEET_FNAME)
+        SurpiCountTableFormat(counttable_fp, mode='r').validate(level='max')
+        sample_sheet = SurpiSampleSheetFormat(sample_sheet_fp, mode='r')
+        sample_sheet.validate(level='max')
+
+        counts_df = pandas.read_csv(counttable_fp, sep='\t', header=0)
+        self.assertEqual(counts_df.shape, (500, 34))
+        self.assertEqual(counts_df.columns[:4].tolist(),
+                         [SPECIES_KEY, GENUS_KEY, FAMILY_KEY, TAG_KEY])
+        counts = counts_df.iloc[:, 4:].to_numpy()
+        self.assertGreater((counts > 0).mean(), 0.03)
+        self.assertLess((counts > 0).mean(), 0.07)
+        self.assertGreater(counts_df[GENUS_KEY].isna().sum(), 0)
+        self.assertFalse(counts_df[SPECIES_KEY].duplicated().any())
+        self.assertEqual(len(sample_sheet.to_dataframe()), 30)
+
+        # the synthetic run goes through extract like a real one
+        table, taxonomy = extract(
+            SurpiCountTableReader(counttable_fp), sample_sheet.to_dataframe())
+        self.assertEqual(table.shape, (500, 30))
+        self.assertEqual(table.sum(), counts.sum())
+
+    def test_simulate_surpi_run_is_seeded(self):
+        first_fps = simulate_surpi_run(
+            os.path.join(self.output_dir, "first"), 10, 100, seed=7)
+        second_fps = simulate_surpi_run(
+            os.path.join(self.output_dir, "second"), 10, 100, seed=7)
+        third_fps = simulate_surpi_run(
+            os.path.join(self.output_dir, "third"), 10, 100, seed=8)
+
+        for first_fp, second_fp in zip(first_fps, second_fps):
+            self.assertTrue(filecmp.cmp(first_fp, second_fp, shallow=False))
+        self.assertFalse(
+            filecmp.cmp(first_fps[0], third_fps[0], shallow=False))
+
+    def test_simulate_surpi_run_quirks(self):
+        counttable_fp, _ = simulate_surpi_run(
+            self.output_dir, 5, 2000, nan_genus_rate=0, nan_family_rate=0.5,
+            duplicate_species_rate=0.1, placeholder_rate=0.1, seed=3)
+
+        counts_df = pandas.read_csv(counttable_fp, sep='\t', header=0)
+        is_placeholder = counts_df[SPECIES_KEY] == PLACEHOLDER_SPECIES
+        self.assertGreater(is_placeholder.sum(), 0)
+        self.assertTrue(counts_df.loc[is_placeholder, GENUS_KEY].isna().all())
+        self.assertTrue(
+            counts_df.loc[~is_placeholder, GENUS_KEY].notna().all())
+        self.assertAlmostEqual(counts_df[FAMILY_KEY].isna().mean(), 0.5,
+                               delta=0.05)
+
+        # duplicated species keep their names but not their tags
+        non_placeholder_df = counts_df.loc[~is_placeholder]
+        self.assertGreater(non_placeholder_df[SPECIES_KEY].duplicated().sum(),
+                           0)
+        self.assertFalse(non_placeholder_df.duplicated(
+            [SPECIES_KEY, GENUS_KEY, FAMILY_KEY, TAG_KEY]).any())
+
+    def test_main(self):
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            main([self.output_dir, "--barcodes", "4", "--taxa", "50",
+                  "--seed", "2"])
+
+        self.assertIn(COUNTTABLE_FNAME, stdout.getvalue())
+        counts_df = pandas.read_csv(
+            os.path.join(self.output_dir, COUNTTABLE_FNAME), sep='\t')
+        self.assertEqual(counts_df.shape, (50, 8))
@@ -1,9 +1,17 @@
+import os
+import unittest
+import unittest.mock
 import numpy as np
 import pandas
 from pandas.testing import assert_frame_equal
 from qiime2.plugin.testing import TestPluginBase
 from q2_surpi import (
-    __package_name__, SurpiCountTableFormat, SurpiSampleSheetFormat)
+    __package_name__, SurpiCountTableFormat, SurpiSampleSheetFormat,
+    SurpiCountTableReader, SurpiCountTableDirectoryFormat, SurpiCountMatrix,
+    SurpiCountTableCompressedFormat,
+    SurpiSampleSheetCompressedFormat, SurpiSampleSheetDirectoryFormat)
+from q2_surpi._cache import CACHE_DIR_ENV_VAR, get_pyarrow
+from q2_surpi._compression import get_zstandard
 from q2_surpi._formats_and_types import (
     SPECIES_KEY, GENUS_KEY, FAMILY_KEY, TAG_KEY, SAMPLE_NAME_KEY, BARCODE_KEY)
 
@@ -52,7 +60,10 @@ class TestSurpiCountTableFormatTransformers(TestPluginBase):
             "CATTCGGA+GATGGAAA": [0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 3, 0, 0, 0, 0, 0]
         }
 
+        # the counts all fit in the smallest unsigned dtype
         expected_df = pandas.DataFrame(expected_dict)
+        expected_df = expected_df.astype(
+            {x: np.uint8 for x in expected_df.columns[4:]})
 
         _, obs_df = self.transform_format(
             SurpiCountTableFormat, pandas.DataFrame,
@@ -60,6 +71,89 @@ class TestSurpiCountTableFormatTransformers(TestPluginBase):
 
         assert_frame_equal(obs_df, expected_df)
 
+    def test_surpicounttableformat_to_surpicounttablereader(self):
+        input_fname = "surpi_output.counttable"
+        expected_df = pandas.read_csv(
+            self.get_data_path(input_fname), sep='\t', header=0)
+
+        _, obs_reader = self.transform_format(
+            SurpiCountTableFormat, SurpiCountTableReader,
+            filename=input_fname)
+
+        self.assertIsInstance(obs_reader, SurpiCountTableReader)
+        obs_df = pandas.concat(obs_reader.iter_chunks()).astype(
+            {x: object for x in (GENUS_KEY, FAMILY_KEY, TAG_KEY)})
+        assert_frame_equal(obs_df, expected_df)
+
+    @unittest.skipIf(get_pyarrow() is None, "pyarrow is not installed")
+    def test_surpicounttableformat_to_surpicounttablereader_cached(self):
+        input_fname = "surpi_output.counttable"
+        cache_dir = os.path.join(self.temp_dir.name, "cache")
+
+        with unittest.mock.patch.dict(
+                os.environ, {CACHE_DIR_ENV_VAR: cache_dir}):
+            _, obs_reader = self.transform_format(
+                SurpiCountTableFormat, SurpiCountTableReader,
+                filename=input_fname)
+
+        # the arrow cache is only written once the chunks are read
+        self.assertIsNone(obs_reader.arrow_fp)
+        self.assertFalse(os.path.exists(cache_dir))
+        self.assertEqual(len(pandas.concat(obs_reader.iter_chunks())), 16)
+        self.assertEqual(os.path.dirname(obs_reader.arrow_fp), cache_dir)
+
+    def test_surpicounttableformat_to_surpicountmatrix(self):
+        input_fname = "surpi_output.counttable"
+        expected_df = pandas.read_csv(
+            self.get_data_path(input_fname), sep='\t', header=0)
+
+        _, obs_matrix = self.transform_format(
+            SurpiCountTableFormat, SurpiCountMatrix, filename=input_fname)
+
+        self.assertIsInstance(obs_matrix.counts, np.memmap)
+        np.testing.assert_array_equal(
+            obs_matrix.counts, expected_df.iloc[:, 4:].to_numpy())
+        self.assertEqual(obs_matrix.taxa[SPECIES_KEY].tolist(),
+                         expected_df[SPECIES_KEY].tolist())
+
+class TestSurpiCountTableCompressedFormatTransformers(TestPluginBase):
+    package = f'{__package_name__}.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.input_fnames = ["surpi_output.counttable.gz",
+                             "surpi_output.counttable.bz2"]
+        if get_zstandard() is not None:
+            self.input_fnames.append("surpi_output.counttable.zst")
+
+    def test_surpicounttablecompressedformat_to_dataframe(self):
+        _, expected_df = self.transform_format(
+            SurpiCountTableFormat, pandas.DataFrame,
+            filename="surpi_output.counttable")
+
+        for curr_fname in self.input_fnames:
+            _, obs_df = self.transform_format(
+                SurpiCountTableCompressedFormat, pandas.DataFrame,
+                filename=curr_fname)
+            assert_frame_equal(obs_df, expected_df)
+
+    def test_surpicounttablecompressedformat_to_directoryformat(self):
+        with open(self.get_data_path("surpi_output.counttable"), "rb") as f:
+            expected_bytes = f.read()
+
+        for curr_fname in self.input_fnames:
+            _, obs_dir = self.transform_format(
+                SurpiCountTableCompressedFormat,
+                SurpiCountTableDirectoryFormat, filename=curr_fname)
+
+            # the artifact holds only the decompressed counttable
+            self.assertEqual(os.listdir(str(obs_dir)),
+                             ["surpi_output.counttable"])
+            with open(os.path.join(str(obs_dir), "surpi_output.counttable"),
+                      "rb") as f:
+                self.assertEqual(f.read(), expected_bytes)
+        # endfor each compressed file
+
 
 class TestSurpiSampleSheetFormatTransformers(TestPluginBase):
     package = f'{__package_name__}.tests'
@@ -105,3 +199,26 @@ class TestSurpiSampleSheetFormatTransformers(TestPluginBase):
         # and the barcode, so we only compare those columns
         partial_obs_df = obs_df[[SAMPLE_NAME_KEY, BARCODE_KEY]]
         assert_frame_equal(partial_obs_df, expected_df)
+
+    def test_surpisamplesheetcompressedformat_to_dataframe(self):
+        _, expected_df = self.transform_format(
+            SurpiSampleSheetFormat, pandas.DataFrame,
+            filename="surpi_sample_info.csv")
+
+        _, obs_df = self.transform_format(
+            SurpiSampleSheetCompressedFormat, pandas.DataFrame,
+            filename="surpi_sample_info.csv.gz")
+
+        assert_frame_equal(obs_df, expected_df)
+
+    def test_surpisamplesheetcompressedformat_to_directoryformat(self):
+        with open(self.get_data_path("surpi_sample_info.csv"), "rb") as f:
+            expected_bytes = f.read()
+
+        _, obs_dir = self.transform_format(
+            SurpiSampleSheetCompressedFormat, SurpiSampleSheetDirectoryFormat,
+            filename="surpi_sample_info.csv.gz")
+
+        with open(os.path.join(str(obs_dir), "surpi_sample_info.txt"),
+                  "rb") as f:
+            self.assertEqual(f.read(), expected_bytes)
@@ -17,6 +17,9 @@ setup(
     url=init.__url__,
     entry_points={
         'qiime2.plugins':
-        [f'{init.__name__}={init.__package_name__}.plugin_setup:plugin']
+        [f'{init.__name__}={init.__package_name__}.plugin_setup:plugin'],
+        'console_scripts':
+        [f'q2-surpi-simulate={init.__package_name__}._simulate:main',
+         f'q2-surpi-cache={init.__package_name__}._cache:main']
     },
 )